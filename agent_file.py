@@ -0,0 +1,327 @@
+'''
+Helpers for the .npz agent files written by gym-coup's Human_v_Agent.
+An agent file is treated as a set of named arrays. Numeric arrays that keep
+their shape between two versions of a file can be diffed and merged.
+
+The app reads and writes the arrays Human_v_Agent saves, so an agent file
+works the same in the desktop game, batched training, the server and
+tournaments:
+    Q:           Q-values, one row per state and one column per action
+    states:      gym-coup's numeric observation each row of Q is for
+    lr, df, eps: Learning rate, discount factor and epsilon
+Other arrays in the file are carried along unchanged. The app writes Q as
+float32 and states as uint8, see narrow_tables, which Human_v_Agent reads
+like its own wider arrays.
+
+Agent files may also be saved uncompressed. These are still valid .npz files,
+but each array is stored as a plain .npy member of the zip, so it can be
+memory-mapped in place and only the pages that are used get read.
+'''
+
+import numpy as np
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+logger = logging.getLogger('app')
+
+# Read once, as setting it to read it isn't thread safe
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+# Arrays every agent file has, see the module docstring
+table_names = ('Q', 'states')
+param_names = ('lr', 'df', 'eps')
+
+
+def check_agent(path):
+    '''
+    Check that path is an agent file in Human_v_Agent's format, reading only its header.
+    Returns dict of name to ArrayInfo, see read_header. Raises ValueError otherwise.
+    '''
+    info = read_header(path)
+    if 'keys' in info and 'params' in info:
+        raise ValueError(f'{path} is a batched agent from an earlier version of the app, '
+                         f'which Human_v_Agent can\'t load. Train a new agent with --batch.')
+    missing = [k for k in table_names + param_names if k not in info]
+    if missing:
+        raise ValueError(f'{path} is not a Human_v_Agent agent file, it has no {", ".join(missing)}')
+    q, states = info['Q'], info['states']
+    if len(q.shape) != 2 or len(states.shape) != 2 or q.shape[0] != states.shape[0]:
+        raise ValueError(f'{path} has a Q-table of shape {q.shape} for states of shape {states.shape}')
+    return info
+
+
+def narrow_tables(arrays):
+    '''
+    Agent arrays with Q as float32 and states as uint8, half and an eighth of
+    Human_v_Agent's float64 and int64 on disk and in memory. States that don't
+    fit in a byte are left as they are. Returns a new dict.
+    '''
+    arrays = dict(arrays)
+    arrays['Q'] = np.asarray(arrays['Q'], dtype=np.float32)
+    states = arrays['states']
+    if states.size == 0 or (states.min() >= 0 and states.max() <= 255):
+        arrays['states'] = np.asarray(states, dtype=np.uint8)
+    return arrays
+
+
+def load_arrays(path, mmap_mode=None):
+    '''
+    Read every array of an agent file into memory.
+    mmap_mode: 'r' or 'c' to memory-map the uncompressed arrays instead,
+               so only the pages that are used get read, see AgentArrays
+    '''
+    if mmap_mode is None:
+        with np.load(path) as f:
+            return {k: f[k] for k in f.files}
+    arrays = AgentArrays(path, mmap_mode)
+    try:
+        return dict(arrays.items())
+    finally:
+        arrays.close()
+
+
+def save_arrays(path, arrays, compressed=True):
+    '''
+    Write arrays as an agent file.
+    Written to a temporary file first, so a crash never leaves a partial agent.
+    compressed: False to store arrays uncompressed so they can be memory-mapped
+    '''
+    # Unique in the target directory, so concurrent saves never share a temporary file
+    fd, tmp = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if compressed:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            # mkstemp files are private, give a new agent the usual permissions
+            os.chmod(tmp, 0o666 & ~_umask)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def is_mergeable(base, new):
+    return (base.shape == new.shape
+            and np.issubdtype(base.dtype, np.number)
+            and np.issubdtype(new.dtype, np.number))
+
+
+def _row_keys(states):
+    # One comparable value per row of states, whatever their dtype
+    states = np.ascontiguousarray(states, dtype=np.int64).reshape(len(states), -1)
+    return states.view(np.dtype((np.void, 8 * states.shape[1]))).reshape(-1)
+
+
+def match_rows(base_states, states):
+    '''
+    Rows of base_states holding each row of states, -1 where it isn't there
+    Returns int array
+    '''
+    rows = np.full(len(states), -1, dtype=np.int64)
+    if len(base_states) == 0 or len(states) == 0:
+        return rows
+    base_keys = _row_keys(base_states)
+    order = np.argsort(base_keys)
+    keys = _row_keys(states)
+    pos = np.minimum(np.searchsorted(base_keys[order], keys), len(order) - 1)
+    found = base_keys[order[pos]] == keys
+    rows[found] = order[pos[found]]
+    return rows
+
+
+def diff(base, new):
+    '''
+    base, new: Dicts of arrays from two versions of the same agent
+    Returns dict of new - base for every numeric array. For agent tables,
+    rows are matched by state: the Q changes of states in base are under 'Q',
+    and states added since base are under 'new.states' with their Q-values,
+    counted from zero, under 'new.Q'.
+    Raises ValueError if any other array changed, or an array changed shape
+    or type, as those updates can't be merged back.
+    '''
+    delta = {}
+    new = dict(new)
+    if all(k in base and k in new for k in table_names):
+        q, states = new.pop('Q'), new.pop('states')
+        rows = match_rows(base['states'], states)
+        known = rows >= 0
+        dq = np.zeros(base['Q'].shape, dtype=np.result_type(base['Q'], q))
+        dq[rows[known]] = q[known] - base['Q'][rows[known]]
+        delta['Q'] = dq
+        delta['new.states'] = states[~known]
+        delta['new.Q'] = q[~known]
+    for k, arr in new.items():
+        if k in base and is_mergeable(base[k], arr):
+            delta[k] = arr - base[k]
+        elif k not in base or base[k].shape != arr.shape or not np.array_equal(base[k], arr):
+            raise ValueError(f'Agent array {k} changed shape, type or non-numeric contents, its updates can\'t be merged')
+    return delta
+
+
+def merge(base, deltas):
+    '''
+    Apply the sum of deltas to base. States added by several deltas get one
+    row, with the sum of their Q-values.
+    base:   Dict of arrays, replaced with updated arrays, so it may hold read-only maps
+    deltas: Iterable of dicts from diff
+    '''
+    added = []
+    for delta in deltas:
+        delta = dict(delta)
+        if 'new.states' in delta:
+            added.append((delta.pop('new.states'), delta.pop('new.Q')))
+        for k, d in delta.items():
+            base[k] = base[k] + d.astype(base[k].dtype, copy=False)
+    for states, q in added:
+        if not len(states):
+            continue
+        rows = match_rows(base['states'], states)
+        known = rows >= 0
+        base['Q'] = np.array(base['Q'])
+        np.add.at(base['Q'], rows[known], q[known].astype(base['Q'].dtype, copy=False))
+        base['Q'] = np.concatenate([base['Q'], q[~known].astype(base['Q'].dtype, copy=False)])
+        base['states'] = np.concatenate([base['states'], states[~known]])
+    return base
+
+
+def export_npy(arrays, dirpath):
+    # Write arrays as separate .npy files that other processes can memory-map
+    os.makedirs(dirpath, exist_ok=True)
+    for k, arr in arrays.items():
+        np.save(os.path.join(dirpath, f'{k}.npy'), arr)
+
+
+def open_npy(dirpath):
+    # Memory-map a directory written by export_npy, read-only
+    return {os.path.splitext(name)[0]: np.load(os.path.join(dirpath, name), mmap_mode='r')
+            for name in os.listdir(dirpath) if name.endswith('.npy')}
+
+
+class ArrayInfo:
+    def __init__(self, shape, dtype, fortran_order, offset):
+        '''
+        offset: Byte offset of the array data in the agent file.
+                None if the member is compressed and can't be mapped.
+        '''
+        self.shape = shape
+        self.dtype = dtype
+        self.fortran_order = fortran_order
+        self.offset = offset
+
+
+def read_header(path):
+    '''
+    Read the names, shapes and dtypes of the arrays in an agent file,
+    without reading any array data.
+    Returns dict of name to ArrayInfo. Raises ValueError for invalid files.
+    '''
+    info = {}
+    try:
+        with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+            for member in z.infolist():
+                if not member.filename.endswith('.npy'):
+                    continue
+                name = member.filename[:-4]
+
+                if member.compress_type == zipfile.ZIP_STORED:
+                    # Skip the local file header to reach the .npy member
+                    f.seek(member.header_offset + 26)
+                    name_len, extra_len = struct.unpack('<HH', f.read(4))
+                    f.seek(name_len + extra_len, os.SEEK_CUR)
+                    shape, fortran_order, dtype = _read_npy_header(f)
+                    info[name] = ArrayInfo(shape, dtype, fortran_order, f.tell())
+                else:
+                    with z.open(member) as m:
+                        shape, fortran_order, dtype = _read_npy_header(m)
+                    info[name] = ArrayInfo(shape, dtype, fortran_order, None)
+    except (OSError, zipfile.BadZipFile) as e:
+        raise ValueError(f'{path} is not a valid agent file: {e}') from e
+    return info
+
+
+def _read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def is_compressed(path):
+    return any(a.offset is None for a in read_header(path).values())
+
+
+class AgentArrays:
+    '''
+    Dict-like view of the arrays in an agent file.
+    Uncompressed arrays are memory-mapped, others are read on first access.
+    '''
+    def __init__(self, path, mode='r'):
+        '''
+        mode: 'r' for read-only maps, or 'c' for copy-on-write, where
+              writes stay in memory and never reach the file
+        '''
+        self.path = path
+        self.mode = mode
+        self.info = read_header(path)
+        self._arrays = {}
+        self._npz = None
+
+    def __contains__(self, name):
+        return name in self.info
+
+    def __iter__(self):
+        return iter(self.info)
+
+    def __len__(self):
+        return len(self.info)
+
+    def keys(self):
+        return self.info.keys()
+
+    def items(self):
+        return ((k, self[k]) for k in self.info)
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            a = self.info[name]
+            if a.offset is not None and not a.dtype.hasobject and np.prod(a.shape) > 0:
+                self._arrays[name] = np.memmap(self.path,
+                                               dtype=a.dtype,
+                                               mode=self.mode,
+                                               offset=a.offset,
+                                               shape=a.shape,
+                                               order='F' if a.fortran_order else 'C')
+            else:
+                if self._npz is None:
+                    self._npz = np.load(self.path)
+                self._arrays[name] = self._npz[name]
+        return self._arrays[name]
+
+    def close(self):
+        if self._npz is not None:
+            self._npz.close()
+            self._npz = None
+        self._arrays = {}
+
+
+def convert(path, compressed=False):
+    # Rewrite an agent file in place as compressed or uncompressed, with narrowed tables
+    arrays = load_arrays(path)
+    if all(k in arrays for k in table_names):
+        arrays = narrow_tables(arrays)
+    save_arrays(path, arrays, compressed)
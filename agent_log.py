@@ -0,0 +1,441 @@
+'''
+Append-only persistence of agent training.
+
+Human_v_Agent saves its whole table after every training game. A
+TrainingSession points it at a scratch copy of the agent file instead, and
+after each game appends only the entries that changed to a log next to the
+agent file. Once it watches the game's env, only the rows of the states the
+agent acted in, and rows added since, are compared, and they are the only
+pages of the scratch copy read where it's uncompressed. The log is compacted
+into the agent file on quit, with an atomic replace, so a killed app never
+leaves a partially written agent behind. Anything that reads an agent file
+without a session calls compact_pending first, so it sees logged training.
+'''
+
+import agent_file
+from policy import StateIndex, encode
+import numpy as np
+import functools
+import io
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('app')
+
+
+# Agent file path to the future of a session closing in the background.
+# Sessions are closed and opened from the GUI, prefetch and I/O threads.
+_closing = {}
+_closing_lock = threading.Lock()
+
+
+def log_path(filepath):
+    # Training log kept next to an agent file
+    return f'{filepath}.log'
+
+
+def checkpoint_dir(filepath):
+    # Rotated snapshots of an agent file
+    return f'{filepath}.checkpoints'
+
+
+def list_checkpoints(filepath):
+    # Checkpoint paths of an agent file, newest first
+    d = checkpoint_dir(filepath)
+    if not os.path.isdir(d):
+        return []
+    return [os.path.join(d, n) for n in sorted(os.listdir(d), reverse=True) if n.endswith('.npz')]
+
+
+def wait_closing(filepath):
+    '''
+    Wait for a session on filepath that's closing in the background, if any.
+    A failed close was logged, and its log is still there to be compacted.
+    '''
+    with _closing_lock:
+        future = _closing.get(filepath)
+    if future is None:
+        return
+    future.exception()
+    with _closing_lock:
+        if _closing.get(filepath) is future:
+            del _closing[filepath]
+
+
+def compact_pending(filepath):
+    '''
+    Bring an agent file up to date before reading it without a TrainingSession.
+    Waits for a session on it that's closing in the background, then compacts
+    training logged by a session that never closed, e.g. a killed app.
+    '''
+    wait_closing(filepath)
+    log = AgentLog(log_path(filepath))
+    if not os.path.exists(filepath) or not os.path.exists(log.path):
+        return
+    logger.info(f'Compacting training log {log.path}')
+    arrays = log.replay(agent_file.load_arrays(filepath, mmap_mode='c'))
+    agent_file.save_arrays(filepath, arrays, agent_file.is_compressed(filepath))
+    log.clear()
+
+
+def apply_changes(arrays, changes):
+    '''
+    Set the entries of changes in arrays, in place. Flat indexes past the
+    end of an array add rows to it, replacing it in arrays with a bigger one.
+    changes: Dict of array name to (flat indexes, new values), see AgentLog.append
+    '''
+    for k, (idx, val) in changes.items():
+        arr = arrays[k]
+        if len(idx) and arr.ndim and idx.max() >= arr.size:
+            width = int(np.prod(arr.shape[1:]))
+            grown = np.zeros((int(idx.max()) // width + 1,) + arr.shape[1:], dtype=arr.dtype)
+            grown[:len(arr)] = arr
+            arrays[k] = arr = grown
+        arr.flat[idx] = val
+    return arrays
+
+
+def entry_changes(base, new, rows=None):
+    '''
+    Entries where new differs from base, as (flat indexes, values), or None
+    if new can't be logged by entry as it changed type or lost rows.
+    rows: Rows of base to compare, all of them if None. Rows new has past
+          the end of base are always included.
+    '''
+    if (base.dtype != new.dtype or not np.issubdtype(new.dtype, np.number)
+            or base.ndim != new.ndim or base.shape[1:] != new.shape[1:]):
+        return None
+    if new.ndim == 0:
+        if new == base:
+            return np.zeros(0, dtype=np.int64), new.reshape(1)[:0]
+        return np.zeros(1, dtype=np.int64), new.reshape(1)
+    n = len(base)
+    if len(new) < n:
+        return None
+    width = int(np.prod(new.shape[1:]))
+    rows = np.arange(n) if rows is None else rows
+    vals = np.asarray(new[rows]).reshape(len(rows), width)
+    r, c = np.nonzero(vals != np.asarray(base[rows]).reshape(len(rows), width))
+    return (np.concatenate([rows[r] * width + c, np.arange(n * width, len(new) * width)]),
+            np.concatenate([vals[r, c], np.asarray(new[n:]).reshape(-1)]))
+
+
+def restore_checkpoint(checkpoint, filepath):
+    '''
+    Make a checkpoint the agent file, e.g. to roll back a bad run.
+    Training logged since the last compaction is dropped.
+    '''
+    wait_closing(filepath)
+    # A unique name next to the agent file, so restores never share a partial copy
+    fd, tmp = tempfile.mkstemp(prefix=f'.{os.path.basename(filepath)}.', suffix='.tmp',
+                               dir=os.path.dirname(filepath) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f, open(checkpoint, 'rb') as src:
+            shutil.copyfileobj(src, f)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(filepath if os.path.exists(filepath) else checkpoint, tmp)
+        os.replace(tmp, filepath)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    AgentLog(log_path(filepath)).clear()
+    logger.info(f'Restored {filepath} from {checkpoint}')
+
+
+def _after(wait, fn, *args):
+    if wait is not None:
+        wait()
+    return fn(*args)
+
+
+def _log_failure(future):
+    # Background saves have no caller to raise to
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Saving training failed', exc_info=future.exception())
+
+
+class AgentLog:
+    # Record header: payload length, crc32 of payload
+    record_header = struct.Struct('<II')
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, changes):
+        '''
+        changes: Dict of array name to (flat indexes, new values).
+                 Indexes past the end of an array add rows, see apply_changes.
+        Values are absolute, so replaying a record twice is harmless.
+        '''
+        buf = io.BytesIO()
+        np.savez(buf, **{f'{k}.idx': idx for k, (idx, _) in changes.items()},
+                 **{f'{k}.val': val for k, (_, val) in changes.items()})
+        payload = buf.getvalue()
+
+        with open(self.path, 'ab') as f:
+            f.write(self.record_header.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def records(self):
+        # Yield the changes of each complete record, in order
+        if not os.path.exists(self.path):
+            return
+        torn = None
+        with open(self.path, 'rb') as f:
+            while True:
+                start = f.tell()
+                header = f.read(self.record_header.size)
+                if not header:
+                    break
+                if len(header) == self.record_header.size:
+                    length, crc = self.record_header.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == crc:
+                        with np.load(io.BytesIO(payload)) as rec:
+                            names = {n[:-4] for n in rec.files}
+                            yield {k: (rec[f'{k}.idx'], rec[f'{k}.val']) for k in names}
+                        continue
+                torn = start
+                break
+
+        if torn is not None:
+            # Torn write from a crash, drop it so later appends stay readable
+            logger.warning(f'Discarding incomplete record at byte {torn} of {self.path}')
+            with open(self.path, 'r+b') as f:
+                f.truncate(torn)
+
+    def replay(self, arrays):
+        # Apply every logged change to arrays, in place
+        for changes in self.records():
+            apply_changes(arrays, changes)
+        return arrays
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TrainingSession:
+    def __init__(self, filepath):
+        '''
+        filepath: The agent file being trained.
+                  May not exist yet when creating a new agent.
+        Use work_path as the Human_v_Agent filepath, and watch its env.
+        Log writes run in order on a background thread, see record_game_async.
+        Set checkpoint_every to snapshot the agent every that many games,
+        keeping the newest keep_checkpoints, see list_checkpoints.
+        Set updates to a metrics.Table of metrics.updates_columns to add a
+        row for each record, see _add_update.
+        '''
+        self.filepath = filepath
+        # Let the previous session on this agent finish compacting first
+        wait_closing(filepath)
+        self.log = AgentLog(log_path(filepath))
+        self._dir = tempfile.mkdtemp(prefix='coup_agent_')
+        self.work_path = os.path.join(self._dir, os.path.basename(filepath))
+        self._io = ThreadPoolExecutor(max_workers=1)
+        self.base = None
+        self.checkpoint_every = 0
+        self.keep_checkpoints = 5
+        self.updates = None
+        self.games = 0
+        # Snapshots are written apart from the log, so they never hold up a game's record
+        self._snapshots = ThreadPoolExecutor(max_workers=1)
+        # Observations the agent acted in since the last record, None until watch
+        self._touched = None
+        # Row of each state of base, built on the first record that needs it
+        self._index = None
+
+        if os.path.exists(filepath):
+            self.compressed = agent_file.is_compressed(filepath)
+            # Mapped copy-on-write when uncompressed, so logged changes never touch the file
+            self.base = agent_file.load_arrays(filepath, mmap_mode='c')
+            if os.path.exists(self.log.path):
+                # Recover training from a session that didn't compact
+                logger.info(f'Recovering training log {self.log.path}')
+                self.log.replay(self.base)
+                agent_file.save_arrays(self.work_path, self.base, compressed=False)
+            elif not self.compressed:
+                shutil.copyfile(filepath, self.work_path)
+            else:
+                agent_file.save_arrays(self.work_path, self.base, compressed=False)
+        else:
+            self.compressed = True
+
+    def watch(self, env):
+        '''
+        Note the states the agent acts in on env, so records only compare
+        their rows of the table. Without it, records compare every entry.
+        '''
+        self._touched = []
+        step = env.step
+
+        @functools.wraps(step)
+        def wrapper(action, *args, **kwargs):
+            if env.game.whose_action == 1:
+                self._touched.append(env.get_obs())
+            return step(action, *args, **kwargs)
+        env.step = wrapper
+
+    def _take_touched(self):
+        touched = self._touched
+        if touched is not None:
+            self._touched = []
+        return touched
+
+    def record_game(self, games=1):
+        '''
+        Log what the last games changed in the scratch copy
+        games: Games played since the last record, for checkpoint_every
+        '''
+        self._record(games, self._take_touched())
+
+    def _record(self, games, touched):
+        if not os.path.exists(self.work_path):
+            return
+        prev_games = self.games
+        self.games += games
+
+        if self.base is None:
+            # First save of a new agent
+            self.base = agent_file.load_arrays(self.work_path)
+            agent_file.save_arrays(self.filepath, self.base, self.compressed)
+            return
+
+        # Only the pages that are compared get read, where the scratch copy is uncompressed
+        new = agent_file.load_arrays(self.work_path, mmap_mode='r')
+        changes = self._changes(new, touched)
+        if changes is None:
+            # An array changed shape or type and can't be logged by entry, save the agent whole.
+            # Copied, as Human_v_Agent rewrites the scratch copy.
+            self.base = {k: np.array(arr) for k, arr in new.items()}
+            self._index = None
+            agent_file.save_arrays(self.filepath, self.base, self.compressed)
+            self.log.clear()
+            logger.debug('Saved the whole agent, an array changed shape or type')
+        elif changes:
+            self.log.append(changes)
+            if self.updates is not None:
+                self._add_update(changes)
+            apply_changes(self.base, changes)
+            logger.debug(f'Logged {sum(len(i) for i, _ in changes.values())} changed entries')
+
+        if self.checkpoint_every and self.games // self.checkpoint_every > prev_games // self.checkpoint_every:
+            self.checkpoint_async()
+
+    def _add_update(self, changes):
+        '''
+        Metrics row for a record, from the Q entries it changes. Human_v_Agent
+        moves an entry by the learning rate times its TD error, so an entry
+        updated more than once between records counts once, with the sum.
+        '''
+        if 'Q' not in changes or not all(k in self.base for k in ('Q', 'lr', 'eps')):
+            return
+        idx, val = changes['Q']
+        q = self.base['Q'].reshape(-1)
+        # Rows added since the last record start at zero
+        old = np.zeros(len(idx))
+        inside = idx < q.size
+        old[inside] = q[idx[inside]]
+        td = (val - old)[val != old] / float(self.base['lr'])
+        if not len(td):
+            return
+        self.updates.append(time=time.time(), games=self.games, transitions=len(td),
+                            td_abs=np.abs(td).mean(), epsilon=float(self.base['eps']))
+
+    def _changes(self, new, touched):
+        # Changed entries of new, see AgentLog.append, or None if it has to be saved whole
+        if set(new) != set(self.base):
+            return None
+        rows = self._touched_rows(new, touched) if touched is not None else None
+        changes = {}
+        for k, arr in new.items():
+            c = entry_changes(self.base[k], arr, rows if k in agent_file.table_names else None)
+            if c is None:
+                return None
+            if len(c[0]):
+                changes[k] = c
+        return changes
+
+    def _touched_rows(self, new, touched):
+        # Rows of base for the touched states, or None to compare every row
+        if not all(k in new and k in self.base for k in agent_file.table_names):
+            return None
+        states = self.base['states']
+        try:
+            if self._index is None or len(self._index) > len(states):
+                self._index = StateIndex(encode(states))
+            elif len(self._index) < len(states):
+                # Rows added by earlier records
+                self._index.lookup(encode(states[len(self._index):]))
+            rows = self._index.find(encode(np.array(touched).reshape(len(touched), -1)
+                                           if touched else np.zeros((0, states.shape[1]))))
+        except ValueError:
+            # Not gym-coup observations
+            return None
+        rows = np.unique(rows[rows >= 0])
+        if len(self._index) != len(states) or not np.array_equal(new['states'][rows], states[rows]):
+            # Duplicate states, or Human_v_Agent moved rows
+            self._index = None
+            return None
+        return rows
+
+    def checkpoint_async(self):
+        # Copy now, write and rotate in the background
+        arrays = {k: v.copy() for k, v in self.base.items()}
+        future = self._snapshots.submit(self._checkpoint, arrays, self.games)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def _checkpoint(self, arrays, games):
+        d = checkpoint_dir(self.filepath)
+        os.makedirs(d, exist_ok=True)
+        # Names sort by time
+        ns = time.time_ns()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(ns // 10**9))
+        name = f'{stamp}.{ns // 10**6 % 1000:03d}-{games}games.npz'
+        agent_file.save_arrays(os.path.join(d, name), arrays, self.compressed)
+        for old in list_checkpoints(self.filepath)[self.keep_checkpoints:]:
+            os.remove(old)
+
+    def compact(self):
+        # Write the logged training into the agent file
+        if self.base is None or not os.path.exists(self.log.path):
+            return
+        agent_file.save_arrays(self.filepath, self.base, self.compressed)
+        self.log.clear()
+
+    def close(self):
+        self.compact()
+        self._snapshots.shutdown(wait=True)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def record_game_async(self, games=1, after=None):
+        '''
+        after: Function to wait on before recording, on the background thread,
+               e.g. until a game step that's still writing work_path finishes
+        '''
+        # Taken now, later steps belong to the next record
+        future = self._io.submit(_after, after, self._record, games, self._take_touched())
+        future.add_done_callback(_log_failure)
+        return future
+
+    def close_async(self, after=None):
+        # Runs after any pending record_game_async. after is as for record_game_async.
+        future = self._io.submit(_after, after, self.close)
+        future.add_done_callback(_log_failure)
+        self._io.shutdown(wait=False)
+        with _closing_lock:
+            _closing[self.filepath] = future
+        return future
@@ -1,5 +1,68 @@
 from components import *
-from coup_rl import Human_v_Agent
+from worker import StepRunner
+import os
+import pickle
+import threading
+import time
+
+def preload():
+    '''
+    Import the RL stack (gym-coup, numpy) on a background thread,
+    so it's ready by the time a game starts without delaying the menu.
+    '''
+    def run():
+        try:
+            import coup_rl
+            import agent_log
+            decoder.load()
+        except ImportError as e:
+            # Reported again when a game is started
+            logger.warning(f'Could not preload the RL stack: {e}')
+    threading.Thread(target=run, daemon=True).start()
+
+def new_game(p_first_turn,
+             filepath,
+             is_training,
+             learning_rate=None,
+             discount_factor=None,
+             epsilon=None):
+    '''
+    Load the agent and build the game. Safe to call off the GUI thread.
+    Takes the same parameters as Board.game_setup.
+    Returns (Human_v_Agent or policy.PolicyGame, TrainingSession or None)
+    '''
+    if not is_training and os.path.exists(filepath):
+        from agent_log import compact_pending
+        from policy import PolicyGame
+        compact_pending(filepath)
+        # Only the Q-table rows of the states met are read, unlike Human_v_Agent
+        game = PolicyGame(p_first_turn, filepath)
+        # Training changes the agent, which would make the book stale
+        from book import OpeningBook, book_path
+        book = OpeningBook.load(book_path(filepath), filepath)
+        if book is not None:
+            game.agent.step = book.wrap(game.env, game.agent.step)
+        return game, None
+
+    # Usually already imported by preload
+    from coup_rl import Human_v_Agent
+    from agent_log import TrainingSession
+
+    # When training, the agent saves to a scratch copy and
+    # only the changes are logged to the agent file
+    training = TrainingSession(filepath) if is_training else None
+
+    # agent and game env with RL algo
+    game = Human_v_Agent(p_first_turn,
+                         training.work_path if training else filepath,
+                         is_training,
+                         learning_rate,
+                         discount_factor,
+                         epsilon,
+                         log_level=logger.level)
+    if training:
+        training.watch(game.env)
+    return game, training
 
 class Board(QWidget):
     def __init__(self):
@@ -10,15 +73,46 @@ class Board(QWidget):
         self.layout = QVBoxLayout()
 
         self.top_menu = TopMenu()
+
+        # Game steps run in the background so the window stays responsive
+        self.runner = StepRunner(self)
+        self.runner.finished.connect(self.step_finished)
+        self.runner.failed.connect(self.step_failed)
+        self.top_menu.quit_btn.clicked.connect(self.runner.cancel)
+        self.top_menu.undo_btn.clicked.connect(self.undo)
+        self.training = None
+        # Log training updates every this many games
+        self.flush_every = 1
+        self.unflushed_games = 0
+        # Future of the last training record, which game steps wait for
+        self._recording = None
+        # metrics.MetricsWriter of the agent being trained
+        self.metrics = None
+        # metrics.StepHook recording the agent's steps while training
+        self.step_hook = None
+        self.turns = 0
+        # replay.ReplayFile finished games are saved to, if any
+        self.replays = None
+        self.record = None
+        # False when showing a replay rather than playing
+        self.can_rematch = True
+        # True if the env can be put back to an earlier step, e.g. not for remote games
+        self.can_undo = False
+        # (snapshot.Snapshot, recorded steps, turns) before each of the human's actions
+        self.history = []
+
         self.p1 = Player('Me', self)
         self.p2 = Player('Opponent', self)
         self.players = [self.p1, self.p2]
 
         self.actions = ActionSelector()
         self.actions.disable_all()
-        for btn in self.actions.findChildren(ActionButton):
+        for btn in self.actions.buttons.values():
             btn.clicked.connect(self.action_btn_click)
 
+        # Swapped in for the actions when a game ends
+        self.game_over = None
+
         self.select_cards_instructions = QLabel('', self)
 
         self.confirm_btn = QPushButton('Confirm', self)
@@ -51,77 +145,256 @@ class Board(QWidget):
         discount_factor: Used for creating new QTable. Float [0, 1]
         epsilon:         Used for creating new QTable. Float [0, 1]
         '''
-        # agent and game env with RL algo
-        self._game = Human_v_Agent(p_first_turn,
+        self.attach_game(*new_game(p_first_turn,
                                    filepath,
                                    is_training,
                                    learning_rate,
                                    discount_factor,
-                                   epsilon,
-                                   log_level=logger.level)
+                                   epsilon))
+
+    def attach_game(self, game, training=None):
+        '''
+        game:     Human_v_Agent, or any object with the same step/agent/env interface
+        training: TrainingSession the game saves through, if training
+        '''
+        self._game = game
+        self.training = training
+        self._recording = None
+        if training is not None:
+            from metrics import (MetricsWriter, StepHook, games_columns, metrics_path,
+                                 steps_columns, updates_columns)
+            self.metrics = MetricsWriter(metrics_path(training.filepath), chunk_rows=64)
+            self.metrics.table('games', games_columns)
+            self.step_hook = StepHook(game.env, self.metrics.table('steps', steps_columns))
+            training.updates = self.metrics.table('updates', updates_columns)
+        self.turns = 0
         # gym env with game logic
         self.env = self._game.env
+        decoder.check(self.env)
+        # Undoing a move wouldn't undo what the agent learned from it
+        self.can_undo = self.can_undo and training is None
+        self.top_menu.undo_btn.setVisible(self.can_undo)
+        self.history = []
+
+        if profiler.enabled:
+            # Agent time includes any env steps the agent takes itself
+            self._game.agent.step = profiler.wrap('agent', self._game.agent.step)
+            self.env.step = profiler.wrap('env_step', self.env.step)
+        if self.replays is not None:
+            from replay import GameRecord
+            self.record = GameRecord()
+            self.record.start(self.env)
+            self.env.step = self.recorded(self.env.step)
+        # Last rendered observation, used to only patch what changed
+        self._last_obs = None
+
+        self.refresh()
+
+    def recorded(self, step):
+        # Wrap env.step to record every step, including those the agent takes itself
+        def wrapper(*args, **kwargs):
+            ret = step(*args, **kwargs)
+            self.record.add(self.env)
+            return ret
+        return wrapper
+
+    def end_game(self, obs):
+        self.actions.hide()
+        self.disable_card_select()
+        # Check who won the game
+        user_won = 0 in obs[8:12]
+        if self.game_over is None:
+            self.game_over = GameOver(user_won)
+            self.game_over.rematch_btn.clicked.connect(self.rematch)
+        else:
+            self.game_over.set_result(user_won)
+        self.game_over.rematch_btn.setVisible(self.can_rematch)
+        self.layout.replaceWidget(self.actions, self.game_over)
+        self.game_over.show()
+
+        if self.metrics is not None:
+            # Recorded from the agent's side, like headless games
+            self.metrics.tables['games'].append(time=time.time(), won=not user_won, turns=self.turns,
+                                                training=True, epsilon=float('nan'))
+            self.step_hook.games += 1
+
+        if self.training:
+            self.unflushed_games += 1
+            if self.unflushed_games >= self.flush_every:
+                # Read in the background, so a rematch starts straight away
+                self._recording = self.training.record_game_async(self.unflushed_games)
+                self.metrics.flush()
+                self.unflushed_games = 0
+
+        if self.record is not None:
+            self.replays.append(self.record, user_won)
+
+    def show_actions(self):
+        # Swap the actions back in for the game over widget
+        if self.game_over is not None and self.game_over.isVisibleTo(self):
+            self.layout.replaceWidget(self.game_over, self.actions)
+            self.game_over.hide()
+            self.actions.show()
+        self.actions.disable_all()
 
+    def rematch(self):
+        '''
+        Start a new game in place, keeping the loaded agent and the widgets.
+        Relies on the env's reset() starting a new game.
+        '''
+        self.env.reset()
+        if self.record is not None:
+            self.record.start(self.env)
+        self.turns = 0
+        self.history = []
+        self.show_actions()
+        self.redraw()
+
+        if self.env.game.whose_action == 1:
+            self.agent_step()
+
+    def redraw(self):
+        # Render the env from scratch rather than patching the last render
+        for p in self.players:
+            p.set_move('-')
+        self._last_obs = None
         self.refresh()
 
-    def refresh(self):
+    def save_undo(self):
+        # Snapshot the game before the human's action, so it can be taken back
+        self.top_menu.undo_btn.setEnabled(False)
+        if self.can_undo:
+            from snapshot import Snapshot
+            try:
+                snapshot = Snapshot(self.env)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logger.warning(f'Undo is off, the game can\'t be snapshotted: {e}')
+                self.can_undo = False
+                self.top_menu.undo_btn.hide()
+                return
+            recorded = len(self.record.states) if self.record is not None else 0
+            self.history.append((snapshot, recorded, self.turns))
+
+    def undo(self):
+        # Back to before the human's last action, and the agent's reply to it
+        if self.runner.busy or not self.history:
+            return
+        snapshot, recorded, self.turns = self.history.pop()
+        snapshot.restore(self.env)
+        if self.record is not None:
+            del self.record.states[recorded:]
+        self.disable_card_select()
+        self.actions.disable_all()
+        self.redraw()
+        self.update_undo()
+
+    def update_undo(self):
+        self.top_menu.undo_btn.setEnabled(bool(self.history) and not self.runner.busy
+                                          and not self.env.game.game_over)
+
+    def end_session(self):
+        # Compact logged training into the agent file in the background
+        self.runner.cancel()
+        if self.training:
+            # A cancelled step may still be writing the scratch agent, record and close after it
+            step_done = self.runner.waiter()
+            if self.unflushed_games:
+                self.training.record_game_async(self.unflushed_games, after=step_done)
+                self.unflushed_games = 0
+            closed = self.training.close_async(after=step_done)
+            self.training = None
+            self._recording = None
+            if self.metrics is not None:
+                # The last records still add their updates
+                closed.add_done_callback(lambda _, metrics=self.metrics: metrics.close())
+                self.metrics = None
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+        self.step_hook = None
+
+    def agent_step(self):
+        # Agent takes its turn without a human action, e.g. when it goes first
+        self.actions.disable_all()
+        self.submit_step()
+
+    def submit_step(self, action=None):
+        # Steps of a rematch wait on the worker thread while the last game's record reads the scratch agent
+        recording = self._recording
+        if recording is not None and recording.done():
+            recording = self._recording = None
+        self.runner.submit(self._game, action, after=recording.exception if recording is not None else None)
+
+    def step_finished(self, obs):
+        self.turns += 1
+        self.refresh(obs)
+        self.update_undo()
+        if profiler.enabled:
+            # Paint now rather than on the next event loop pass, to time it
+            with profiler.time('repaint'):
+                self.repaint()
+
+    @profiled('refresh')
+    def refresh(self, obs=None):
+        '''
+        obs: Numeric observation from the env. Fetched from the env if None.
+        '''
         valid = []
-        obs = self.env.get_obs(text=True)
+        if obs is None:
+            obs = self.env.get_obs()
+        decoder.learn_obs(self.env, obs)
 
         if self.env.game.game_over:
-            self.actions.close()
-            self.disable_card_select()
-            # Check who won the game
-            user_won = 0 in obs[8:12]
-            self.layout.replaceWidget(self.actions, GameOver(user_won))
+            if self.actions.isVisibleTo(self):
+                self.end_game(obs)
 
         elif self.env.game.whose_action == 0:
-            valid = self.env.get_valid_actions(text=True)
+            valid = decoder.valid_actions(self.env)
             self.actions.enable(valid)
 
+        last = self._last_obs
         for i in range(len(self.players)):
             p = self.players[i]
-            p_env_cards = [(obs[ind+i*4], obs[ind+8+i*4]) for ind in range(4) if obs[ind+i*4] != 'none']
+            cards_slice = slice(i*4, i*4+4)
+            elim_slice = slice(8+i*4, 12+i*4)
             p_env_coins = obs[16+i]
             p_env_la = obs[18+i]
 
-            # Refresh coins
-            p.set_coins(p_env_coins)
-
-            # Refresh last move
-            if p_env_la != 'none':
-                a = p_env_la.replace('_', ' ').capitalize().strip()
-                if a[:4] in ['Pass', 'Bloc', 'Chal']:
-                    a = a.split()[0]
-                p.set_move(a)
-
-            # Replace all cards
-            while len(p.cards):
-                p.remove_card(0)
-            for c in p_env_cards:
-                new_c = Card(name=c[0], parent=p)
-                if c[1]:
-                    new_c.set_eliminated()
-                elif i == 1:
-                    # Hide player 2 cards unless eliminated
-                    new_c.set_hidden()
-
-                p.add_card(new_c)
+            # Only patch the fields that changed since the last render
+            if last is None or p_env_coins != last[16+i]:
+                p.set_coins(p_env_coins)
+
+            label = decoder.moves[p_env_la]
+            if label is not None and (last is None or p_env_la != last[18+i]):
+                p.set_move(label)
+
+            if (last is None
+                    or list(obs[cards_slice]) != last[cards_slice]
+                    or list(obs[elim_slice]) != last[elim_slice]):
+                # Hide player 2 cards unless eliminated
+                p.set_cards([(decoder.cards[c], bool(elim), i == 1 and not elim)
+                             for c, elim in zip(obs[cards_slice], obs[elim_slice])
+                             if decoder.cards[c] is not None])
+
+            if i == 0:
+                # Any previous selection is void after a step
+                p.clear_selection()
 
             # If necessary, allow P1 cards to be selected
             if self.env.game.whose_action == 0 and i == 0:
                 text = ''
-                if 'lose_card_1' in valid or 'lose_card_2' in valid:
+                selects = {decoder.selects[a] for a in valid}
+                if 1 in selects:
                     # Player will select which card to lose
                     p.num_selectable = 1
 
-                    if obs[19] == 'assassinate':
+                    if decoder.moves[obs[19]] == action_label('assassinate'):
                         # Opponent is assassinating
                         text = 'Choose a card to be eliminated and press Confirm\nOR\nBlock or Challenge the assassination'
                     else:
                         # Player's only option is losing a card
                         text = 'Choose a card to be eliminated and press Confirm.'
-                elif 'exchange_return_34' in valid:
+                elif 2 in selects:
                     p.num_selectable = 2
                     text = 'Choose 2 cards to return to the deck and press Confirm.'
                 else:
@@ -138,14 +411,21 @@ class Board(QWidget):
                     # Show instructions text
                     self.select_cards_instructions.setText(text)
 
+        self._last_obs = list(obs)
+
     def action_btn_click(self):
         # Prevent more clicks
         self.actions.disable_all()
 
         sender = self.sender()
         action = sender.coup_action_name
-        self._game.step(action)
+        self.save_undo()
+        self.submit_step(action)
+
+    def step_failed(self, msg):
+        logger.error(f'Game step failed: {msg}')
         self.refresh()
+        self.update_undo()
 
     def disable_card_select(self):
         # Hide confirm button
@@ -177,5 +457,5 @@ class Board(QWidget):
         else:
             raise RuntimeError('Cannot select more than two cards')
 
-        self._game.step(action)
-        self.refresh()
+        self.save_undo()
+        self.submit_step(action)
@@ -0,0 +1,176 @@
+'''
+Opening book: precomputed agent moves for early-game states.
+
+The first few plies of most games pass through the same states, so their
+moves are worked out offline and stored as packed states and action ids. A
+game's agent plays book moves where it has one and falls back to its own
+choice otherwise.
+
+A book built for an agent file holds the agent's own greedy moves, so it
+plays the agent as it is, only without the table lookups. It also holds the
+file's size and mtime, and is ignored once the file changes, e.g. after
+training. Without an agent file, tree search chooses the moves, for the
+Tree Search opponent.
+
+    $ python app/book.py --agent agent.npz --plies 6 --games 2000
+'''
+
+import agent_file
+from agent_log import compact_pending
+from policy import BatchPolicy, encode, valid_mask
+import numpy as np
+import argparse
+import functools
+import logging
+import os
+import random
+
+logger = logging.getLogger('app')
+
+
+def book_path(filepath):
+    # Opening book kept next to an agent file
+    return f'{filepath}.book'
+
+
+def fingerprint(filepath):
+    # Of the agent with its logged training, which compaction would change
+    compact_pending(filepath)
+    st = os.stat(filepath)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+class OpeningBook:
+    def __init__(self, moves=None):
+        '''
+        moves: Dict of packed state, see policy.encode, to action id
+        '''
+        self.moves = moves if moves is not None else {}
+
+    def __len__(self):
+        return len(self.moves)
+
+    def key(self, env):
+        return int(encode([env.get_obs()])[0])
+
+    def get(self, env):
+        # Book action id for the env's state, or None
+        action = self.moves.get(self.key(env))
+        if action is not None and action in env.get_valid_actions():
+            return action
+        return None
+
+    def wrap(self, env, step):
+        # An agent step that plays book moves until the agent is out of book
+        @functools.wraps(step)
+        def wrapper(*args, **kwargs):
+            while not env.game.game_over and env.game.whose_action == 1:
+                action = self.get(env)
+                if action is None:
+                    return step(*args, **kwargs)
+                env.step(action)
+        return wrapper
+
+    def save(self, path, source=None):
+        '''
+        source: Agent file the book is for, whose own moves it holds, see build.
+                The book is dropped when that file changes.
+        '''
+        arrays = {
+            'keys': np.fromiter(self.moves.keys(), dtype=np.uint64, count=len(self.moves)),
+            'actions': np.fromiter(self.moves.values(), dtype=np.int16, count=len(self.moves)),
+        }
+        if source is not None:
+            arrays['source'] = fingerprint(source)
+            arrays['own_moves'] = np.array(True)
+        agent_file.save_arrays(path, arrays)
+
+    @classmethod
+    def load(cls, path, source=None):
+        '''
+        Returns the book at path, or None if there isn't one
+        or it wasn't built from source's own moves as it is now.
+        '''
+        if not os.path.exists(path):
+            return None
+        try:
+            arrays = agent_file.load_arrays(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read opening book {path}: {e}')
+            return None
+        if 'source' in arrays and (source is None or not os.path.exists(source)
+                                   or not np.array_equal(arrays['source'], fingerprint(source))):
+            logger.info(f'Ignoring opening book {path}, its agent file has changed')
+            return None
+        if source is not None and 'own_moves' not in arrays:
+            # Tree search moves, which would play the agent differently
+            logger.info(f'Ignoring opening book {path}, it wasn\'t built from the agent\'s own moves')
+            return None
+        return cls(dict(zip(arrays['keys'].tolist(), arrays['actions'].tolist())))
+
+
+def build(envs, choose, plies=6, games=1000, seed=None):
+    '''
+    Sample the first plies env steps of games, with random human moves,
+    and book the agent's choice in every state it meets.
+    envs:   gym-coup envs to play on, e.g. one per p_first_turn
+    choose: Function of an env returning the agent's action id
+    Returns OpeningBook
+    '''
+    rng = random.Random(seed)
+    book = OpeningBook()
+    for n in range(games):
+        env = envs[n % len(envs)]
+        env.reset()
+        for _ in range(plies):
+            if env.game.game_over:
+                break
+            if env.game.whose_action == 1:
+                key = book.key(env)
+                if key not in book.moves:
+                    book.moves[key] = int(choose(env))
+                env.step(book.moves[key])
+            else:
+                env.step(rng.choice(env.get_valid_actions()))
+    return book
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an opening book')
+    parser.add_argument('--agent', metavar='FILE',
+                        help='Agent file the book is for, which chooses the book moves itself. '
+                             'Without it, tree search chooses them.')
+    parser.add_argument('--out', metavar='FILE', help='Book file, by default next to --agent')
+    parser.add_argument('--plies', type=int, default=6, help='Env steps from the start of the game to cover')
+    parser.add_argument('--games', type=int, default=1000, help='Games to sample')
+    parser.add_argument('--think', type=float, default=1.0, help='Seconds of tree search per book move, without --agent')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    if args.agent is None and args.out is None:
+        parser.error('Give --agent, --out or both')
+
+    from headless import new_envs
+    envs = new_envs(1, 0) + new_envs(1, 1)
+    search = None
+    if args.agent is not None:
+        try:
+            policy = BatchPolicy.load(args.agent)
+        except ValueError as e:
+            parser.error(str(e))
+        def choose(env):
+            # As policy.PolicyGame plays it
+            mask = valid_mask([env.get_valid_actions()], policy.num_actions)
+            return policy.greedy(np.array([env.get_obs()]), mask)[0]
+    else:
+        from mcts import MCTSAgent
+        search = MCTSAgent(envs[0], time_budget=args.think, seed=args.seed)
+        def choose(env):
+            search.env = env
+            return search.choose()
+
+    book = build(envs, choose, args.plies, args.games, args.seed)
+    if search is not None:
+        search.close()
+    out = args.out or book_path(args.agent)
+    book.save(out, args.agent)
+    print(f'Booked {len(book)} states to {out}')
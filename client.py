@@ -0,0 +1,86 @@
+'''
+Client for server.py, so the Board can play a game hosted by a server.
+'''
+
+import json
+import socket
+
+
+class RemoteState:
+    def __init__(self):
+        self.whose_action = 0
+        self.game_over = False
+
+
+class RemoteEnv:
+    # Mirrors the server's env from its last reply
+    def __init__(self, game):
+        self._game = game
+        self.game = RemoteState()
+        self.obs = None
+        self.valid = []
+
+    def update(self, reply):
+        self.obs = reply['obs']
+        self.valid = reply['valid']
+        self.game.whose_action = reply['whose_action']
+        self.game.game_over = reply['game_over']
+
+    def get_obs(self, text=True):
+        return self.obs
+
+    def get_valid_actions(self, text=True):
+        return self.valid
+
+    def step(self, action):
+        # The server also plays the agent's answer
+        self._game.request(op='step', action=action)
+
+    def reset(self):
+        self._game.request(op='reset')
+
+
+class RemoteAgent:
+    def __init__(self, game):
+        self._game = game
+
+    def step(self):
+        self._game.request(op='agent')
+
+
+class RemoteGame:
+    '''
+    Same interface as Human_v_Agent, for a game hosted by a server.
+    Requests block, so like Human_v_Agent it's stepped through the StepRunner.
+    Only text observations and actions are available.
+    '''
+    def __init__(self, address, p_first_turn=0, timeout=30):
+        '''
+        address:      'host:port' of the server
+        p_first_turn: Which player goes first, 0-indexed
+        timeout:      Seconds to wait for the server
+        '''
+        host, port = address.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)), timeout=timeout)
+        self.file = self.sock.makefile('rwb')
+        self.env = RemoteEnv(self)
+        self.agent = RemoteAgent(self)
+        self.request(op='new', p_first_turn=p_first_turn)
+
+    def request(self, **msg):
+        self.file.write(json.dumps(msg).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('Server closed the connection')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError(f'Server error: {reply["error"]}')
+        self.env.update(reply)
+
+    def step(self, action):
+        self.env.step(action)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
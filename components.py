@@ -1,12 +1,133 @@
 from PyQt6.QtWidgets import *
-from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QColor
+from PyQt6.QtCore import Qt, QPointF, QTimer, pyqtSignal
+from PyQt6.QtGui import QColor, QFontDatabase, QPainter, QPen, QPolygonF
+from profiling import profiler, profiled
 import logging
+import threading
 
 logging.basicConfig()
 logger = logging.getLogger('app')
 
 
+def _decode_action(action_name):
+    # gym-coup action name to the label used on buttons and as the last move
+    a = action_name.replace('_', ' ').capitalize().strip()
+    if a[:4] in ['Pass', 'Bloc', 'Chal']:
+        a = a.split()[0]
+    return a
+
+# Decoded once at import for the fixed action names. Names not listed here,
+# such as the Pass/Block/Challenge variants, are decoded on first use and kept.
+action_labels = {x: _decode_action(x) for x in
+                 ['income', 'foreign_aid', 'coup', 'tax', 'assassinate', 'exchange', 'steal',
+                  'lose_card_1', 'lose_card_2',
+                  'exchange_return_12', 'exchange_return_13', 'exchange_return_14',
+                  'exchange_return_23', 'exchange_return_24', 'exchange_return_34']}
+
+def action_label(action_name):
+    label = action_labels.get(action_name)
+    if label is None:
+        label = action_labels[action_name] = _decode_action(action_name)
+    return label
+
+
+class Decoder:
+    '''
+    Tables from gym-coup's numeric card and action ids to what the board shows,
+    built once from coup_rl's card and action name lists, so decoding is a
+    dict lookup. Ids are list positions, and last moves are offset by one, 0
+    being no move yet. Envs that only have text observations, such as replays
+    and remote games, report names as their ids, which are in the tables too.
+    If the lists can't be imported, or don't match an env's text API, ids are
+    learned the first time an env reports them instead, see learn_obs.
+    '''
+    def __init__(self):
+        # Card id to card name, None for an empty slot
+        self.cards = {}
+        # Last move id to its label, None for no move yet
+        self.moves = {}
+        # Action id to gym-coup action name, and to its button label
+        self.actions = {}
+        self.labels = {}
+        # Action id to cards the player selects to play it, 1 to lose one and 2 to return two
+        self.selects = {}
+        # None until load, then True if ids are learned from envs
+        self.learning = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        # Build the tables from coup_rl's lists. Safe to call from any thread, only the first call builds them.
+        with self._lock:
+            if self.learning is not None:
+                return
+            try:
+                from coup_rl import actions, cards
+            except ImportError as e:
+                logger.warning(f'Learning card and action ids from the game, coup_rl has no lists of them: {e}')
+                self.learning = True
+                return
+            for i, name in enumerate(cards):
+                for c in (i, name):
+                    self.cards[c] = None if name == 'none' else name
+            self.moves[0] = self.moves['none'] = None
+            for i, name in enumerate(actions):
+                self.moves[i + 1] = self.moves[name] = action_label(name)
+                for a in (i, name):
+                    self.actions[a] = name
+                    self.labels[a] = action_label(name)
+                    self.selects[a] = (1 if name.startswith('lose_card')
+                                       else 2 if name.startswith('exchange_return') else 0)
+            self.learning = False
+
+    def check(self, env):
+        '''
+        Check the tables against a new game's text API, once per game rather
+        than per refresh. Falls back to learning ids if they don't match.
+        '''
+        self.load()
+        if self.learning:
+            return
+        obs, text = env.get_obs(), env.get_obs(text=True)
+        expected = [None if n == 'none' else n for n in text[0:8]] + [
+            None if n == 'none' else action_label(n) for n in text[18:20]]
+        found = [self.cards.get(c, 0) for c in obs[0:8]] + [self.moves.get(m, 0) for m in obs[18:20]]
+        valid = env.get_valid_actions()
+        if found != expected or [self.actions.get(a) for a in valid] != env.get_valid_actions(text=True):
+            logger.warning('coup_rl\'s card and action lists don\'t match the game, learning ids from it instead')
+            with self._lock:
+                for table in (self.cards, self.moves, self.actions, self.labels, self.selects):
+                    table.clear()
+                self.learning = True
+
+    def learn_obs(self, env, obs):
+        '''
+        When learning, learn the ids in a numeric observation that aren't in the tables yet.
+        env: Env obs was read from, not stepped since
+        '''
+        if not self.learning or (all(c in self.cards for c in obs[0:8])
+                                 and all(m in self.moves for m in obs[18:20])):
+            return
+        text = env.get_obs(text=True)
+        for c, name in zip(obs[0:8], text[0:8]):
+            self.cards[c] = None if name == 'none' else name
+        for m, name in zip(obs[18:20], text[18:20]):
+            self.moves[m] = None if name == 'none' else action_label(name)
+
+    def valid_actions(self, env):
+        # Valid action ids of env, learning any that are new when learning
+        valid = env.get_valid_actions()
+        if self.learning and any(a not in self.actions for a in valid):
+            for a, name in zip(valid, env.get_valid_actions(text=True)):
+                self.actions[a] = name
+                self.labels[a] = action_label(name)
+                self.selects[a] = (1 if name.startswith('lose_card')
+                                   else 2 if name.startswith('exchange_return') else 0)
+        return valid
+
+# Shared by every board, as the ids are gym-coup's
+decoder = Decoder()
+
+
 class Card(QFrame):
     name_colors = {
         'Assassin': 'black',
@@ -25,11 +146,14 @@ class Card(QFrame):
         self.setFixedSize(100, 150)
 
         # Highlight on hover and press
+        self.name = name
         self.is_hidden = name is None
         self.is_selected = False
         self.is_selectable = False
         self.is_eliminated = False
-        
+        # (name, is_eliminated, is_hidden) as last set through set_state
+        self.state = None
+
         self.layout = QHBoxLayout()
 
         self.layout.addStretch()
@@ -41,6 +165,13 @@ class Card(QFrame):
 
         self.setAutoFillBackground(True)
 
+        # Created once and toggled, so reused cards don't pile up labels
+        self.elim_lbl = QLabel('ELIMINATED', self)
+        self.elim_lbl.setStyleSheet('color: red; font-weight: bold; background-color: black;')
+        self.elim_lbl.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.elim_lbl.move(0, 0)
+        self.elim_lbl.hide()
+
         if self.is_hidden:
             self.set_hidden()
         else:
@@ -51,6 +182,7 @@ class Card(QFrame):
         if name not in self.name_colors:
             raise RuntimeError(f'Cannot set to unknown card type {name}')
 
+        self.name = name
         self.lbl.setText(name)
         p = self.palette()
         p.setColor(self.backgroundRole(), QColor(self.name_colors[name]))
@@ -65,17 +197,29 @@ class Card(QFrame):
         self.setPalette(p)
         self.is_hidden = True
 
-    def set_eliminated(self):
+    def set_eliminated(self, val=True):
         # Indicate when card is eliminated
-        if self.is_hidden:
+        if val and self.is_hidden:
             logger.warning('Show the card details before setting it as eliminated.')
             return
 
-        self.is_eliminated = True
-        self.elim_lbl = QLabel('ELIMINATED', self)
-        self.elim_lbl.setStyleSheet('color: red; font-weight: bold; background-color: black;')
-        self.elim_lbl.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.elim_lbl.move(0, 0)
+        self.is_eliminated = val
+        self.elim_lbl.setVisible(val)
+
+    def set_state(self, name, eliminated=False, hidden=False):
+        '''
+        Reuse this card to show a new state.
+        Hidden cards keep the name so later changes can be detected.
+        '''
+        if hidden:
+            self.set_hidden()
+            self.set_eliminated(False)
+        else:
+            if self.is_hidden or name != self.name:
+                self.set_card(name)
+            self.set_eliminated(eliminated)
+        self.name = name
+        self.state = (name, eliminated, hidden)
 
     def set_highlighted(self, val):
         # val: True or False
@@ -104,6 +248,12 @@ class Card(QFrame):
         if self.is_selectable and not self.is_selected:
             self.set_highlighted(False)
 
+    def clear_selection(self):
+        self.is_selected = False
+        self.is_selectable = False
+        self.set_highlighted(False)
+        self.setFrameShadow(QFrame.Shadow.Plain)
+
     def mousePressEvent(self, event):
         # Select a card
         if self.is_selectable:
@@ -144,23 +294,47 @@ class Player(QWidget):
         self.num_selectable = 0
         self.num_selected = 0
 
+        # Card widgets in slot order, kept in sync with the cards layout
+        self.card_slots = []
+
     def get_card(self, ind):
-        return self.cards.itemAt(ind).widget()
+        return self.card_slots[ind]
 
     def add_card(self, card):
         if isinstance(card, str):
-            self.cards.addWidget(Card(name=card, parent=self))
-        elif isinstance(card, Card):
-            self.cards.addWidget(card)
-        else:
+            card = Card(name=card, parent=self)
+        elif not isinstance(card, Card):
             raise TypeError(f'add_card does not accept param type {type(card)}')
+        self.cards.addWidget(card)
+        self.card_slots.append(card)
 
     def remove_card(self, ind):
-        self.cards.removeWidget(self.cards.itemAt(ind).widget())
+        card = self.card_slots.pop(ind)
+        self.cards.removeWidget(card)
+        # Dispose of the widget rather than leaving a hidden child behind
+        card.setParent(None)
+        card.deleteLater()
 
     def set_card(self, ind, name):
-        card = Card(name=name, parent=self)
-        self.cards.replaceWidget(self.cards.itemAt(ind), card)
+        self.get_card(ind).set_card(name)
+
+    def set_cards(self, cards):
+        '''
+        cards: List of (name, is_eliminated, is_hidden) for each card in hand.
+        Existing Card widgets are reused and only patched where they changed.
+        '''
+        for ind, state in enumerate(cards):
+            if ind < len(self.card_slots):
+                card = self.card_slots[ind]
+                if card.state != state:
+                    card.set_state(*state)
+            else:
+                card = Card(parent=self)
+                card.set_state(*state)
+                self.add_card(card)
+
+        while len(self.card_slots) > len(cards):
+            self.remove_card(len(self.card_slots) - 1)
 
     def set_coins(self, num):
         self.coins.setText(str(num))
@@ -168,10 +342,15 @@ class Player(QWidget):
     def set_move(self, action):
         self.move.setText(action)
 
+    def clear_selection(self):
+        for card in self.card_slots:
+            card.clear_selection()
+        self.num_selected = 0
+
     def check_selected(self):
         if self.num_selected < self.num_selectable:
             # Set all non-eliminated cards to selectable
-            for card in self.findChildren(Card):
+            for card in self.card_slots:
                 if not card.is_eliminated:
                     card.is_selectable = True
 
@@ -180,7 +359,7 @@ class Player(QWidget):
 
         elif self.num_selected == self.num_selectable:
             # Prevent any more cards from being selected
-            for card in self.findChildren(Card):
+            for card in self.card_slots:
                 if not card.is_selected:
                     card.is_selectable = False
 
@@ -192,12 +371,7 @@ class Player(QWidget):
 
     def get_selected_cards_index(self):
         # Get the indexes of the selected cards
-        cards = self.findChildren(Card)
-        ind = []
-        for i in range(len(cards)):
-            if cards[i].is_selected:
-                ind.append(i)
-        return ind
+        return [i for i, card in enumerate(self.card_slots) if card.is_selected]
 
 
 class ActionSelector(QWidget):
@@ -209,6 +383,8 @@ class ActionSelector(QWidget):
 
         self.main_actions = QGridLayout()
         self.counter_actions = QGridLayout()
+        # Button label to button, in display order
+        self.buttons = {}
 
         # Main actions
         actions = ['Income', 'Foreign aid', 'Coup', 'Tax', 'Assassinate', 'Exchange', 'Steal']
@@ -217,7 +393,9 @@ class ActionSelector(QWidget):
             per_row = 4
             r = x // per_row
             c = x % per_row
-            self.main_actions.addWidget(ActionButton(actions[x], colors[x]), r, c)
+            btn = ActionButton(actions[x], colors[x])
+            self.buttons[actions[x]] = btn
+            self.main_actions.addWidget(btn, r, c)
 
         # Counter actions
         actions = ['Pass', 'Block', 'Challenge']
@@ -226,71 +404,93 @@ class ActionSelector(QWidget):
             per_row = 4
             r = x // per_row
             c = x % per_row
-            self.counter_actions.addWidget(ActionButton(actions[x], colors[x]), r, c)        
+            btn = ActionButton(actions[x], colors[x])
+            self.buttons[actions[x]] = btn
+            self.counter_actions.addWidget(btn, r, c)
 
         self.layout.addLayout(self.main_actions)
         self.layout.addLayout(self.counter_actions)
         self.setLayout(self.layout)
 
     def disable_all(self):
-        for btn in self.findChildren(ActionButton):
+        # Batch the style changes into a single repaint
+        self.setUpdatesEnabled(False)
+        for btn in self.buttons.values():
             btn.disable()
-    
-    def enable(self, action_names):
+        self.setUpdatesEnabled(True)
+
+    def enable(self, actions):
         '''
-        action_names: Actions in the form of gym-coup function names (lowercase underscored)
+        actions: Valid action ids, learned by decoder
         '''
-        button_names = [x.replace('_', ' ').capitalize().strip() for x in action_names]
-        for i in range(len(button_names)):
-            if button_names[i][:4] in ['Pass', 'Bloc', 'Chal']:
-                button_names[i] = button_names[i].split()[0]
-
-        for btn in self.findChildren(ActionButton):
-            try:
-                ind = button_names.index(btn.text())
-            except ValueError:
+        self.setUpdatesEnabled(False)
+        enabled = set()
+        for a in actions:
+            btn = self.buttons.get(decoder.labels[a])
+            if btn is None or btn in enabled:
                 continue
 
+            enabled.add(btn)
             btn.enable()
             # For Pass/Block/Challenge, store which type it is,
             # but don't display the longer name on the button
-            btn.coup_action_name = action_names[ind]
+            btn.coup_action_name = decoder.actions[a]
+        self.setUpdatesEnabled(True)
 
 
 class ActionButton(QPushButton):
     default = '#606060'
     grayedOut = '#909090'
 
+    grayedOutStyle = f'background-color: {grayedOut};'
+
     def __init__(self, name, color=None):
         super().__init__(name)
         self.setFixedSize(90, 90)
         self.color = color if color is not None else ActionButton.default
-        self.setStyleSheet(f'background-color: {self.color};')
+        self.enabled_style = f'background-color: {self.color};'
+        self.setStyleSheet(self.enabled_style)
 
     def disable(self):
+        # Restyling is costly, skip buttons already in this state
+        if not self.isEnabled():
+            return
         self.setEnabled(False)
-        self.setStyleSheet(f'background-color: {ActionButton.grayedOut};')
+        self.setStyleSheet(ActionButton.grayedOutStyle)
 
     def enable(self):
+        if self.isEnabled():
+            return
         self.setEnabled(True)
-        self.setStyleSheet(f'background-color: {self.color};')
+        self.setStyleSheet(self.enabled_style)
 
 
 class TopMenu(QWidget):
     def __init__(self):
         super().__init__()
         self.layout = QHBoxLayout()
-        self.setFixedSize(150, 40)
+        self.setFixedSize(225, 40)
 
         self.quit_btn = QPushButton('Quit', self)
         self.rules_btn = QPushButton('Rules', self)
-        self.rules = Rules()
-        self.rules_btn.clicked.connect(self.rules.show)
+        # Shown by the board when moves can be taken back
+        self.undo_btn = QPushButton('Undo', self)
+        self.undo_btn.setEnabled(False)
+        # Built on first click
+        self.rules = None
+        self.rules_btn.clicked.connect(self.show_rules)
 
         self.layout.addWidget(self.quit_btn)
         self.layout.addWidget(self.rules_btn)
+        self.layout.addWidget(self.undo_btn)
+        self.undo_btn.hide()
         self.setLayout(self.layout)
 
+    def show_rules(self):
+        if self.rules is None:
+            self.rules = Rules()
+        self.rules.show()
+
 
 class Rules(QMainWindow):
     def __init__(self):
@@ -370,10 +570,117 @@ class Rules(QMainWindow):
         self.setCentralWidget(self.text)
 
 
-class GameOver(QLabel):
+class GameOver(QWidget):
     def __init__(self, user_won):
+        super().__init__()
+        self.layout = QVBoxLayout()
+
+        self.lbl = QLabel('', self)
+        self.lbl.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.layout.addWidget(self.lbl)
+
+        # Play again against the same agent, without going through the menu
+        self.rematch_btn = QPushButton('Rematch', self)
+        self.layout.addWidget(self.rematch_btn, alignment=Qt.AlignmentFlag.AlignCenter)
+
+        self.setLayout(self.layout)
+        self.set_result(user_won)
+
+    def set_result(self, user_won):
         text = 'You Won!' if user_won else 'You Lost'
-        super().__init__(text)
-        self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.lbl.setText(text)
         color = 'green' if user_won else 'red'
-        self.setStyleSheet(f'color: {color}; font-size: 32px;')
\ No newline at end of file
+        self.lbl.setStyleSheet(f'color: {color}; font-size: 32px;')
+
+
+class ProfileOverlay(QDockWidget):
+    # Live p50/p95/p99 latencies, shown when profiling
+    def __init__(self, parent=None):
+        super().__init__('Profile', parent)
+        self.lbl = QLabel('', self)
+        self.lbl.setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
+        self.lbl.setAlignment(Qt.AlignmentFlag.AlignTop)
+        self.setWidget(self.lbl)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_stats)
+        self.timer.start(500)
+
+    def update_stats(self):
+        lines = [f'{"":10}{"n":>6}{"p50":>9}{"p95":>9}{"p99":>9} ms']
+        for name, (count, p50, p95, p99) in sorted(profiler.stats().items()):
+            lines.append(f'{name:10}{count:>6}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}')
+        self.lbl.setText('\n'.join(lines))
+
+
+class LineChart(QWidget):
+    # Minimal line chart of one series, drawn at most one point per pixel
+    def __init__(self, title, parent=None):
+        super().__init__(parent)
+        self.title = title
+        self.values = []
+        self.setMinimumSize(240, 120)
+
+    def set_values(self, values):
+        self.values = values
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        w, h = self.width(), self.height()
+        painter.drawText(4, 14, self.title)
+        vals = self.values
+        if len(vals) < 2:
+            return
+        step = max(1, len(vals) // w)
+        vals = vals[::step]
+        lo, hi = min(vals), max(vals)
+        painter.drawText(4, h - 4, f'{lo:.3g} .. {hi:.3g}, n={len(self.values)}')
+        span = (hi - lo) or 1
+        top, bottom = 20, h - 20
+        painter.setPen(QPen(QColor('blue'), 1))
+        painter.drawPolyline(QPolygonF([QPointF(i * (w - 1) / (len(vals) - 1),
+                                                bottom - (v - lo) / span * (bottom - top))
+                                        for i, v in enumerate(vals)]))
+
+
+class MetricsPanel(QDockWidget):
+    # Charts of an agent's training metrics, read while the panel is visible
+    def __init__(self, path, parent=None, window=100):
+        '''
+        path:   Metrics directory, see metrics.metrics_path
+        window: Games per point of the rolling win rate
+        '''
+        super().__init__('Training', parent)
+        from metrics import MetricsReader
+        self.reader = MetricsReader(path)
+        self.window = window
+
+        widget = QWidget(self)
+        layout = QVBoxLayout()
+        self.win_rate = LineChart(f'Agent win rate, last {window} games')
+        self.td_error = LineChart('Mean |TD error| per update')
+        self.epsilon = LineChart('Epsilon per update')
+        for chart in [self.win_rate, self.td_error, self.epsilon]:
+            layout.addWidget(chart)
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_charts)
+        self.timer.start(2000)
+        QTimer.singleShot(0, self.update_charts)
+
+    def update_charts(self):
+        if not self.isVisible():
+            return
+        import numpy as np
+        games = self.reader.read('games')
+        if 'won' in games and len(games['won']):
+            won = games['won'].astype(np.float64)
+            window = min(self.window, len(won))
+            self.win_rate.set_values((np.convolve(won, np.ones(window), 'valid') / window).tolist())
+        updates = self.reader.read('updates')
+        if 'td_abs' in updates:
+            self.td_error.set_values(updates['td_abs'].tolist())
+            self.epsilon.set_values(updates['epsilon'].tolist())
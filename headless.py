@@ -0,0 +1,298 @@
+from coup_rl import Human_v_Agent
+from agent_log import TrainingSession, compact_pending
+from metrics import MetricsWriter, StepHook, games_columns, metrics_path, steps_columns, updates_columns
+import numpy as np
+import logging
+import os
+import random
+import tempfile
+import time
+
+logger = logging.getLogger('app')
+
+
+class RandomOpponent:
+    # Picks uniformly among the valid actions
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def choose(self, valid):
+        return self.rng.choice(valid)
+
+
+class ScriptedOpponent:
+    # Picks the first valid action by a fixed priority of action name prefixes
+    priority = ['coup', 'assassinate', 'tax', 'steal', 'foreign_aid', 'income',
+                'pass', 'exchange_return', 'lose_card']
+
+    def __init__(self, seed=None):
+        # Deterministic, so the seed is unused
+        pass
+
+    def choose(self, valid):
+        for prefix in self.priority:
+            for action in valid:
+                if action.startswith(prefix):
+                    return action
+        return valid[0]
+
+
+opponents = {
+    'random': RandomOpponent,
+    'scripted': ScriptedOpponent,
+}
+
+
+def play_game(game, opponent):
+    '''
+    Play a game to the end with the opponent in the human's seat.
+    Returns (True if the agent won, number of turns)
+    '''
+    env = game.env
+    turns = 0
+    while not env.game.game_over:
+        if env.game.whose_action == 0:
+            game.step(opponent.choose(env.get_valid_actions(text=True)))
+        else:
+            game.agent.step()
+        turns += 1
+
+    obs = env.get_obs(text=True)
+    # Agent won if all of the human seat's cards are eliminated
+    return 0 not in obs[8:12], turns
+
+
+def play_games(num_games,
+               filepath,
+               is_training,
+               learning_rate=None,
+               discount_factor=None,
+               epsilon=None,
+               p_first_turn=0,
+               opponent='scripted',
+               seed=None,
+               report_every=0,
+               durable=True,
+               metrics=True,
+               checkpoint_every=0,
+               keep_checkpoints=5,
+               flush_every=1):
+    '''
+    Play num_games games between the agent and an opponent without any UI.
+    Takes the same parameters as Board.game_setup.
+
+    opponent:     Name of an opponent in headless.opponents
+    report_every: Print progress after this many games. 0 to disable.
+    durable:      When training, log each game's updates next to the agent file
+                  instead of letting Human_v_Agent rewrite it every game.
+    metrics:      Record each game and the agent's steps to the agent's metrics, see
+                  metrics.py, or to this metrics directory. Updates are recorded
+                  when training durably.
+    checkpoint_every, keep_checkpoints: Checkpoint rotation when training durably,
+                  see TrainingSession
+    flush_every:  Log training updates every this many games when training durably,
+                  like the menu's setting for rematches. The rest are logged at the end.
+
+    Returns (agent wins, elapsed seconds)
+    '''
+    opp = opponents[opponent](seed)
+    wins = 0
+    start = time.perf_counter()
+
+    session = TrainingSession(filepath) if is_training and durable else None
+    path = session.work_path if session else filepath
+    if session:
+        session.checkpoint_every = checkpoint_every
+        session.keep_checkpoints = keep_checkpoints
+    else:
+        # Human_v_Agent reads the agent file itself
+        compact_pending(filepath)
+    if metrics:
+        writer = MetricsWriter(metrics if isinstance(metrics, str) else metrics_path(filepath))
+        games = writer.table('games', games_columns)
+    else:
+        writer = games = None
+
+    # Built once and reset between games, like a rematch on the board
+    game = Human_v_Agent(p_first_turn,
+                         path,
+                         is_training,
+                         learning_rate,
+                         discount_factor,
+                         epsilon,
+                         log_level=logger.level)
+    if session:
+        session.watch(game.env)
+    if writer:
+        hook = StepHook(game.env, writer.table('steps', steps_columns))
+        if session:
+            session.updates = writer.table('updates', updates_columns)
+    for n in range(1, num_games + 1):
+        if n > 1:
+            game.env.reset()
+        if game.env.game.whose_action == 1:
+            # Agent has the first turn
+            game.agent.step()
+
+        won, turns = play_game(game, opp)
+        wins += won
+        if games:
+            games.append(time=time.time(), won=won, turns=turns, training=is_training,
+                         epsilon=np.nan if epsilon is None else epsilon)
+            hook.games = n
+        if session and n % flush_every == 0:
+            session.record_game(flush_every)
+
+        if report_every and n % report_every == 0:
+            elapsed = time.perf_counter() - start
+            print(f'{n} games, {n / elapsed:.1f} games/s, win rate {wins / n:.3f}')
+
+    if session:
+        if num_games % flush_every:
+            session.record_game(num_games % flush_every)
+        session.close()
+    if writer:
+        writer.close()
+    return wins, time.perf_counter() - start
+
+
+def report(num_games, wins, elapsed, opponent):
+    games_per_sec = num_games / elapsed if elapsed else 0.0
+    print(f'Played {num_games} games against {opponent} opponent')
+    print(f'{games_per_sec:.1f} games/s, agent win rate {wins / max(num_games, 1):.3f}')
+    return games_per_sec
+
+
+def run(num_games, filepath, is_training, *args, opponent='scripted', report_every=1000, num_envs=None, **kwargs):
+    '''
+    Play and report on num_games games. See play_games for the parameters.
+    num_envs: Play batched with this many envs at once, see play_batch
+    Returns (agent wins, games per second)
+    '''
+    if num_envs:
+        wins, elapsed = play_batch(num_games, filepath, is_training, *args,
+                                   opponent=opponent, num_envs=num_envs, **kwargs)
+    else:
+        wins, elapsed = play_games(num_games, filepath, is_training, *args,
+                                   opponent=opponent, report_every=report_every, **kwargs)
+    return wins, report(num_games, wins, elapsed, opponent)
+
+
+def new_envs(num_envs, p_first_turn=0):
+    '''
+    gym-coup envs for batched play. Human_v_Agent builds them, but its own
+    agent is never stepped, so it's given a fresh table that is never saved.
+    '''
+    path = os.path.join(tempfile.gettempdir(), 'coup_batch_unused.npz')
+    return [Human_v_Agent(p_first_turn, path, False, 0.5, 0.5, 0.5, log_level=logger.level).env
+            for _ in range(num_envs)]
+
+
+def play_batch(num_games,
+               filepath,
+               is_training,
+               learning_rate=None,
+               discount_factor=None,
+               epsilon=None,
+               p_first_turn=0,
+               opponent='scripted',
+               seed=None,
+               num_envs=64,
+               envs=None,
+               metrics=True):
+    '''
+    Play num_games games with num_envs in flight at once. The agent is a
+    policy.BatchPolicy saved at filepath, which picks actions for every env
+    waiting on it with one vectorised lookup and learns from batched updates.
+    Takes the same parameters as play_games, plus:
+    num_envs: Games played at once
+    envs:     Envs to play on instead of new_envs
+    metrics:  Record games and updates to the agent's metrics, see metrics.py
+
+    Expects gym-coup's numeric get_obs()/get_valid_actions() to line up with
+    the text versions, and rewards the agent +1 for a win and -1 for a loss.
+
+    Returns (agent wins, elapsed seconds)
+    '''
+    from policy import BatchPolicy, valid_mask
+
+    if envs is None:
+        envs = new_envs(num_envs, p_first_turn)
+    num_envs = len(envs)
+    if os.path.exists(filepath):
+        policy = BatchPolicy.load(filepath, seed)
+    else:
+        # Only the hyperparameters that were given, BatchPolicy has defaults for the rest
+        params = {k: v for k, v in [('learning_rate', learning_rate), ('discount_factor', discount_factor),
+                                    ('epsilon', epsilon)] if v is not None}
+        policy = BatchPolicy(envs[0].action_space.n, seed=seed, **params)
+    opp = opponents[opponent](seed)
+    writer = MetricsWriter(metrics_path(filepath)) if metrics else None
+    if writer:
+        games = writer.table('games', games_columns)
+        updates = writer.table('updates', updates_columns)
+
+    # Agent's last (obs, action) in each env, waiting for its outcome
+    pending = [None] * num_envs
+    turns = [0] * num_envs
+    active = [True] * num_envs
+    started = min(num_envs, num_games)
+    active[started:] = [False] * (num_envs - started)
+    wins = finished = 0
+    start = time.perf_counter()
+
+    while finished < num_games:
+        for i, env in enumerate(envs):
+            # The opponent's moves
+            while active[i] and not env.game.game_over and env.game.whose_action == 0:
+                names = env.get_valid_actions(text=True)
+                env.step(env.get_valid_actions()[names.index(opp.choose(names))])
+
+        # transitions: obs, action, reward, next obs, next mask, done
+        transitions = []
+        turn = [i for i, env in enumerate(envs) if active[i] and not env.game.game_over]
+        if turn:
+            obs = np.array([envs[i].get_obs() for i in turn])
+            mask = valid_mask([envs[i].get_valid_actions() for i in turn], policy.num_actions)
+            actions = policy.act(obs, mask, greedy=not is_training)
+            for j, i in enumerate(turn):
+                if pending[i] is not None:
+                    transitions.append(pending[i] + (0.0, obs[j], mask[j], False))
+                pending[i] = (obs[j], actions[j])
+                turns[i] += 1
+                envs[i].step(int(actions[j]))
+
+        for i, env in enumerate(envs):
+            if not active[i] or not env.game.game_over:
+                continue
+            # Agent won if all of the human seat's cards are eliminated
+            agent_won = 0 not in env.get_obs(text=True)[8:12]
+            wins += agent_won
+            finished += 1
+            if writer:
+                games.append(time=time.time(), won=agent_won, turns=turns[i], training=is_training,
+                             epsilon=policy.epsilon)
+            turns[i] = 0
+            if pending[i] is not None:
+                obs_i, a = pending[i]
+                transitions.append((obs_i, a, 1.0 if agent_won else -1.0,
+                                    obs_i, np.zeros(policy.num_actions, dtype=bool), True))
+                pending[i] = None
+
+            if started < num_games:
+                env.reset()
+                started += 1
+            else:
+                active[i] = False
+
+        if is_training and transitions:
+            td = policy.update(*(np.array(col) for col in zip(*transitions)))
+            if writer:
+                updates.append(time=time.time(), games=finished, transitions=len(td),
+                               td_abs=np.abs(td).mean(), epsilon=policy.epsilon)
+
+    if is_training:
+        policy.save(filepath)
+    if writer:
+        writer.close()
+    return wins, time.perf_counter() - start
@@ -1,46 +1,181 @@
+import time
+# Process start, for --startup-time
+_start = time.perf_counter()
+
 from menu import *
 from board import *
+from prefetch import AgentCache
+import os
 import sys
 import argparse
 
 class Coup(QMainWindow):
-    def __init__(self):
+    def __init__(self, replays_path=None, server=None, book_path=None):
+        '''
+        replays_path: File finished games are recorded to, None to not record
+        server:       'host:port' of a server.py to play on, instead of a local agent
+        book_path:    Opening book for the tree search opponent, see book.py
+        '''
         super().__init__()
         self.setWindowTitle('Coup')
+        self.board_widget = None
+        self.server = server
+        self.book_path = book_path
+        self.metrics_panel = None
+        # Game made here rather than by the agent cache, closed on quit,
+        # e.g. a client.RemoteGame or mcts.MCTSGame
+        self.own_game = None
+        self.replays_path = replays_path
+        # replay.ReplayFile, opened on first use
+        self.replays = None
+        # Agents loaded ahead of pressing Start
+        self.agent_cache = AgentCache()
         self.quit_game()
         self.setFocus()
 
+        if profiler.enabled:
+            self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, ProfileOverlay(self))
+
     def start_game(self):
         # Init from menu form
         form_data = self.menu_widget.get_form_data()
 
         self.board_widget = Board()
-        self.board_widget.game_setup(int(form_data[0]),
-                                     form_data[1],
-                                     form_data[2],
-                                     form_data[3],
-                                     form_data[4],
-                                     form_data[5])
+        self.board_widget.replays = self.open_replays()
+        if self.server is not None:
+            from client import RemoteGame
+            try:
+                self.own_game = RemoteGame(self.server, int(form_data[0]))
+            except OSError as e:
+                QMessageBox.warning(self, 'Server Unavailable', f'Could not connect to {self.server}: {e}')
+                self.board_widget = None
+                return
+            self.board_widget.attach_game(self.own_game)
+        elif self.menu_widget.get_think_time() is not None:
+            from mcts import MCTSGame
+            from book import OpeningBook
+            self.own_game = MCTSGame(int(form_data[0]), self.menu_widget.get_think_time(),
+                                     book=OpeningBook.load(self.book_path) if self.book_path else None)
+            self.board_widget.can_undo = True
+            self.board_widget.attach_game(self.own_game)
+        else:
+            checkpoint = self.menu_widget.get_checkpoint()
+            if checkpoint is not None and form_data[2]:
+                # Training continues from the checkpoint, so it becomes the agent file
+                from agent_log import restore_checkpoint
+                self.agent_cache.discard(wait=True)
+                restore_checkpoint(checkpoint, form_data[1])
+            game, training = self.agent_cache.take(form_data)
+            if training is not None:
+                training.checkpoint_every = self.menu_widget.checkpoint_every.value()
+                training.keep_checkpoints = self.menu_widget.keep_checkpoints.value()
+            self.board_widget.can_undo = True
+            self.board_widget.attach_game(game, training)
+        self.board_widget.flush_every = self.menu_widget.flush_every.value()
         self.board_widget.top_menu.quit_btn.clicked.connect(self.quit_game)
 
+        self.show_metrics(form_data)
+
         if form_data[0]:
             # Agent has the first turn
-            self.board_widget._game.agent.step()
-            self.board_widget.actions.disable_all()
-            self.board_widget.refresh()
+            self.board_widget.agent_step()
 
         self.setCentralWidget(self.board_widget)
 
+    def show_metrics(self, form_data):
+        # Charts of the agent's training, if it's being trained or has been
+        if self.server is not None or self.menu_widget.get_think_time() is not None:
+            return
+        from metrics import metrics_path
+        path = metrics_path(form_data[1])
+        if form_data[2] or os.path.isdir(path):
+            self.metrics_panel = MetricsPanel(path, self)
+            self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, self.metrics_panel)
+
     def quit_game(self):
+        if self.metrics_panel is not None:
+            self.removeDockWidget(self.metrics_panel)
+            self.metrics_panel.deleteLater()
+            self.metrics_panel = None
+        if self.board_widget is not None:
+            self.board_widget.end_session()
+            self.board_widget = None
+        if self.own_game is not None:
+            self.own_game.close()
+            self.own_game = None
+
         self.menu_widget = Menu()
         self.menu_widget.start_btn.clicked.connect(self.start_game)
+        self.menu_widget.form_changed.connect(self.prefetch_agent)
+        self.menu_widget.replays_btn.setEnabled(self.replays_path is not None)
+        self.menu_widget.replays_btn.clicked.connect(self.show_replays)
+        if self.server is not None:
+            self.menu_widget.set_remote(self.server)
+        else:
+            self.agent_cache.prefetch_last()
         self.setCentralWidget(self.menu_widget)
 
+    def open_replays(self):
+        if self.replays is None and self.replays_path is not None:
+            from replay import ReplayFile
+            self.replays = ReplayFile(self.replays_path)
+        return self.replays
+
+    def show_replays(self):
+        from viewer import ReplayViewer
+        viewer = ReplayViewer(self.open_replays())
+        viewer.board.top_menu.quit_btn.clicked.connect(self.quit_game)
+        self.setCentralWidget(viewer)
+
+    def prefetch_agent(self):
+        if self.server is not None or self.menu_widget.get_think_time() is not None:
+            return
+        self.agent_cache.prefetch(self.menu_widget.get_form_data())
+
+    def closeEvent(self, event):
+        if self.board_widget is not None:
+            self.board_widget.end_session()
+        if self.own_game is not None:
+            self.own_game.close()
+        self.agent_cache.discard()
+        super().closeEvent(event)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Coup RL Desktop App')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-i', '--info', action='store_true', help='Log at the info level')
     group.add_argument('-d', '--debug', action='store_true', help='Log at the debug level')
+
+    parser.add_argument('--profile', nargs='?', const='profile.json', metavar='FILE',
+                        help='Show step latencies and write a .json or .csv trace on quit (default profile.json)')
+    parser.add_argument('--startup-time', action='store_true', help='Print the time to first paint and exit')
+    parser.add_argument('--replays', default='replays.coup', metavar='FILE',
+                        help='File finished games are recorded to and replayed from (default replays.coup)')
+    parser.add_argument('--no-replays', action='store_true', help='Don\'t record games')
+    parser.add_argument('--book', default='mcts.book', metavar='FILE',
+                        help='Opening book for the tree search opponent, if it exists (default mcts.book)')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='Play against the agent of a running server.py')
+    parser.add_argument('--uncompress', metavar='FILE', help='Rewrite an agent file uncompressed, so it can be memory-mapped')
+
+    headless = parser.add_argument_group('headless', 'Play games without the UI')
+    headless.add_argument('--headless', type=int, metavar='N', help='Play N games against a scripted or random opponent')
+    headless.add_argument('--agent', metavar='FILE', help='Agent file ending in .npz')
+    headless.add_argument('--train', action='store_true', help='Train the agent')
+    headless.add_argument('--lr', type=float, help='Learning rate, for a new agent. Defaults to 0.5 like the menu')
+    headless.add_argument('--df', type=float, help='Discount factor, for a new agent. Defaults to 0.5 like the menu')
+    headless.add_argument('--eps', type=float, help='Epsilon, for a new agent. Defaults to 0.5 like the menu')
+    headless.add_argument('--agent-first', action='store_true', help='Agent has the first turn')
+    headless.add_argument('--opponent', choices=['scripted', 'random'], default='scripted')
+    headless.add_argument('--seed', type=int, help='Seed for the random opponent')
+    headless.add_argument('--batch', type=int, metavar='K',
+                          help='Play K games at once with a batched agent, saved in the same format at --agent')
+    headless.add_argument('--workers', type=int, default=1, help='Play in this many processes, 0 for one per CPU')
+    headless.add_argument('--checkpoint-every', type=int, default=0, metavar='N',
+                          help='When training, snapshot the agent every N games')
+    headless.add_argument('--keep-checkpoints', type=int, default=5, metavar='K', help='Newest checkpoints kept')
+    headless.add_argument('--flush-every', type=int, default=1, metavar='N',
+                          help='When training, log updates every N games, like the menu\'s setting')
+    headless.add_argument('--sync-every', type=int, default=100, help='Games per worker between agent file merges')
     args = parser.parse_args()
 
     if args.debug:
@@ -48,7 +183,72 @@ if __name__ == '__main__':
     elif args.info:
         logger.setLevel(logging.INFO)
 
+    if args.uncompress is not None:
+        import agent_file
+        agent_file.convert(args.uncompress, compressed=False)
+        sys.exit(0)
+
+    if args.headless is not None:
+        if args.agent is None:
+            parser.error('--headless requires --agent')
+        if args.batch and args.workers != 1:
+            parser.error('--batch plays in a single process, drop --workers')
+        if args.checkpoint_every and (args.batch or args.workers != 1):
+            parser.error('--checkpoint-every only applies without --batch and --workers')
+        if args.flush_every != 1 and (args.batch or args.workers != 1):
+            parser.error('--flush-every only applies without --batch and --workers')
+        if args.flush_every < 1:
+            parser.error('--flush-every must be at least 1')
+        if os.path.exists(args.agent):
+            import agent_file
+            try:
+                # Only the array headers are read, so a wrong file fails before any game is played
+                agent_file.check_agent(args.agent)
+            except ValueError as e:
+                parser.error(str(e))
+        else:
+            # A new agent needs every hyperparameter, an existing one keeps its own
+            args.lr, args.df, args.eps = [0.5 if v is None else v for v in (args.lr, args.df, args.eps)]
+        if args.workers == 1:
+            import headless as hl
+            kwargs = {'num_envs': args.batch}
+            if args.checkpoint_every:
+                kwargs.update(checkpoint_every=args.checkpoint_every, keep_checkpoints=args.keep_checkpoints)
+            if args.flush_every != 1:
+                kwargs['flush_every'] = args.flush_every
+        else:
+            import parallel as hl
+            kwargs = {'workers': args.workers or None, 'sync_every': args.sync_every}
+        hl.run(args.headless,
+               args.agent,
+               args.train,
+               args.lr,
+               args.df,
+               args.eps,
+               p_first_turn=int(args.agent_first),
+               opponent=args.opponent,
+               seed=args.seed,
+               **kwargs)
+        sys.exit(0)
+
+    profiler.enabled = args.profile is not None
+
     app = QApplication(sys.argv)
-    main_app = Coup()
+    main_app = Coup(None if args.no_replays else args.replays, args.connect, args.book)
     main_app.show()
-    sys.exit(app.exec())
+
+    if args.startup_time:
+        # Runs once the first paint has been processed
+        def first_paint():
+            print(f'First paint after {(time.perf_counter() - _start) * 1000:.1f} ms')
+            app.quit()
+        QTimer.singleShot(0, first_paint)
+    else:
+        # Start importing the RL stack once the menu is up
+        QTimer.singleShot(0, preload)
+    ret = app.exec()
+
+    if profiler.enabled:
+        profiler.dump(args.profile)
+        logger.warning(f'Wrote profile trace to {args.profile}')
+    sys.exit(ret)
@@ -0,0 +1,245 @@
+'''
+Monte Carlo tree search opponent, an alternative to the tabular agent.
+
+The search only uses what the agent can see. Nodes are keyed by the agent's
+information set: the observation with the human's unrevealed cards hidden,
+and whose turn it is. So the tree is a table that carries over between
+moves and games. Every iteration plays a determinization, a branch of the
+real env where the deck and the human's unrevealed cards are reshuffled
+together and the branch's random generators are reseeded. Deck draws, the
+human's hand and the human's replies are therefore sampled anew each time.
+
+Search is root parallel: each process of the pool searches with its own
+tree for the move's time budget, and the visit counts of the root actions
+are summed to pick the move.
+'''
+
+from snapshot import Snapshot
+import numpy as np
+import logging
+import math
+import multiprocessing
+import os
+import random
+import time
+
+logger = logging.getLogger('app')
+
+# Each pool process's tree, kept between moves
+_tree = None
+
+
+def state_key(env):
+    # The agent's information set, with the human's cards hidden until they're eliminated
+    obs = [int(x) for x in env.get_obs()]
+    for i in range(4):
+        if not obs[8 + i]:
+            obs[i] = -1
+    return tuple(obs) + (int(env.game.whose_action),)
+
+
+def _cards(holder):
+    # Card list of a deck or hand, which may itself be a plain list
+    return holder if isinstance(holder, list) else getattr(holder, 'cards', None)
+
+
+def _reseed(obj, rng):
+    for k, v in list(vars(obj).items()):
+        if isinstance(v, random.Random):
+            v.seed(rng.getrandbits(64))
+        elif isinstance(v, np.random.RandomState):
+            v.seed(rng.getrandbits(32))
+        elif isinstance(v, np.random.Generator):
+            setattr(obj, k, np.random.default_rng(rng.getrandbits(64)))
+
+
+def determinize(env, rng):
+    '''
+    Resample what the agent can't see, in place on a branch of the real env.
+    The env's and its game's random generators are reseeded, then the deck
+    and the human's unrevealed cards are shuffled and dealt back. Expects
+    gym-coup's layout: env.game.deck, and env.game.players[0] holding the
+    human's cards in observation slot order, each a list or with a cards list.
+    Returns False if the env has no such layout and only the generators changed.
+    '''
+    game = env.game
+    for obj in (env, game):
+        _reseed(obj, rng)
+    deck = _cards(getattr(game, 'deck', None))
+    players = getattr(game, 'players', None)
+    hand = _cards(players[0]) if players else None
+    if deck is None or hand is None:
+        return False
+    eliminated = env.get_obs(text=True)[8:12]
+    hidden = [i for i in range(min(len(hand), 4))
+              if not eliminated[i] and getattr(hand[i], 'name', hand[i]) != 'none']
+    pool = [hand[i] for i in hidden] + deck
+    rng.shuffle(pool)
+    for n, i in enumerate(hidden):
+        hand[i] = pool[n]
+    deck[:] = pool[len(hidden):]
+    return True
+
+
+class Tree:
+    def __init__(self, c=1.4, max_nodes=200000, max_depth=200, seed=None):
+        '''
+        c:         UCT exploration constant
+        max_nodes: Nodes kept before the tree is cleared
+        max_depth: Steps after which a playout counts as a draw
+        '''
+        self.c = c
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.rng = random.Random(seed)
+        # State key to visits, and to {action: [visits, agent wins]}
+        self.visits = {}
+        self.children = {}
+        # Warned once if branches can't have their hidden cards resampled
+        self._warned = False
+
+    def select(self, key, valid, player):
+        # UCT, from the point of view of the player to act
+        children = self.children[key]
+        untried = [a for a in valid if a not in children]
+        if untried:
+            return self.rng.choice(untried)
+        log_n = math.log(self.visits[key])
+        def score(a):
+            n, w = children[a]
+            value = w / n if player == 1 else 1 - w / n
+            return value + self.c * math.sqrt(log_n / n)
+        return max(valid, key=score)
+
+    def iterate(self, root):
+        # One selection, expansion, playout and backup on a determinization of the root snapshot
+        sim = root.branch()
+        if not determinize(sim, self.rng) and not self._warned:
+            logger.warning('Env has no deck to reshuffle, tree search sees the human\'s cards')
+            self._warned = True
+        path = []
+        expanded = False
+        depth = 0
+        while not sim.game.game_over and depth < self.max_depth:
+            valid = sim.get_valid_actions()
+            if expanded:
+                action = self.rng.choice(valid)
+            else:
+                key = state_key(sim)
+                if key not in self.children:
+                    self.children[key] = {}
+                    self.visits[key] = 0
+                    expanded = True
+                action = self.select(key, valid, sim.game.whose_action)
+                path.append((key, action, sim.game.whose_action))
+            sim.step(action)
+            depth += 1
+
+        if sim.game.game_over:
+            # Agent won if all of the human seat's cards are eliminated
+            result = float(0 not in sim.get_obs(text=True)[8:12])
+        else:
+            result = 0.5
+        for key, action, _ in path:
+            self.visits[key] += 1
+            stats = self.children[key].setdefault(action, [0, 0.0])
+            stats[0] += 1
+            stats[1] += result
+
+    def search(self, root, time_budget=None, iterations=None):
+        '''
+        root: snapshot.Snapshot of the env to search from
+        Returns {action: visits} of the root after searching until the
+        time budget in seconds or the number of iterations runs out.
+        '''
+        if len(self.children) > self.max_nodes:
+            self.visits.clear()
+            self.children.clear()
+        deadline = time.perf_counter() + time_budget if time_budget else math.inf
+        n = 0
+        while time.perf_counter() < deadline and (iterations is None or n < iterations):
+            self.iterate(root)
+            n += 1
+        return {a: s[0] for a, s in self.children.get(state_key(root.branch()), {}).items()}
+
+
+def _search(task):
+    root, time_budget, iterations, seed = task
+    global _tree
+    if _tree is None:
+        _tree = Tree(seed=seed)
+    return _tree.search(root, time_budget, iterations)
+
+
+class MCTSAgent:
+    def __init__(self, env, time_budget=1.0, iterations=None, workers=None, seed=None):
+        '''
+        env:         gym-coup env, the agent playing player 1
+        time_budget: Seconds of search per move, or None for no time limit
+        iterations:  Iterations per move and process, or None for no limit
+        workers:     Processes to search in. Defaults to the CPU count.
+                     With 1, search runs in the calling thread.
+        '''
+        if time_budget is None and iterations is None:
+            raise ValueError('MCTSAgent needs a time budget or a number of iterations')
+        self.env = env
+        self.time_budget = time_budget
+        self.iterations = iterations
+        self.workers = workers or os.cpu_count()
+        self.rng = random.Random(seed)
+        self.tree = Tree(seed=seed) if self.workers == 1 else None
+        self._pool = None
+        if self.workers > 1:
+            # Made up front, on the calling thread rather than mid game on a step thread.
+            # Spawned, as forking a process that runs Qt's threads can deadlock the children.
+            self._pool = multiprocessing.get_context('spawn').Pool(self.workers)
+
+    def choose(self):
+        valid = self.env.get_valid_actions()
+        if len(valid) == 1:
+            return valid[0]
+        root = Snapshot(self.env)
+        if self.tree is not None:
+            visits = self.tree.search(root, self.time_budget, self.iterations)
+        else:
+            visits = {}
+            tasks = [(root, self.time_budget, self.iterations, self.rng.random())
+                     for _ in range(self.workers)]
+            for counts in self._pool.map(_search, tasks, chunksize=1):
+                for a, n in counts.items():
+                    visits[a] = visits.get(a, 0) + n
+        return max(valid, key=lambda a: visits.get(a, 0))
+
+    def step(self):
+        # Act until it's the human's turn again, like Human_v_Agent's agent
+        game = self.env.game
+        while not game.game_over and game.whose_action == 1:
+            self.env.step(self.choose())
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class MCTSGame:
+    '''
+    Same interface as Human_v_Agent, with an MCTSAgent as the opponent.
+    Takes the same parameters as MCTSAgent, besides the env, plus:
+    book: book.OpeningBook played before searching, if any
+    '''
+    def __init__(self, p_first_turn=0, time_budget=1.0, iterations=None, workers=None, seed=None, book=None):
+        from headless import new_envs
+        self.env = new_envs(1, p_first_turn)[0]
+        self.agent = MCTSAgent(self.env, time_budget, iterations, workers, seed)
+        if book is not None:
+            self.agent.step = book.wrap(self.env, self.agent.step)
+
+    def step(self, action):
+        # Human's action by name, then the agent's reply
+        names = self.env.get_valid_actions(text=True)
+        self.env.step(self.env.get_valid_actions()[names.index(action)])
+        self.agent.step()
+
+    def close(self):
+        self.agent.close()
@@ -1,10 +1,20 @@
 from components import *
+import os
 
 class Menu(QWidget):
+    # Emitted when the selections settle on a complete form
+    form_changed = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.layout = QFormLayout()
 
+        # Coalesce bursts of changes, e.g. typing in a spin box
+        self.form_changed_timer = QTimer(self)
+        self.form_changed_timer.setSingleShot(True)
+        self.form_changed_timer.setInterval(300)
+        self.form_changed_timer.timeout.connect(self.emit_form_changed)
+
         self.lbl = QLabel('New Game', self)
         self.layout.addRow(self.lbl)
         self.layout.setAlignment(self.lbl, Qt.AlignmentFlag.AlignCenter)
@@ -14,6 +24,11 @@ class Menu(QWidget):
         self.layout.addRow(self.create_new_checkbox)
         self.layout.setAlignment(self.create_new_checkbox, Qt.AlignmentFlag.AlignCenter)
 
+        self.tree_search_checkbox = QCheckBox('Tree Search Opponent')
+        self.tree_search_checkbox.stateChanged.connect(self.tree_search_changed)
+        self.layout.addRow(self.tree_search_checkbox)
+        self.layout.setAlignment(self.tree_search_checkbox, Qt.AlignmentFlag.AlignCenter)
+
         # Pages for whether creating new or not
         self.agent_info_stack = QStackedWidget()
 
@@ -67,6 +82,19 @@ class Menu(QWidget):
         stack_page_2.setLayout(sub)
         self.agent_info_stack.addWidget(stack_page_2)
 
+        # Search settings for the tree search opponent
+        stack_page_3 = QWidget()
+        sub = QHBoxLayout()
+        sub.addWidget(QLabel('Seconds per move:'))
+        self.think_time = QDoubleSpinBox()
+        self.think_time.setDecimals(1)
+        self.think_time.setRange(0.1, 30)
+        self.think_time.setSingleStep(0.5)
+        self.think_time.setValue(1)
+        sub.addWidget(self.think_time)
+        stack_page_3.setLayout(sub)
+        self.agent_info_stack.addWidget(stack_page_3)
+
         self.layout.addRow(self.agent_info_stack)
 
         # Display selected file name
@@ -79,6 +107,37 @@ class Menu(QWidget):
         self.train_checkbox = QCheckBox('Train the agent')
         self.layout.addRow(self.train_checkbox)
         self.layout.setAlignment(self.train_checkbox, Qt.AlignmentFlag.AlignCenter)
+
+        # How often rematches save training, see Board.flush_every
+        sub = QHBoxLayout()
+        sub.addWidget(QLabel('Save training every'))
+        self.flush_every = QSpinBox()
+        self.flush_every.setRange(1, 1000)
+        self.flush_every.setValue(1)
+        sub.addWidget(self.flush_every)
+        sub.addWidget(QLabel('games'))
+        self.layout.addRow(sub)
+
+        # Checkpoint rotation while training, see TrainingSession
+        sub = QHBoxLayout()
+        sub.addWidget(QLabel('Checkpoint every'))
+        self.checkpoint_every = QSpinBox()
+        self.checkpoint_every.setRange(0, 100000)
+        self.checkpoint_every.setValue(0)
+        self.checkpoint_every.setSpecialValueText('never')
+        sub.addWidget(self.checkpoint_every)
+        sub.addWidget(QLabel('games, keep'))
+        self.keep_checkpoints = QSpinBox()
+        self.keep_checkpoints.setRange(1, 1000)
+        self.keep_checkpoints.setValue(5)
+        sub.addWidget(self.keep_checkpoints)
+        self.layout.addRow(sub)
+
+        # Retained checkpoints of the selected agent, listed once one is selected
+        self.checkpoint_box = QComboBox()
+        self.checkpoint_box.currentIndexChanged.connect(self.form_changed_timer.start)
+        self.layout.addRow(self.checkpoint_box)
+        self.checkpoint_box.hide()
         
         self.first_turn_checkbox = QCheckBox('Opponent goes first')
         self.layout.addRow(self.first_turn_checkbox)
@@ -89,25 +148,88 @@ class Menu(QWidget):
         self.layout.addRow(self.start_btn)
         self.layout.setAlignment(self.start_btn, Qt.AlignmentFlag.AlignCenter)
 
+        self.replays_btn = QPushButton('Replays', self)
+        self.layout.addRow(self.replays_btn)
+        self.layout.setAlignment(self.replays_btn, Qt.AlignmentFlag.AlignCenter)
+
         self.setLayout(self.layout)
 
+        for spin_box in [self.lr, self.df, self.eps]:
+            spin_box.valueChanged.connect(self.form_changed_timer.start)
+        for checkbox in [self.train_checkbox, self.first_turn_checkbox]:
+            checkbox.stateChanged.connect(self.form_changed_timer.start)
+
+    def emit_form_changed(self):
+        if self.start_btn.isEnabled():
+            self.form_changed.emit()
+
+    def get_checkpoint(self):
+        # Path of the checkpoint selected to play instead of the agent file, if any
+        return self.checkpoint_box.currentData() if self.checkpoint_box.isVisibleTo(self) else None
+
     def get_form_data(self):
         c = self.create_new_checkbox.isChecked()
+        checkpoint = self.get_checkpoint()
         return (
             self.first_turn_checkbox.isChecked(),
-            self.file_name.text(),
+            # A checkpoint is played directly, or restored to the agent file to train it
+            checkpoint if checkpoint is not None and not self.train_checkbox.isChecked() else self.file_name.text(),
             self.train_checkbox.isChecked(),
             self.lr.value() if c else None,
             self.df.value() if c else None,
             self.eps.value() if c else None
         )
 
+    def set_remote(self, address):
+        # The server's agent is played, so there's no agent to pick or train
+        self.create_new_checkbox.hide()
+        self.agent_info_stack.hide()
+        self.train_checkbox.hide()
+        self.file_name.setText(f'Server {address}')
+        self.start_btn.setEnabled(True)
+
+    def get_think_time(self):
+        # Seconds per move of the tree search opponent, None when playing an agent file
+        return self.think_time.value() if self.tree_search_checkbox.isChecked() else None
+
+    def list_checkpoints(self, path):
+        self.checkpoint_box.clear()
+        checkpoints = []
+        if path is not None:
+            from agent_log import list_checkpoints
+            checkpoints = list_checkpoints(path)
+        if not checkpoints:
+            self.checkpoint_box.hide()
+            return
+        self.checkpoint_box.addItem('Latest', None)
+        for c in checkpoints:
+            self.checkpoint_box.addItem(f'Checkpoint {os.path.basename(c)[:-4]}', c)
+        self.checkpoint_box.show()
+
     def create_new_changed(self):
         ind = int(self.create_new_checkbox.isChecked())
+        self.list_checkpoints(None)
+        if ind:
+            self.tree_search_checkbox.setChecked(False)
         self.file_name.setText('')
         self.start_btn.setEnabled(False)
         self.agent_info_stack.setCurrentIndex(ind)
 
+    def tree_search_changed(self):
+        checked = self.tree_search_checkbox.isChecked()
+        if checked:
+            self.create_new_checkbox.setChecked(False)
+            self.agent_info_stack.setCurrentIndex(2)
+        else:
+            self.agent_info_stack.setCurrentIndex(int(self.create_new_checkbox.isChecked()))
+        # No agent file is used, so there's nothing to pick or train
+        self.file_name.setVisible(not checked)
+        self.train_checkbox.setVisible(not checked)
+        self.train_checkbox.setChecked(False)
+        self.file_name.setText('')
+        self.list_checkpoints(None)
+        self.start_btn.setEnabled(checked)
+
     def select_agent(self):
         dialog = QFileDialog(self)
         self.agent_file(dialog)
@@ -120,8 +242,19 @@ class Menu(QWidget):
     def agent_file(self, dialog):
         dialog.setNameFilter('*.npz')
         if dialog.exec():
-            self.file_name.setText(dialog.selectedFiles()[0])
+            path = dialog.selectedFiles()[0]
+            if dialog.acceptMode() == QFileDialog.AcceptMode.AcceptOpen:
+                # Only the array headers are read, so this is fast for any table size
+                import agent_file as af
+                try:
+                    af.check_agent(path)
+                except ValueError as e:
+                    QMessageBox.warning(self, 'Invalid Agent File', str(e))
+                    return
+            self.file_name.setText(path)
+            self.list_checkpoints(path if dialog.acceptMode() == QFileDialog.AcceptMode.AcceptOpen else None)
             self.start_btn.setEnabled(True)
+            self.form_changed_timer.start()
         else:
             if not len(self.file_name.text()):
                 self.start_btn.setEnabled(False)
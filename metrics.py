@@ -0,0 +1,169 @@
+'''
+Training telemetry, stored as columnar chunks next to the agent file.
+
+Rows are buffered in preallocated column arrays and each full buffer is
+written in the background as one chunk: a directory holding a .npy file
+per column, renamed into place once complete. Readers only ever see whole
+chunks, and load the ones they haven't seen yet.
+
+    agent.npz.metrics/<table>/<chunk>/<column>.npy
+
+Games are recorded by whoever plays them. On the Human_v_Agent path, the
+agent's actions are recorded by a StepHook on its env, and its updates by
+the TrainingSession, from the Q entries each record changed, see
+agent_log.TrainingSession.updates. Batched training records each update as
+it's made.
+'''
+
+import numpy as np
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def metrics_path(filepath):
+    # Metrics kept next to an agent file
+    return f'{filepath}.metrics'
+
+
+# Tables and their columns
+games_columns = {
+    'time': np.float64,
+    'won': np.int8,
+    'turns': np.int32,
+    'training': np.int8,
+    # NaN where the agent's epsilon isn't known
+    'epsilon': np.float32,
+}
+updates_columns = {
+    'time': np.float64,
+    # Games finished before the update
+    'games': np.int64,
+    'transitions': np.int32,
+    'td_abs': np.float32,
+    'epsilon': np.float32,
+}
+steps_columns = {
+    'time': np.float64,
+    # Games finished before the step
+    'games': np.int64,
+    'action': np.int16,
+}
+
+
+class Table:
+    def __init__(self, writer, name, columns, chunk_rows):
+        self.writer = writer
+        self.name = name
+        self.buf = {k: np.empty(chunk_rows, dtype=dtype) for k, dtype in columns.items()}
+        self.n = 0
+        # Rows are added from game steps and training records, on their own threads
+        self._lock = threading.Lock()
+
+    def append(self, **row):
+        with self._lock:
+            n = self.n
+            for k, v in row.items():
+                self.buf[k][n] = v
+            self.n = n + 1
+            if self.n == len(self.buf['time']):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.n:
+            return
+        chunk = {k: b[:self.n].copy() for k, b in self.buf.items()}
+        self.n = 0
+        self.writer.write_async(self.name, chunk)
+
+
+class StepHook:
+    '''
+    Adds a row to a steps table for each action the agent takes on a
+    Human_v_Agent env, by wrapping env.step. Count finished games in games.
+    '''
+    def __init__(self, env, steps):
+        self.games = 0
+        step = env.step
+
+        @functools.wraps(step)
+        def wrapper(action, *args, **kwargs):
+            if env.game.whose_action == 1:
+                steps.append(time=time.time(), games=self.games, action=action)
+            return step(action, *args, **kwargs)
+        env.step = wrapper
+
+
+class MetricsWriter:
+    def __init__(self, path, chunk_rows=4096):
+        '''
+        path:       Metrics directory, see metrics_path
+        chunk_rows: Rows buffered per table before a chunk is written
+        '''
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.tables = {}
+        self._io = ThreadPoolExecutor(max_workers=1)
+        self._seq = 0
+
+    def table(self, name, columns):
+        if name not in self.tables:
+            self.tables[name] = Table(self, name, columns, self.chunk_rows)
+        return self.tables[name]
+
+    def write_async(self, table, chunk):
+        # Chunk names sort by time, and never clash between processes
+        self._seq += 1
+        name = f'{time.time_ns():020d}-{os.getpid()}-{self._seq:06d}'
+        return self._io.submit(self._write, table, name, chunk)
+
+    def _write(self, table, name, chunk):
+        table_dir = os.path.join(self.path, table)
+        tmp = os.path.join(table_dir, f'.{name}.tmp')
+        os.makedirs(tmp, exist_ok=True)
+        for k, arr in chunk.items():
+            np.save(os.path.join(tmp, f'{k}.npy'), arr)
+        os.replace(tmp, os.path.join(table_dir, name))
+
+    def flush(self):
+        for t in self.tables.values():
+            t.flush()
+
+    def close(self):
+        # Write what's buffered and wait for every chunk
+        self.flush()
+        self._io.shutdown(wait=True)
+
+
+class MetricsReader:
+    # Reads a metrics directory, loading only chunks added since the last read
+    def __init__(self, path):
+        self.path = path
+        # Table to (chunk names read, {column: list of arrays})
+        self._read = {}
+
+    def read(self, table):
+        '''
+        Returns dict of column to array of every row so far, empty if there are none
+        '''
+        seen, cols = self._read.setdefault(table, (set(), {}))
+        table_dir = os.path.join(self.path, table)
+        if os.path.isdir(table_dir):
+            for name in sorted(os.listdir(table_dir)):
+                if name.startswith('.') or name in seen:
+                    continue
+                chunk_dir = os.path.join(table_dir, name)
+                for f in os.listdir(chunk_dir):
+                    cols.setdefault(f[:-4], []).append(np.load(os.path.join(chunk_dir, f)))
+                seen.add(name)
+        # Keep one array per column, so later reads only concatenate new chunks
+        for k, parts in cols.items():
+            if len(parts) > 1:
+                cols[k] = [np.concatenate(parts)]
+        return {k: parts[0] for k, parts in cols.items()}
@@ -0,0 +1,152 @@
+'''
+Play headless games across a pool of processes.
+
+Human_v_Agent trains on an agent file it reads and rewrites itself, so when
+training each worker plays on its own full copy of the agent file. Workers
+diff their copy against the round's base, memory-mapped read-only: the agent
+file itself when it's uncompressed, or else an export of it as .npy files,
+so the base isn't loaded again in every worker. Workers send back the path
+to their delta rather than the table, and the parent sums the deltas into
+the agent file before the next round. Rows are matched by state, so states
+new to the table are appended, once however many workers met them, see
+agent_file.merge. Without training, workers play the agent file as it is
+and nothing is copied or merged.
+
+Workers record their games and steps to the agent's metrics, and the
+parent records each round's merged updates, see metrics.py.
+'''
+
+import agent_file
+import headless
+from agent_log import compact_pending
+from metrics import MetricsWriter, metrics_path, updates_columns
+import numpy as np
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+
+def _play(task):
+    (worker_id, filepath, base_path, work_dir, num_games,
+     is_training, p_first_turn, opponent, seed, metrics) = task
+
+    if is_training:
+        # Train on a private copy, then diff it against the shared base
+        work_path = os.path.join(work_dir, f'worker_{worker_id}.npz')
+        shutil.copyfile(filepath, work_path)
+    else:
+        work_path = filepath
+
+    wins, _ = headless.play_games(num_games,
+                                  work_path,
+                                  is_training,
+                                  p_first_turn=p_first_turn,
+                                  opponent=opponent,
+                                  seed=seed,
+                                  durable=False,
+                                  metrics=metrics)
+    if not is_training:
+        return wins, None
+
+    if os.path.isdir(base_path):
+        base = agent_file.open_npy(base_path)
+    else:
+        base = agent_file.load_arrays(base_path, mmap_mode='r')
+    delta = agent_file.diff(base, agent_file.load_arrays(work_path))
+    delta_path = os.path.join(work_dir, f'delta_{worker_id}.npz')
+    np.savez(delta_path, **delta)
+    return wins, delta_path
+
+
+def add_update(updates, base, deltas, games):
+    '''
+    Metrics row for a merge, from every Q entry the workers changed, as
+    agent_log.TrainingSession records them
+    '''
+    if not all(k in base for k in ('Q', 'lr', 'eps')):
+        return
+    dq = np.concatenate([d[k].reshape(-1) for d in deltas for k in ('Q', 'new.Q') if k in d] or [np.zeros(0)])
+    td = dq[dq != 0] / float(base['lr'])
+    if len(td):
+        updates.append(time=time.time(), games=games, transitions=len(td),
+                       td_abs=np.abs(td).mean(), epsilon=float(base['eps']))
+
+
+def run(num_games,
+        filepath,
+        is_training,
+        learning_rate=None,
+        discount_factor=None,
+        epsilon=None,
+        p_first_turn=0,
+        opponent='scripted',
+        seed=None,
+        workers=None,
+        sync_every=100,
+        metrics=True):
+    '''
+    Takes the same parameters as headless.play_games, plus:
+    workers:    Number of processes. Defaults to the CPU count.
+    sync_every: Games each worker plays between merges into the agent file
+    metrics:    Record games, steps and each merge's updates to the agent's metrics
+
+    Returns (agent wins, games per second)
+    '''
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    wins = 0
+    played = 0
+
+    # Fold in training logged by a session that didn't compact
+    compact_pending(filepath)
+
+    if not os.path.exists(filepath):
+        # Create the new agent, so workers have a shared base to start from
+        w, _ = headless.play_games(1, filepath, True, learning_rate, discount_factor, epsilon,
+                                   p_first_turn=p_first_turn, opponent=opponent, seed=seed,
+                                   durable=False, metrics=False)
+        wins += w
+        played += 1
+
+    metrics_dir = metrics_path(filepath) if metrics else None
+    writer = MetricsWriter(metrics_dir) if metrics and is_training else None
+
+    with tempfile.TemporaryDirectory() as tmp, multiprocessing.Pool(workers) as pool:
+        base_path = None
+        round_num = 0
+        while played < num_games:
+            if is_training:
+                # Read-only maps of an uncompressed file, merge returns new arrays for what changed
+                base = agent_file.load_arrays(filepath, mmap_mode='r')
+                compressed = agent_file.is_compressed(filepath)
+                base_path = filepath
+                if compressed:
+                    base_path = os.path.join(tmp, 'base')
+                    agent_file.export_npy(base, base_path)
+
+            # Split the round's games over the workers
+            round_games = min(workers * sync_every, num_games - played)
+            counts = [round_games // workers + (i < round_games % workers) for i in range(workers)]
+            tasks = [(i, filepath, base_path, tmp, n, is_training, p_first_turn, opponent,
+                      None if seed is None else seed + round_num * workers + i, metrics_dir)
+                     for i, n in enumerate(counts) if n]
+
+            results = pool.map(_play, tasks)
+            wins += sum(w for w, _ in results)
+            played += round_games
+
+            if is_training:
+                deltas = [agent_file.load_arrays(p) for _, p in results]
+                if writer:
+                    add_update(writer.table('updates', updates_columns), base, deltas, played)
+                agent_file.save_arrays(filepath, agent_file.merge(base, deltas), compressed)
+
+            round_num += 1
+            elapsed = time.perf_counter() - start
+            print(f'{played} games, {played / elapsed:.1f} games/s, win rate {wins / played:.3f}')
+
+    if writer:
+        writer.close()
+    return wins, headless.report(played, wins, time.perf_counter() - start, opponent)
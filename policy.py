@@ -0,0 +1,406 @@
+'''
+Batched tabular Q-learning, for serving many games with one agent.
+
+Human_v_Agent picks one action at a time for one env. BatchPolicy plays
+the same agent files, see agent_file, and selects actions for a whole batch
+of states with a single vectorised lookup of their Q-table rows.
+'''
+
+import agent_file
+import numpy as np
+import os
+
+
+# Packed state layout, low bits first: (first obs column, columns, bits per column)
+# for the card ids, eliminated flags, coins and last actions of both players
+state_fields = [(0, 8, 3), (8, 8, 1), (16, 2, 4), (18, 2, 6)]
+# Columns of a gym-coup observation
+obs_columns = sum(columns for _, columns, _ in state_fields)
+
+
+def encode(obs):
+    '''
+    Packs numeric observations into one uint64 each. Every field is kept,
+    so a key maps back to exactly one observation.
+    obs: 2D int array, one gym-coup observation per row
+    Returns uint64 array of state keys
+    '''
+    obs = np.asarray(obs, dtype=np.int64)
+    if obs.ndim != 2 or obs.shape[1] != obs_columns:
+        raise ValueError(f'Observations of shape {obs.shape} don\'t have gym-coup\'s {obs_columns} columns')
+    keys = np.zeros(len(obs), dtype=np.uint64)
+    shift = 0
+    for first, columns, bits in state_fields:
+        vals = obs[:, first:first + columns]
+        if vals.size and (vals.min() < 0 or vals.max() >= 1 << bits):
+            raise ValueError(f'Observation columns {first}-{first + columns - 1} '
+                             f'don\'t fit in {bits} bits')
+        for col in vals.T.astype(np.uint64):
+            keys |= col << np.uint64(shift)
+            shift += bits
+    return keys
+
+
+class StateIndex:
+    '''
+    Open addressing hash table from packed states to Q-table rows, adding a
+    row for each new state. Slots are probed linearly for a whole batch at once.
+    '''
+    empty = np.uint64(2**64 - 1)
+    # Fibonacci hashing multiplier
+    mult = np.uint64(0x9E3779B97F4A7C15)
+
+    def __init__(self, keys=None):
+        '''
+        keys: State keys of existing rows, in row order
+        '''
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._n = 0
+        self._resize(1024)
+        if keys is not None:
+            self._append(np.asarray(keys, dtype=np.uint64))
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def keys(self):
+        # State key of each row
+        return self._keys[:self._n]
+
+    def lookup(self, keys):
+        '''
+        keys: uint64 array of state keys, from encode
+        Returns array of Q-table rows
+        '''
+        uniq, inv = np.unique(keys, return_inverse=True)
+        rows = self._find(uniq)
+        new = rows < 0
+        if new.any():
+            rows[new] = self._append(uniq[new])
+        return rows[inv.reshape(-1)]
+
+    def find(self, keys):
+        # Rows of keys, -1 where missing, without adding any
+        uniq, inv = np.unique(keys, return_inverse=True)
+        return self._find(uniq)[inv.reshape(-1)]
+
+    def arrays(self):
+        # The hash table itself, so it can be shared without rebuilding it, see from_arrays
+        return {'keys': self.keys, 'slots': self._slots, 'rows': self._rows}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''
+        Index over arrays from StateIndex.arrays, e.g. memory-mapped read-only.
+        Only find works on a read-only index.
+        '''
+        index = cls.__new__(cls)
+        index._keys = arrays['keys']
+        index._n = len(index._keys)
+        index._slots = arrays['slots']
+        index._rows = arrays['rows']
+        index._shift = np.uint64(64 - (len(index._slots).bit_length() - 1))
+        return index
+
+    def _hash(self, keys):
+        with np.errstate(over='ignore'):
+            return ((keys * self.mult) >> self._shift).astype(np.int64)
+
+    def _find(self, keys):
+        # Rows of keys, -1 where missing
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        slot = self._hash(keys)
+        todo = np.arange(len(keys))
+        while len(todo):
+            found = self._slots[slot[todo]]
+            hit = found == keys[todo]
+            rows[todo[hit]] = self._rows[slot[todo[hit]]]
+            todo = todo[~hit & (found != self.empty)]
+            slot[todo] = (slot[todo] + 1) & (len(self._slots) - 1)
+        return rows
+
+    def _append(self, keys):
+        # Add rows for keys not in the table yet, returns their rows
+        rows = np.arange(self._n, self._n + len(keys))
+        if 2 * (self._n + len(keys)) > len(self._slots):
+            size = len(self._slots)
+            while 2 * (self._n + len(keys)) > size:
+                size *= 2
+            self._resize(size)
+        if self._n + len(keys) > len(self._keys):
+            grown = np.zeros(max(self._n + len(keys), 2 * len(self._keys)), dtype=np.uint64)
+            grown[:self._n] = self.keys
+            self._keys = grown
+        self._keys[rows] = keys
+        self._n += len(keys)
+        self._insert(keys, rows)
+        return rows
+
+    def _insert(self, keys, rows):
+        slot = self._hash(keys)
+        todo = np.arange(len(keys))
+        while len(todo):
+            free = todo[self._slots[slot[todo]] == self.empty]
+            # Where keys probe the same free slot, the first one takes it
+            _, first = np.unique(slot[free], return_index=True)
+            taken = free[first]
+            self._slots[slot[taken]] = keys[taken]
+            self._rows[slot[taken]] = rows[taken]
+            todo = np.setdiff1d(todo, taken, assume_unique=True)
+            slot[todo] = (slot[todo] + 1) & (len(self._slots) - 1)
+
+    def _resize(self, size):
+        # size must be a power of 2
+        self._slots = np.full(size, self.empty, dtype=np.uint64)
+        self._rows = np.zeros(size, dtype=np.int64)
+        self._shift = np.uint64(64 - (size.bit_length() - 1))
+        self._insert(self.keys, np.arange(self._n))
+
+
+def mirror(obs):
+    '''
+    Observations as seen from the other seat, with the players' columns swapped,
+    so an agent trained in the agent's seat can play the human's.
+    obs: 2D int array, one gym-coup observation per row
+    '''
+    obs = np.asarray(obs)
+    cols = np.arange(obs.shape[1])
+    for first, columns, _ in state_fields:
+        half = columns // 2
+        cols[first:first + columns] = np.roll(cols[first:first + columns], half)
+    return obs[:, cols]
+
+
+def valid_mask(valid_actions, num_actions):
+    '''
+    valid_actions: List of lists of valid action ids, one list per env
+    Returns bool array (envs, num_actions)
+    '''
+    mask = np.zeros((len(valid_actions), num_actions), dtype=bool)
+    for i, valid in enumerate(valid_actions):
+        mask[i, valid] = True
+    return mask
+
+
+class BatchPolicy:
+    def __init__(self,
+                 num_actions,
+                 learning_rate=0.5,
+                 discount_factor=0.5,
+                 epsilon=0.5,
+                 q=None,
+                 states=None,
+                 seed=None,
+                 extra=None):
+        '''
+        num_actions:     Size of the env's action space
+        learning_rate:   Float (0, 1]
+        discount_factor: Float [0, 1]
+        epsilon:         Chance of a random valid action. Float [0, 1]
+        q:               Existing Q-table
+        states:          Observation of each row of q
+        extra:           Other arrays of the agent file, saved back unchanged
+        '''
+        for name, value in [('learning_rate', learning_rate), ('discount_factor', discount_factor),
+                            ('epsilon', epsilon)]:
+            if value is None:
+                raise ValueError(f'BatchPolicy {name} can\'t be None')
+        self.num_actions = num_actions
+        self.learning_rate = learning_rate
+        self.discount_factor = discount_factor
+        self.epsilon = epsilon
+        self.index = StateIndex(encode(states)) if states is not None else StateIndex()
+        self.q = q if q is not None else np.zeros((1024, num_actions), dtype=np.float32)
+        # Every column fits in a byte, encode checks them
+        self.states = (np.asarray(states, dtype=np.uint8) if states is not None
+                       else np.zeros((len(self.q), obs_columns), dtype=np.uint8))
+        self.extra = extra if extra is not None else {}
+        self.rng = np.random.default_rng(seed)
+
+    def rows(self, obs):
+        # Q-table rows for a batch of observations, growing the table as needed
+        obs = np.asarray(obs)
+        n = len(self.index)
+        rows = self.index.lookup(encode(obs))
+        if len(self.index) > n:
+            size = max(len(self.index), 2 * len(self.q))
+            if len(self.index) > len(self.q):
+                grown = np.zeros((size, self.num_actions), dtype=np.float32)
+                grown[:len(self.q)] = self.q
+                self.q = grown
+            if len(self.index) > len(self.states):
+                grown = np.zeros((size, self.states.shape[1]), dtype=self.states.dtype)
+                grown[:len(self.states)] = self.states
+                self.states = grown
+            new = rows >= n
+            self.states[rows[new]] = obs[new]
+        return rows
+
+    def values(self, rows, overlays=None):
+        '''
+        Q-values of rows, as seen by the sessions training on them
+        overlays: Overlay or None for each row
+        '''
+        q = self.q[rows]
+        if overlays is not None:
+            for j, (row, overlay) in enumerate(zip(rows.tolist(), overlays)):
+                if overlay is not None and row in overlay.deltas:
+                    q[j] += overlay.deltas[row]
+        return q
+
+    def act(self, obs, mask, greedy=False, overlays=None):
+        '''
+        obs:      2D array, one observation per env
+        mask:     Bool array (envs, num_actions) of valid actions, from valid_mask
+        greedy:   True to never explore, e.g. when evaluating
+        overlays: Overlay of each env's session, or None where it has none
+        Returns array of action ids
+        '''
+        rows = self.rows(obs)
+        q = np.where(mask, self.values(rows, overlays), -np.inf)
+        actions = q.argmax(axis=1)
+        if greedy or not self.epsilon:
+            return actions
+
+        # Uniform random valid action: the largest of random keys over valid actions
+        random_actions = np.where(mask, self.rng.random(mask.shape), -1).argmax(axis=1)
+        explore = self.rng.random(len(actions)) < self.epsilon
+        return np.where(explore, random_actions, actions)
+
+    def greedy(self, obs, mask):
+        '''
+        Best valid actions, without adding rows for new states, so a loaded
+        table is only read, and only at the rows of the states met.
+        obs, mask: As for act
+        Returns array of action ids
+        '''
+        rows = self.index.find(encode(obs))
+        # States the agent never met have all-zero Q-values, as when it's training
+        q = np.where((rows >= 0)[:, None], self.q[np.maximum(rows, 0)], 0.0)
+        return np.where(mask, q, -np.inf).argmax(axis=1)
+
+    def update(self, obs, actions, rewards, next_obs, next_mask, done, overlay=None):
+        '''
+        One Q-learning update for a batch of transitions.
+        next_obs and next_mask are ignored where done is True.
+        overlay: Overlay to apply the update to, instead of the table
+        Returns the TD errors.
+        '''
+        overlays = None if overlay is None else [overlay] * len(obs)
+        rows = self.rows(obs)
+        done = np.asarray(done, dtype=bool)
+        next_q = np.zeros(len(rows), dtype=np.float32)
+        live = ~done
+        if live.any():
+            next_rows = self.rows(np.asarray(next_obs)[live])
+            q = np.where(next_mask[live],
+                         self.values(next_rows, None if overlay is None else overlays[:len(next_rows)]),
+                         -np.inf)
+            next_q[live] = np.where(next_mask[live].any(axis=1), q.max(axis=1), 0.0)
+
+        target = np.asarray(rewards, dtype=np.float32) + self.discount_factor * next_q
+        td = target - self.values(rows, overlays)[np.arange(len(rows)), actions]
+        if overlay is not None:
+            overlay.add(rows, actions, self.learning_rate * td)
+        else:
+            # add.at so repeated (state, action) pairs in a batch all apply
+            np.add.at(self.q, (rows, actions), self.learning_rate * td)
+        return td
+
+    def arrays(self):
+        # Copy of everything save writes, in the agent file format, e.g. to save off the calling thread
+        n = len(self.index)
+        arrays = dict(self.extra)
+        arrays.update(Q=self.q[:n].copy(),
+                      states=self.states[:n].copy(),
+                      lr=np.array(self.learning_rate),
+                      df=np.array(self.discount_factor),
+                      eps=np.array(self.epsilon))
+        return arrays
+
+    def save(self, path):
+        if os.path.exists(path):
+            # Never replace a file that isn't an agent
+            agent_file.check_agent(path)
+        agent_file.save_arrays(path, self.arrays())
+
+    @classmethod
+    def load(cls, path, seed=None):
+        '''
+        Load an agent file, e.g. one trained by Human_v_Agent.
+        Raises ValueError if path isn't in the agent file format.
+        '''
+        import agent_log
+        # Training logged by a session that didn't compact
+        agent_log.compact_pending(path)
+        agent_file.check_agent(path)
+        # Q-values of uncompressed files are mapped copy-on-write, so only visited rows are read
+        arrays = agent_file.load_arrays(path, mmap_mode='c')
+        q = arrays.pop('Q')
+        states = arrays.pop('states')
+        lr, df, eps = (float(arrays.pop(k)) for k in agent_file.param_names)
+        return cls(q.shape[1], lr, df, eps,
+                   q=q if q.dtype == np.float32 else q.astype(np.float32),
+                   states=states, seed=seed, extra=arrays)
+
+
+class Overlay:
+    '''
+    One session's training on a shared BatchPolicy. Updates are kept here as
+    changes to the shared Q-values, by row, which the session sees on top of
+    the shared table. merge adds them to the table, e.g. when its game ends.
+    '''
+    def __init__(self, policy):
+        self.policy = policy
+        # Row to change of each action's Q-value
+        self.deltas = {}
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def add(self, rows, actions, changes):
+        for row, action, change in zip(rows.tolist(), actions.tolist(), changes.tolist()):
+            if row not in self.deltas:
+                self.deltas[row] = np.zeros(self.policy.num_actions, dtype=np.float32)
+            self.deltas[row][action] += change
+
+    def merge(self):
+        # Changes are added rather than copied, so sessions merging the same rows all count
+        if self.deltas:
+            rows = np.fromiter(self.deltas, dtype=np.int64, count=len(self.deltas))
+            self.policy.q[rows] += np.stack(list(self.deltas.values()))
+        self.deltas = {}
+
+
+class PolicyAgent:
+    # Plays the agent's seat of an env greedily from a BatchPolicy
+    def __init__(self, env, policy):
+        self.env = env
+        self.policy = policy
+
+    def step(self):
+        # Act until it's the human's turn again
+        env = self.env
+        while not env.game.game_over and env.game.whose_action == 1:
+            mask = valid_mask([env.get_valid_actions()], self.policy.num_actions)
+            env.step(int(self.policy.greedy(np.array([env.get_obs()]), mask)[0]))
+
+
+class PolicyGame:
+    '''
+    Same interface as Human_v_Agent, for playing an agent file without training.
+    Human_v_Agent reads its whole table, this maps it and reads the states
+    to index them, but only the Q-values of the states met, where the file is
+    uncompressed. See --uncompress in main.py.
+    '''
+    def __init__(self, p_first_turn, filepath):
+        from headless import new_envs
+        self.env = new_envs(1, p_first_turn)[0]
+        self.agent = PolicyAgent(self.env, BatchPolicy.load(filepath))
+
+    def step(self, action):
+        # Human's action by name, then the agent's reply
+        names = self.env.get_valid_actions(text=True)
+        self.env.step(self.env.get_valid_actions()[names.index(action)])
+        self.agent.step()
@@ -0,0 +1,90 @@
+'''
+Loads the agent in the background while the menu is being filled in,
+so pressing Start only has to attach an already built game.
+
+An agent that's going to be trained is only checked, by reading its header
+through read-only maps. Training copies the agent file, so the copy and the
+game are made when Start is pressed, and nothing is left to clean up if the
+form changes first.
+'''
+
+import agent_file
+from board import new_game
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+logger = logging.getLogger('app')
+
+
+class AgentCache:
+    def __init__(self):
+        self._io = ThreadPoolExecutor(max_workers=1)
+        # Key of the prefetched game and its future (game, None), or when
+        # training the future of the agent file's header
+        self._key = None
+        self._future = None
+        # Form data of the last game taken without training, prefetched again back at the menu
+        self._last = None
+
+    @staticmethod
+    def key(form_data):
+        '''
+        form_data: Tuple from Menu.get_form_data
+        The agent file's mtime is part of the key, so a changed file is reloaded.
+        '''
+        path = form_data[1]
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        return (int(form_data[0]),) + tuple(form_data[1:]) + (mtime,)
+
+    def prefetch(self, form_data):
+        key = self.key(form_data)
+        if key == self._key:
+            return
+        self.discard()
+        self._key = key
+        if form_data[2]:
+            logger.debug(f'Checking agent {form_data[1]}')
+            self._future = self._io.submit(self._check, form_data[1])
+        else:
+            logger.debug(f'Prefetching agent {form_data[1]}')
+            self._future = self._io.submit(new_game, int(form_data[0]), *form_data[1:])
+
+    @staticmethod
+    def _check(path):
+        # Header of an agent to be trained, None for a new agent
+        return agent_file.check_agent(path) if os.path.exists(path) else None
+
+    def take(self, form_data):
+        '''
+        Returns (game, TrainingSession or None) for form_data, see board.new_game.
+        Waits for a matching prefetch still loading, or loads now on a miss.
+        '''
+        future = self._future if self.key(form_data) == self._key else None
+        self._key = self._future = None
+        if future is not None and not form_data[2]:
+            game = future.result()
+        else:
+            # Training makes its scratch copy of the agent now
+            game = new_game(int(form_data[0]), *form_data[1:])
+
+        # Training changes the agent, so that is loaded fresh
+        self._last = None if form_data[2] else form_data
+        return game
+
+    def prefetch_last(self):
+        # Back at the menu, have the next game against the last agent ready for a replay
+        if self._last is not None and os.path.exists(self._last[1]):
+            self.prefetch(self._last)
+
+    def discard(self, wait=False):
+        '''
+        wait: Block until a prefetch still loading has finished,
+              e.g. before replacing its agent file
+        '''
+        if self._future is None:
+            return
+        future = self._future
+        self._key = self._future = None
+        if wait:
+            future.exception()
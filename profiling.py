@@ -0,0 +1,92 @@
+'''
+Latency instrumentation, enabled with the --profile flag.
+Timings are kept in memory and summarised as percentiles or dumped as a trace.
+'''
+
+from collections import defaultdict
+from contextlib import contextmanager
+import csv
+import functools
+import json
+import math
+import time
+
+
+def percentile(sorted_vals, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_vals:
+        return 0.0
+    ind = min(len(sorted_vals) - 1, max(0, math.ceil(p / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[ind]
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self._start = time.perf_counter()
+        # name to list of (start seconds since profiler creation, duration seconds)
+        self.samples = defaultdict(list)
+
+    def record(self, name, start, duration):
+        self.samples[name].append((start - self._start, duration))
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def wrap(self, name, fn):
+        # Time every call of fn under name
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.time(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        '''
+        Returns dict of name to (count, p50, p95, p99), in milliseconds
+        '''
+        out = {}
+        for name, samples in list(self.samples.items()):
+            durations = sorted(d for _, d in samples)
+            out[name] = (len(durations),) + tuple(percentile(durations, p) * 1000
+                                                  for p in (50, 95, 99))
+        return out
+
+    def dump(self, path):
+        # Write every sample as a .csv trace, or .json with a summary
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(['name', 'start_s', 'duration_ms'])
+                for name, samples in self.samples.items():
+                    for start, duration in samples:
+                        w.writerow([name, f'{start:.6f}', f'{duration * 1000:.3f}'])
+        else:
+            with open(path, 'w') as f:
+                json.dump({
+                    'summary_ms': {name: dict(zip(['count', 'p50', 'p95', 'p99'], s))
+                                   for name, s in self.stats().items()},
+                    'trace': {name: [[round(s, 6), round(d * 1000, 3)] for s, d in samples]
+                              for name, samples in self.samples.items()},
+                }, f, indent=1)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    # Decorator timing a function under name while the profiler is enabled
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            with profiler.time(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
@@ -0,0 +1,186 @@
+'''
+Game replays, kept in an append-only binary file with an offset index.
+
+A record holds the deal and every env step of one game. gym-coup draws
+exchanged cards from its own deck, so actions alone can't rebuild a game,
+and each step stores only the observation fields it changed instead, a few
+bytes each. A full state is stored every snapshot_every steps, so any step
+is rebuilt from the nearest snapshot plus a bounded number of changes.
+'''
+
+import numpy as np
+import logging
+import os
+import struct
+import zlib
+
+logger = logging.getLogger('app')
+
+
+# Text observation fields, then whose_action and game_over
+num_fields = 22
+# Fields holding card or action names, the rest are small ints
+str_fields = frozenset([0, 1, 2, 3, 4, 5, 6, 7, 18, 19])
+# Names with a fixed code. Others are stored with the game that uses them.
+vocab = (['none', 'Assassin', 'Ambassador', 'Captain', 'Contessa', 'Duke',
+          'income', 'foreign_aid', 'coup', 'tax', 'assassinate', 'exchange', 'steal',
+          'lose_card_1', 'lose_card_2', 'lose_card_3', 'lose_card_4']
+         + [f'exchange_return_{a}{b}' for a in range(1, 5) for b in range(a + 1, 5)])
+snapshot_every = 16
+# Marks a full state rather than a count of changed fields
+snapshot_marker = 0xFF
+
+
+def state_of(env):
+    # Everything the board shows for the env's current step
+    return list(env.get_obs(text=True)) + [env.game.whose_action, int(env.game.game_over)]
+
+
+class GameRecord:
+    def __init__(self):
+        # One state per step, the first being the deal
+        self.states = []
+
+    def start(self, env):
+        self.states = [state_of(env)]
+
+    def add(self, env):
+        self.states.append(state_of(env))
+
+    def encode(self, user_won):
+        names = {n: i for i, n in enumerate(vocab)}
+        extras = []
+        def code(i, v):
+            if i not in str_fields:
+                return int(v)
+            if v not in names:
+                names[v] = len(names)
+                extras.append(v)
+            return names[v]
+
+        steps = bytearray()
+        snapshots = []
+        prev = None
+        for n, state in enumerate(self.states):
+            codes = [code(i, v) for i, v in enumerate(state)]
+            if n % snapshot_every == 0:
+                snapshots.append(len(steps))
+                steps.append(snapshot_marker)
+                steps.extend(codes)
+            else:
+                changed = [(i, c) for i, (c, p) in enumerate(zip(codes, prev)) if c != p]
+                steps.append(len(changed))
+                for i, c in changed:
+                    steps.extend((i, c))
+            prev = codes
+
+        extra_bytes = '\n'.join(extras).encode()
+        return (struct.pack('<HBH', len(self.states), user_won, len(extra_bytes)) + extra_bytes
+                + np.array(snapshots, dtype='<u4').tobytes() + bytes(steps))
+
+
+class Replay:
+    # One recorded game, decoded on demand
+    def __init__(self, payload):
+        self.num_steps, user_won, extras_len = struct.unpack_from('<HBH', payload)
+        self.user_won = bool(user_won)
+        pos = struct.calcsize('<HBH')
+        extras = payload[pos:pos + extras_len].decode()
+        self.names = vocab + (extras.split('\n') if extras else [])
+        pos += extras_len
+        num_snapshots = -(-self.num_steps // snapshot_every)
+        self.snapshots = np.frombuffer(payload, dtype='<u4', count=num_snapshots, offset=pos)
+        self.steps = payload[pos + 4 * num_snapshots:]
+
+    def state(self, step):
+        '''
+        step: 0 for the deal, up to num_steps - 1
+        Returns the text observation followed by whose_action and game_over
+        '''
+        if not 0 <= step < self.num_steps:
+            raise IndexError(f'Step {step} of a {self.num_steps} step game')
+        steps = self.steps
+        pos = int(self.snapshots[step // snapshot_every]) + 1
+        codes = list(steps[pos:pos + num_fields])
+        pos += num_fields
+        for _ in range(step % snapshot_every):
+            n = steps[pos]
+            for j in range(pos + 1, pos + 1 + 2 * n, 2):
+                codes[steps[j]] = steps[j + 1]
+            pos += 1 + 2 * n
+        return [self.names[c] if i in str_fields else c for i, c in enumerate(codes)]
+
+
+class ReplayFile:
+    # Record header: payload length, crc32 of payload
+    record_header = struct.Struct('<II')
+
+    def __init__(self, path):
+        '''
+        path: Replay file, created on the first append.
+              Its offset index is kept at path + '.idx'.
+        '''
+        self.path = path
+        self.index_path = f'{path}.idx'
+        self.offsets = self._load_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _load_index(self):
+        if not os.path.exists(self.path):
+            return []
+        offsets = []
+        if os.path.exists(self.index_path):
+            offsets = np.fromfile(self.index_path, dtype='<u8').tolist()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            # Drop index entries past the data, then index any records written
+            # after the index was, e.g. by a crash between the two writes
+            end = 0
+            while offsets:
+                f.seek(offsets[-1])
+                header = f.read(self.record_header.size)
+                if len(header) == self.record_header.size:
+                    end = offsets[-1] + self.record_header.size + self.record_header.unpack(header)[0]
+                    if end <= size:
+                        break
+                offsets.pop()
+
+            indexed = len(offsets)
+            while end < size:
+                f.seek(end)
+                header = f.read(self.record_header.size)
+                if len(header) < self.record_header.size:
+                    break
+                length, crc = self.record_header.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                offsets.append(end)
+                end += self.record_header.size + length
+
+        if end < size:
+            logger.warning(f'Discarding incomplete replay at byte {end} of {self.path}')
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        if len(offsets) != indexed or not os.path.exists(self.index_path):
+            np.array(offsets, dtype='<u8').tofile(self.index_path)
+        return offsets
+
+    def append(self, record, user_won):
+        payload = record.encode(user_won)
+        with open(self.path, 'ab') as f:
+            offset = f.tell()
+            f.write(self.record_header.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+        with open(self.index_path, 'ab') as f:
+            f.write(struct.pack('<Q', offset))
+        self.offsets.append(offset)
+
+    def game(self, i):
+        # Replay of game i, read with one seek through the index
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[i])
+            length, _ = self.record_header.unpack(f.read(self.record_header.size))
+            return Replay(f.read(length))
@@ -0,0 +1,250 @@
+'''
+Game server hosting many human vs agent games against one shared agent.
+
+Clients send newline delimited JSON requests over TCP, one game per
+connection. Whenever games are waiting on the agent, their actions are
+picked together with one batched lookup of a policy.BatchPolicy, which plays
+the app's agent files, see agent_file. client.RemoteGame plays on it from the Board.
+
+Every game reads the one shared table. When training, each game's updates
+go to its own policy.Overlay and are merged into the table when it ends.
+
+    $ python app/server.py --agent batch.npz --port 8765
+'''
+
+from policy import BatchPolicy, Overlay, valid_mask
+import agent_file
+import numpy as np
+import argparse
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('app')
+
+
+def new_env(p_first_turn):
+    from headless import new_envs
+    return new_envs(1, p_first_turn)[0]
+
+
+def state_of(env):
+    # Reply describing the env after a request
+    game = env.game
+    return {
+        'obs': [v if isinstance(v, str) else int(v) for v in env.get_obs(text=True)],
+        'whose_action': int(game.whose_action),
+        'game_over': bool(game.game_over),
+        'valid': [] if game.game_over or game.whose_action != 0 else env.get_valid_actions(text=True),
+    }
+
+
+class Session:
+    # A client's game, and the agent's training from it
+    def __init__(self, env, overlay=None):
+        self.env = env
+        self.overlay = overlay
+        # Agent's last (obs, action), waiting for its outcome
+        self.pending = None
+
+    def learn(self, obs, mask):
+        # Agent is about to act at obs, which is the outcome of its last action
+        if self.overlay is not None and self.pending is not None:
+            self.overlay.policy.update(*(np.array([x]) for x in self.pending + (0.0, obs, mask, False)),
+                                       overlay=self.overlay)
+
+    def finish(self):
+        # Learn from the end of the game and merge it into the shared table
+        if self.overlay is None:
+            return
+        if self.pending is not None:
+            agent_won = 0 not in self.env.get_obs(text=True)[8:12]
+            obs, action = self.pending
+            no_actions = np.zeros(self.overlay.policy.num_actions, dtype=bool)
+            self.overlay.policy.update(*(np.array([x]) for x in (obs, action, 1.0 if agent_won else -1.0,
+                                                                 obs, no_actions, True)),
+                                       overlay=self.overlay)
+            self.pending = None
+        self.overlay.merge()
+
+
+class GameServer:
+    def __init__(self, policy, new_env=new_env, batch_wait=0.002, is_training=False, filepath=None, save_every=100):
+        '''
+        policy:      BatchPolicy playing every game
+        new_env:     Function of p_first_turn returning a gym-coup env
+        batch_wait:  Seconds to let more games join a batch before acting
+        is_training: True to train the policy, otherwise it plays greedily
+        filepath:    Where training is saved
+        save_every:  Save after this many finished games
+        '''
+        self.policy = policy
+        self.new_env = new_env
+        self.batch_wait = batch_wait
+        self.is_training = is_training
+        self.filepath = filepath
+        self.save_every = save_every
+        self.finished_games = 0
+        # (session, future set when it's no longer the agent's turn)
+        self.waiting = []
+        self._wake = asyncio.Event()
+        self.sessions = 0
+        # (host, port) being served on, once serve has started, e.g. to find the port when serving on port 0
+        self.address = None
+        self.batches = 0
+        self.agent_steps = 0
+        # Saves run one at a time, and at most one is pending
+        self._io = ThreadPoolExecutor(max_workers=1)
+        self._saving = None
+
+    async def agent_turn(self, session):
+        # Returns once the agent has played until the human's turn
+        env = session.env
+        if not env.game.game_over and env.game.whose_action == 1:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.append((session, future))
+            self._wake.set()
+            await future
+        if env.game.game_over:
+            self.game_over(session)
+
+    def game_over(self, session):
+        if not self.is_training or session.overlay is None:
+            return
+        session.finish()
+        session.overlay = None
+        self.finished_games += 1
+        if self.filepath is not None and self.finished_games % self.save_every == 0:
+            self.save_async()
+
+    def save_async(self):
+        # Snapshot on the loop, write in the background. Skipped while the last save is still writing.
+        if self._saving is not None and not self._saving.done():
+            logger.info('Previous save still in progress, skipping this one')
+            return self._saving
+        arrays = self.policy.arrays()
+        self._saving = self._io.submit(agent_file.save_arrays, self.filepath, arrays)
+        self._saving.add_done_callback(self._saved)
+        return self._saving
+
+    def _saved(self, future):
+        if future.exception() is not None:
+            logger.error(f'Saving {self.filepath} failed: {future.exception()}')
+
+    def close(self):
+        # Finish any save in flight, then save the final table
+        if self._saving is not None:
+            self._saving.exception()
+        if self.is_training and self.filepath is not None:
+            self.policy.save(self.filepath)
+        self._io.shutdown(wait=True)
+
+    async def batcher(self):
+        # Plays the agent's turn in every waiting game
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.batch_wait)
+            self._wake.clear()
+            batch, self.waiting = self.waiting, []
+            while batch:
+                sessions = [session for session, _ in batch]
+                try:
+                    obs = np.array([s.env.get_obs() for s in sessions])
+                    mask = valid_mask([s.env.get_valid_actions() for s in sessions], self.policy.num_actions)
+                    actions = self.policy.act(obs, mask, greedy=not self.is_training,
+                                              overlays=[s.overlay for s in sessions])
+                    for j, (s, action) in enumerate(zip(sessions, actions)):
+                        if self.is_training:
+                            s.learn(obs[j], mask[j])
+                            s.pending = (obs[j], action)
+                        s.env.step(int(action))
+                except Exception as e:
+                    logger.exception('Agent step failed')
+                    for _, future in batch:
+                        future.set_exception(e)
+                    break
+                self.batches += 1
+                self.agent_steps += len(batch)
+
+                # Games can need more than one agent action in a row, e.g. a coup then losing a card
+                still = []
+                for session, future in batch:
+                    if session.env.game.game_over or session.env.game.whose_action != 1:
+                        future.set_result(None)
+                    else:
+                        still.append((session, future))
+                batch = still
+
+    def new_session(self, env):
+        return Session(env, Overlay(self.policy) if self.is_training else None)
+
+    async def handle(self, reader, writer):
+        session = None
+        self.sessions += 1
+        try:
+            while line := await reader.readline():
+                try:
+                    msg = json.loads(line)
+                    op = msg['op']
+                    if op == 'new':
+                        session = self.new_session(self.new_env(int(msg.get('p_first_turn', 0))))
+                    elif session is None:
+                        raise ValueError('No game, send "new" first')
+                    elif op == 'reset':
+                        # An unfinished game's training is dropped
+                        session = self.new_session(session.env)
+                        session.env.reset()
+                    elif op == 'step':
+                        env = session.env
+                        # Like Human_v_Agent.step, the agent answers before the reply
+                        names = env.get_valid_actions(text=True)
+                        if env.game.game_over or env.game.whose_action != 0 or msg['action'] not in names:
+                            raise ValueError(f'Invalid action {msg["action"]}')
+                        env.step(env.get_valid_actions()[names.index(msg['action'])])
+                        await self.agent_turn(session)
+                    elif op == 'agent':
+                        await self.agent_turn(session)
+                    elif op != 'state':
+                        raise ValueError(f'Unknown op {op}')
+                    reply = state_of(session.env)
+                except (KeyError, ValueError) as e:
+                    reply = {'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        self.address = server.sockets[0].getsockname()[:2]
+        logger.warning(f'Serving on {", ".join(str(s.getsockname()) for s in server.sockets)}')
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.batcher())
+        finally:
+            self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coup RL game server')
+    parser.add_argument('--agent', required=True, metavar='FILE', help='Agent file, trained by the app or with --batch in main.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--batch-wait', type=float, default=2, help='Ms to gather games into one agent batch')
+    parser.add_argument('--train', action='store_true', help='Train the agent on every game played')
+    parser.add_argument('--save-every', type=int, default=100, help='Games between saves when training')
+    args = parser.parse_args()
+
+    server = GameServer(BatchPolicy.load(args.agent),
+                        batch_wait=args.batch_wait / 1000,
+                        is_training=args.train,
+                        filepath=args.agent,
+                        save_every=args.save_every)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,47 @@
+'''
+Snapshots of a game's env, for undo and what-if analysis.
+
+A snapshot is the env's state pickled once into bytes. Restoring it loads
+the state back into an existing env object, so the game, the agent and the
+board keep their references to the env. Branching loads it into a new env
+object without building a game, so analysis code can play out thousands
+of continuations from one position. Both are several times cheaper than
+copy.deepcopy of the env.
+
+Instance level wrappers of env.step, such as Board's replay recording and
+the profiler, aren't game state. They are left out of snapshots and kept
+by the env being restored.
+'''
+
+import pickle
+
+# Env attributes that wrap the env rather than being part of its state
+wrapper_attrs = ('step',)
+
+
+class Snapshot:
+    def __init__(self, env):
+        '''
+        env: gym-coup env, or anything else that pickles
+        '''
+        self.env_type = type(env)
+        state = {k: v for k, v in vars(env).items() if k not in wrapper_attrs}
+        self.data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __len__(self):
+        # Size in bytes
+        return len(self.data)
+
+    def restore(self, env):
+        # Put env back in the snapshot's state, in place
+        attrs = vars(env)
+        wrappers = {k: attrs[k] for k in wrapper_attrs if k in attrs}
+        attrs.clear()
+        attrs.update(pickle.loads(self.data))
+        attrs.update(wrappers)
+
+    def branch(self):
+        # New env in the snapshot's state, independent of the original
+        env = self.env_type.__new__(self.env_type)
+        vars(env).update(pickle.loads(self.data))
+        return env
@@ -0,0 +1,248 @@
+'''
+Benchmarks of the UI hot path, run offscreen against a stub game.
+
+The stub stands in for gym-coup's Human_v_Agent with the same observation
+layout, so only Board, ActionSelector and Player are measured, and gym-coup
+doesn't need to be installed. It only has text observations and actions, so
+the board decodes their names as ids. Cold start to first paint is timed
+against a budget. Save runs and compare them with pytest-benchmark:
+
+    $ python -m pytest tests/bench_ui.py --benchmark-autosave
+    $ python -m pytest tests/bench_ui.py --benchmark-compare --benchmark-compare-fail=mean:25%
+'''
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import pytest
+pytest.importorskip('pytest_benchmark')
+
+from board import Board
+from PyQt6.QtCore import QCoreApplication, QEvent, QThreadPool
+from PyQt6.QtWidgets import QApplication
+import random
+import resource
+import subprocess
+import sys
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Max ms from starting the app to its first paint
+startup_budget = 1000
+
+
+class StubGameState:
+    def __init__(self, p_first_turn):
+        self.game_over = False
+        self.whose_action = p_first_turn
+
+
+class StubEnv:
+    '''
+    A reduced game of Coup with gym-coup's text observation:
+    4 card slots per player, 4 eliminated flags per player, coins, last actions.
+    '''
+    cards = ['Assassin', 'Ambassador', 'Captain', 'Contessa', 'Duke']
+
+    def __init__(self, rng, p_first_turn=0):
+        self.rng = rng
+        self.p_first_turn = p_first_turn
+        self.reset()
+
+    def reset(self):
+        rng = self.rng
+        self.game = StubGameState(self.p_first_turn)
+        self.p_cards = [[rng.choice(self.cards), rng.choice(self.cards), 'none', 'none'] for _ in range(2)]
+        # Empty slots count as eliminated
+        self.elim = [[0, 0, 1, 1] for _ in range(2)]
+        self.coins = [2, 2]
+        self.last = ['none', 'none']
+        # Player who has to lose a card, and whether they are mid exchange
+        self.losing = None
+        self.exchanging = False
+
+    def get_obs(self, text=True):
+        return (self.p_cards[0] + self.p_cards[1] + self.elim[0] + self.elim[1]
+                + self.coins + self.last)
+
+    def alive(self, p):
+        return [i for i in range(4) if not self.elim[p][i]]
+
+    def get_valid_actions(self, text=True):
+        p = self.game.whose_action
+        if self.losing == p:
+            return [f'lose_card_{i+1}' for i in self.alive(p)]
+        if self.exchanging:
+            held = [i for i in range(4) if self.p_cards[p][i] != 'none']
+            return [f'exchange_return_{held[a]+1}{held[b]+1}'
+                    for a in range(len(held)) for b in range(a+1, len(held))]
+        if self.coins[p] >= 10:
+            return ['coup']
+        valid = ['income', 'foreign_aid', 'tax']
+        if self.p_cards[p][2] == 'none':
+            valid.append('exchange')
+        if self.coins[p] >= 7:
+            valid.append('coup')
+        return valid
+
+    def step(self, action):
+        p = self.game.whose_action
+        o = 1 - p
+        self.last[p] = action
+
+        if action.startswith('lose_card'):
+            self.elim[p][int(action[-1]) - 1] = 1
+            self.losing = None
+            if not self.alive(p):
+                self.game.game_over = True
+                return
+        elif action.startswith('exchange_return'):
+            keep = [self.p_cards[p][i] for i in range(4)
+                    if self.p_cards[p][i] != 'none' and str(i+1) not in action[-2:]]
+            elim = [self.elim[p][i] for i in range(4)
+                    if self.p_cards[p][i] != 'none' and str(i+1) not in action[-2:]]
+            self.p_cards[p] = keep + ['none'] * (4 - len(keep))
+            self.elim[p] = elim + [1] * (4 - len(elim))
+            self.exchanging = False
+        elif action == 'exchange':
+            self.p_cards[p][2:] = [self.rng.choice(self.cards), self.rng.choice(self.cards)]
+            self.elim[p][2:] = [0, 0]
+            self.exchanging = True
+            return
+        elif action == 'coup':
+            self.coins[p] -= 7
+            self.losing = o
+            self.game.whose_action = o
+            return
+        else:
+            self.coins[p] += {'income': 1, 'foreign_aid': 2, 'tax': 3}[action]
+
+        # Turn passes back to whoever didn't just act on their own turn
+        self.game.whose_action = o if not action.startswith('lose_card') else p
+
+
+class StubAgent:
+    def __init__(self, env, rng):
+        self.env = env
+        self.rng = rng
+
+    def step(self):
+        # Act until it's the human's turn again
+        game = self.env.game
+        while not game.game_over and game.whose_action == 1:
+            valid = self.env.get_valid_actions(text=True)
+            self.env.step('coup' if 'coup' in valid else self.rng.choice(valid))
+
+
+class StubGame:
+    # Same interface as Human_v_Agent
+    def __init__(self, seed, p_first_turn=0):
+        rng = random.Random(seed)
+        self.env = StubEnv(rng, p_first_turn)
+        self.agent = StubAgent(self.env, rng)
+
+    def step(self, action):
+        self.env.step(action)
+        self.agent.step()
+
+
+def wait_for_step(board):
+    while board.runner.busy:
+        QThreadPool.globalInstance().waitForDone()
+        QCoreApplication.processEvents()
+
+
+def play(board, rng):
+    # Click through a game like a user would
+    wait_for_step(board)
+    while not board.env.game.game_over:
+        p1 = board.p1
+        if p1.num_selectable:
+            for card in [c for c in p1.card_slots if not c.is_eliminated][:p1.num_selectable]:
+                card.set_selected(True)
+            p1.check_selected()
+            board.confirm_btn.click()
+        else:
+            rng.choice([b for b in board.actions.buttons.values() if b.isEnabled()]).click()
+        wait_for_step(board)
+
+
+def new_board(seed):
+    board = Board()
+    board.attach_game(StubGame(seed, p_first_turn=seed % 2))
+    if seed % 2:
+        board.agent_step()
+    return board
+
+
+def delete(board):
+    board.deleteLater()
+    QCoreApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+
+
+def rss_mb():
+    # Current resident set size, falling back to the peak where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@pytest.fixture(scope='module')
+def qapp():
+    return QApplication.instance() or QApplication(sys.argv)
+
+
+def test_game(benchmark, qapp):
+    # A whole game clicked through the board, which must not leave widgets behind
+    rng = random.Random(0)
+    baseline = len(QApplication.allWidgets())
+    boards = []
+    widgets = []
+
+    def setup():
+        if boards:
+            widgets.append(len(QApplication.allWidgets()) - baseline)
+            delete(boards.pop())
+        boards.append(new_board(len(widgets)))
+        return (boards[-1], rng), {}
+
+    benchmark.pedantic(play, setup=setup, rounds=20)
+    widgets.append(len(QApplication.allWidgets()) - baseline)
+    delete(boards.pop())
+
+    benchmark.extra_info.update(widgets_per_game_max=max(widgets), rss_mb=round(rss_mb(), 1))
+    # Widgets are reused between refreshes, so every game has as many
+    assert len(set(widgets)) == 1
+    assert len(QApplication.allWidgets()) == baseline
+
+
+def test_refresh(benchmark, qapp):
+    # Rendering an observation that differs from the last one in every field
+    board = new_board(0)
+    try:
+        board.refresh()
+        benchmark(board.redraw)
+    finally:
+        delete(board)
+
+
+def first_paint_ms():
+    out = subprocess.run([sys.executable, os.path.join(app_dir, 'main.py'), '--startup-time'],
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.split()[-2])
+
+
+def test_startup(benchmark):
+    # Cold start, from spawning the app's process to its first paint
+    paints = []
+    benchmark.pedantic(lambda: paints.append(first_paint_ms()), rounds=3)
+    paint = sorted(paints)[len(paints) // 2]
+    benchmark.extra_info['first_paint_ms'] = paint
+    assert paint < startup_budget
+
+
+def test_board_loads_gym_coup_only_to_start_a_game():
+    code = 'import board, sys; sys.exit("coup_rl" in sys.modules)'
+    assert subprocess.run([sys.executable, '-c', code], cwd=app_dir).returncode == 0
@@ -0,0 +1,8 @@
+import coup_stub
+import sys
+
+try:
+    import coup_rl
+except ImportError:
+    # gym-coup isn't a pip package, so games are played on the stub in its place
+    sys.modules['coup_rl'] = coup_stub
@@ -0,0 +1,196 @@
+'''
+Stand-in for gym-coup's coup_rl module, which isn't a pip package.
+
+StubEnv is a reduced game of Coup with gym-coup's observation layout and
+numeric and text APIs: 4 card slots per player, 4 eliminated flags per
+player, coins and last actions. Human_v_Agent plays it with a tabular
+Q-learning agent saved in the app's agent file format, see agent_file.
+'''
+
+import numpy as np
+import os
+import random
+
+cards = ['none', 'Assassin', 'Ambassador', 'Captain', 'Contessa', 'Duke']
+actions = (['income', 'foreign_aid', 'coup', 'tax', 'assassinate', 'exchange', 'steal',
+            'pass', 'block_foreign_aid', 'block_steal_ambassador', 'block_steal_captain',
+            'block_assassinate', 'challenge',
+            'lose_card_1', 'lose_card_2', 'lose_card_3', 'lose_card_4']
+           + [f'exchange_return_{a}{b}' for a in range(1, 5) for b in range(a + 1, 5)])
+
+
+class ActionSpace:
+    n = len(actions)
+
+
+class StubGameState:
+    def __init__(self, p_first_turn):
+        self.game_over = False
+        self.whose_action = p_first_turn
+
+
+class StubEnv:
+    action_space = ActionSpace()
+
+    def __init__(self, rng, p_first_turn=0):
+        self.rng = rng
+        self.p_first_turn = p_first_turn
+        self.reset()
+
+    def reset(self):
+        rng = self.rng
+        self.game = StubGameState(self.p_first_turn)
+        self.p_cards = [[rng.choice(cards[1:]), rng.choice(cards[1:]), 'none', 'none'] for _ in range(2)]
+        # Empty slots count as eliminated
+        self.elim = [[0, 0, 1, 1] for _ in range(2)]
+        self.coins = [2, 2]
+        self.last = ['none', 'none']
+        # Player who has to lose a card, and whether they are mid exchange
+        self.losing = None
+        self.exchanging = False
+
+    def get_obs(self, text=False):
+        if text:
+            return (self.p_cards[0] + self.p_cards[1] + self.elim[0] + self.elim[1]
+                    + self.coins + self.last)
+        # Last actions are offset by one, 0 being no action yet
+        return ([cards.index(c) for c in self.p_cards[0] + self.p_cards[1]] + self.elim[0] + self.elim[1]
+                + self.coins + [0 if a == 'none' else actions.index(a) + 1 for a in self.last])
+
+    def alive(self, p):
+        return [i for i in range(4) if not self.elim[p][i]]
+
+    def get_valid_actions(self, text=False):
+        names = self._valid()
+        return names if text else [actions.index(a) for a in names]
+
+    def _valid(self):
+        p = self.game.whose_action
+        if self.losing == p:
+            return [f'lose_card_{i+1}' for i in self.alive(p)]
+        if self.exchanging:
+            held = [i for i in range(4) if self.p_cards[p][i] != 'none']
+            return [f'exchange_return_{held[a]+1}{held[b]+1}'
+                    for a in range(len(held)) for b in range(a+1, len(held))]
+        if self.coins[p] >= 10:
+            return ['coup']
+        valid = ['income', 'foreign_aid', 'tax']
+        if self.p_cards[p][2] == 'none':
+            valid.append('exchange')
+        if self.coins[p] >= 7:
+            valid.append('coup')
+        return valid
+
+    def step(self, action):
+        if not isinstance(action, str):
+            action = actions[action]
+        p = self.game.whose_action
+        o = 1 - p
+        self.last[p] = action
+
+        if action.startswith('lose_card'):
+            self.elim[p][int(action[-1]) - 1] = 1
+            self.losing = None
+            if not self.alive(p):
+                self.game.game_over = True
+                return
+        elif action.startswith('exchange_return'):
+            keep = [self.p_cards[p][i] for i in range(4)
+                    if self.p_cards[p][i] != 'none' and str(i+1) not in action[-2:]]
+            elim = [self.elim[p][i] for i in range(4)
+                    if self.p_cards[p][i] != 'none' and str(i+1) not in action[-2:]]
+            self.p_cards[p] = keep + ['none'] * (4 - len(keep))
+            self.elim[p] = elim + [1] * (4 - len(elim))
+            self.exchanging = False
+        elif action == 'exchange':
+            self.p_cards[p][2:] = [self.rng.choice(cards[1:]), self.rng.choice(cards[1:])]
+            self.elim[p][2:] = [0, 0]
+            self.exchanging = True
+            return
+        elif action == 'coup':
+            self.coins[p] -= 7
+            self.losing = o
+            self.game.whose_action = o
+            return
+        else:
+            self.coins[p] += {'income': 1, 'foreign_aid': 2, 'tax': 3}[action]
+
+        # Turn passes back to whoever didn't just act on their own turn
+        self.game.whose_action = o if not action.startswith('lose_card') else p
+
+
+class QAgent:
+    # Tabular Q-learning in the agent's seat, with a row per observation met
+    def __init__(self, env, filepath, is_training, lr, df, eps, rng):
+        self.env = env
+        self.filepath = filepath
+        self.is_training = is_training
+        self.rng = rng
+        self.rows = {}
+        self.q = np.zeros((0, len(actions)))
+        self.states = np.zeros((0, len(env.get_obs())), dtype=np.int64)
+        if os.path.exists(filepath):
+            with np.load(filepath) as f:
+                self.q = f['Q'].astype(np.float64)
+                self.states = f['states']
+                self.lr, self.df, self.eps = float(f['lr']), float(f['df']), float(f['eps'])
+            self.rows = {tuple(s): i for i, s in enumerate(self.states.tolist())}
+        elif None in (lr, df, eps):
+            raise ValueError('A new agent needs a learning rate, discount factor and epsilon')
+        else:
+            self.lr, self.df, self.eps = lr, df, eps
+        # Last (row, action), waiting for its outcome
+        self.pending = None
+
+    def row(self, obs):
+        key = tuple(obs)
+        if key not in self.rows:
+            self.rows[key] = len(self.rows)
+            self.q = np.vstack([self.q, np.zeros((1, len(actions)))])
+            self.states = np.vstack([self.states, np.array([obs], dtype=self.states.dtype)])
+        return self.rows[key]
+
+    def learn(self, reward, next_row=None, next_valid=()):
+        if self.pending is None or not self.is_training:
+            return
+        row, action = self.pending
+        future = max(self.q[next_row, next_valid]) if next_row is not None else 0.0
+        self.q[row, action] += self.lr * (reward + self.df * future - self.q[row, action])
+        self.pending = None
+
+    def step(self):
+        # Act until it's the human's turn again
+        env = self.env
+        while not env.game.game_over and env.game.whose_action == 1:
+            row = self.row(env.get_obs())
+            valid = env.get_valid_actions()
+            self.learn(0.0, row, valid)
+            if self.is_training and self.rng.random() < self.eps:
+                action = self.rng.choice(valid)
+            else:
+                action = max(valid, key=lambda a: self.q[row, a])
+            self.pending = (row, action)
+            env.step(action)
+        self.game_over()
+
+    def game_over(self):
+        if not self.env.game.game_over:
+            return
+        if self.pending is not None:
+            self.learn(1.0 if 0 not in self.env.get_obs()[8:12] else -1.0)
+        if self.is_training:
+            np.savez_compressed(self.filepath, Q=self.q, states=self.states,
+                                lr=self.lr, df=self.df, eps=self.eps)
+
+
+class Human_v_Agent:
+    def __init__(self, p_first_turn, filepath, is_training, learning_rate, discount_factor, epsilon,
+                 log_level=None, seed=None):
+        rng = random.Random(seed)
+        self.env = StubEnv(rng, p_first_turn)
+        self.agent = QAgent(self.env, filepath, is_training, learning_rate, discount_factor, epsilon, rng)
+
+    def step(self, action):
+        # Human's action by name, then the agent's reply
+        self.env.step(action)
+        self.agent.step()
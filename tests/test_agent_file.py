@@ -0,0 +1,98 @@
+import agent_file
+import numpy as np
+import os
+import pytest
+
+
+def arrays():
+    return {'Q': np.arange(12, dtype=np.float64).reshape(4, 3), 'eps': np.array(0.5)}
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_save_load_round_trip(tmp_path, compressed):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, arrays(), compressed)
+    loaded = agent_file.load_arrays(path)
+    assert loaded.keys() == arrays().keys()
+    for k, arr in arrays().items():
+        np.testing.assert_array_equal(loaded[k], arr)
+    assert agent_file.is_compressed(path) == compressed
+    # Only the agent file is left behind
+    assert os.listdir(tmp_path) == ['agent.npz']
+
+
+def test_uncompressed_arrays_are_mapped(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, arrays(), compressed=False)
+    info = agent_file.read_header(path)
+    assert info['Q'].shape == (4, 3) and info['Q'].offset is not None
+
+    mapped = agent_file.load_arrays(path, mmap_mode='c')
+    assert isinstance(mapped['Q'], np.memmap)
+    mapped['Q'][0, 0] = 100
+    # Copy-on-write, the file is unchanged
+    assert agent_file.load_arrays(path)['Q'][0, 0] == 0
+
+
+def test_read_header_rejects_other_files(tmp_path):
+    path = tmp_path / 'agent.npz'
+    path.write_bytes(b'not a zip')
+    with pytest.raises(ValueError):
+        agent_file.read_header(str(path))
+
+
+def test_failed_save_keeps_the_old_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, arrays())
+
+    def crash(f, **arrays):
+        f.write(b'partial')
+        raise OSError('disk full')
+    monkeypatch.setattr(np, 'savez_compressed', crash)
+    with pytest.raises(OSError):
+        agent_file.save_arrays(path, {'Q': np.zeros(2)})
+    monkeypatch.undo()
+    np.testing.assert_array_equal(agent_file.load_arrays(path)['Q'], arrays()['Q'])
+    assert os.listdir(tmp_path) == ['agent.npz']
+
+
+def test_diff_merge_round_trip():
+    base = arrays()
+    new = {'Q': base['Q'] + 1.5, 'eps': base['eps']}
+    other = {'Q': base['Q'] * 2, 'eps': base['eps']}
+    merged = agent_file.merge(dict(base), [agent_file.diff(base, new), agent_file.diff(base, other)])
+    np.testing.assert_array_equal(merged['Q'], base['Q'] + 1.5 + base['Q'])
+
+
+def table(states, q):
+    return {'Q': np.array(q, dtype=np.float64), 'states': np.array(states, dtype=np.int64),
+            'lr': np.array(0.5), 'df': np.array(0.5), 'eps': np.array(0.5)}
+
+
+def test_merge_adds_new_rows_by_state():
+    base = table([[0, 1], [0, 2]], [[1.0], [2.0]])
+    # Workers meet new states in different orders, one of them shared
+    first = table([[0, 1], [0, 2], [5, 5], [0, 3]], [[1.5], [2.0], [1.0], [3.0]])
+    second = table([[0, 1], [0, 2], [0, 3]], [[1.0], [1.0], [0.5]])
+    merged = agent_file.merge(dict(base), [agent_file.diff(base, first), agent_file.diff(base, second)])
+
+    rows = {tuple(s): q[0] for s, q in zip(merged['states'].tolist(), merged['Q'].tolist())}
+    assert rows == {(0, 1): 1.5, (0, 2): 1.0, (5, 5): 1.0, (0, 3): 3.5}
+
+
+def test_diff_matches_rows_not_positions():
+    base = table([[0, 1], [0, 2]], [[1.0], [2.0]])
+    new = table([[0, 2], [0, 1]], [[2.0], [4.0]])
+    delta = agent_file.diff(base, new)
+    np.testing.assert_array_equal(delta['Q'], [[3.0], [0.0]])
+    assert len(delta['new.states']) == 0
+
+
+def test_merge_into_read_only_maps(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    base = table([[0, 1]], [[1.0]])
+    agent_file.save_arrays(path, base, compressed=False)
+    mapped = agent_file.load_arrays(path, mmap_mode='r')
+    merged = agent_file.merge(mapped, [agent_file.diff(base, table([[0, 1], [0, 2]], [[2.0], [1.0]]))])
+    np.testing.assert_array_equal(merged['Q'], [[2.0], [1.0]])
+    np.testing.assert_array_equal(agent_file.load_arrays(path)['Q'], [[1.0]])
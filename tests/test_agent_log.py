@@ -0,0 +1,195 @@
+import agent_file
+import agent_log
+from agent_log import AgentLog, TrainingSession
+import numpy as np
+import os
+
+
+def changes(value):
+    return {'Q': (np.array([1, 4]), np.array([value, value + 1.0]))}
+
+
+def test_log_round_trip(tmp_path):
+    log = AgentLog(str(tmp_path / 'agent.npz.log'))
+    log.append(changes(1.0))
+    log.append(changes(5.0))
+    records = list(log.records())
+    assert len(records) == 2
+    np.testing.assert_array_equal(records[1]['Q'][1], [5.0, 6.0])
+
+    arrays = log.replay({'Q': np.zeros((2, 3))})
+    np.testing.assert_array_equal(arrays['Q'].reshape(-1), [0, 5, 0, 0, 6, 0])
+
+
+def test_torn_record_is_truncated(tmp_path):
+    log = AgentLog(str(tmp_path / 'agent.npz.log'))
+    log.append(changes(1.0))
+    good = os.path.getsize(log.path)
+    log.append(changes(2.0))
+    # A crash part way through the second record
+    with open(log.path, 'r+b') as f:
+        f.truncate(good + 10)
+
+    assert len(list(log.records())) == 1
+    assert os.path.getsize(log.path) == good
+    # Appends after the recovery are readable
+    log.append(changes(3.0))
+    assert [r['Q'][1][0] for r in log.records()] == [1.0, 3.0]
+
+
+def test_corrupt_record_is_dropped(tmp_path):
+    log = AgentLog(str(tmp_path / 'agent.npz.log'))
+    log.append(changes(1.0))
+    good = os.path.getsize(log.path)
+    log.append(changes(2.0))
+    with open(log.path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    assert len(list(log.records())) == 1
+    assert os.path.getsize(log.path) == good
+
+
+def train(session, q):
+    # What Human_v_Agent does after a training game
+    agent_file.save_arrays(session.work_path, {'Q': q})
+    session.record_game()
+
+
+def test_session_logs_and_compacts(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, {'Q': np.zeros((3, 2))})
+    session = TrainingSession(path)
+    q = agent_file.load_arrays(session.work_path)['Q']
+    q[1, 1] = 7
+    train(session, q)
+
+    # Logged, the agent file itself is untouched until compaction
+    assert os.path.exists(agent_log.log_path(path))
+    assert agent_file.load_arrays(path)['Q'][1, 1] == 0
+    session.close()
+    assert agent_file.load_arrays(path)['Q'][1, 1] == 7
+    assert not os.path.exists(agent_log.log_path(path))
+    assert not os.path.exists(session.work_path)
+
+
+def test_session_recovers_an_uncompacted_log(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, {'Q': np.zeros((3, 2))})
+    session = TrainingSession(path)
+    q = agent_file.load_arrays(session.work_path)['Q']
+    q[2, 0] = 3
+    train(session, q)
+    # Killed without closing
+
+    recovered = TrainingSession(path)
+    assert agent_file.load_arrays(recovered.work_path)['Q'][2, 0] == 3
+    recovered.close()
+    assert agent_file.load_arrays(path)['Q'][2, 0] == 3
+
+
+def test_checkpoints_rotate_and_restore(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, {'Q': np.zeros(2)})
+    session = TrainingSession(path)
+    session.checkpoint_every = 1
+    session.keep_checkpoints = 2
+    for n in range(1, 4):
+        train(session, np.full(2, float(n)))
+        session._snapshots.submit(lambda: None).result()
+    session.close()
+
+    checkpoints = agent_log.list_checkpoints(path)
+    assert len(checkpoints) == 2
+    # Newest first
+    assert agent_file.load_arrays(checkpoints[0])['Q'][0] == 3
+    agent_log.restore_checkpoint(checkpoints[1], path)
+    assert agent_file.load_arrays(path)['Q'][0] == 2
+
+
+def test_log_adds_rows(tmp_path):
+    log = AgentLog(str(tmp_path / 'agent.npz.log'))
+    log.append({'Q': (np.array([1, 4, 5]), np.array([1.0, 2.0, 3.0]))})
+    arrays = log.replay({'Q': np.zeros((1, 2))})
+    np.testing.assert_array_equal(arrays['Q'], [[0, 1], [0, 0], [2, 3]])
+
+
+def test_watched_session_logs_touched_rows(tmp_path):
+    import coup_stub
+    import headless
+    path = str(tmp_path / 'agent.npz')
+    headless.play_games(5, path, True, 0.5, 0.5, 0.5, seed=0, metrics=False)
+    assert not os.path.exists(agent_log.log_path(path))
+
+    session = TrainingSession(path)
+    game = coup_stub.Human_v_Agent(0, session.work_path, True, None, None, None, seed=1)
+    session.watch(game.env)
+    compared = []
+    entry_changes = agent_log.entry_changes
+    def spy(base, new, rows=None):
+        compared.append(rows)
+        return entry_changes(base, new, rows)
+    agent_log.entry_changes = spy
+    try:
+        for _ in range(3):
+            game.env.reset()
+            headless.play_game(game, headless.ScriptedOpponent())
+            session.record_game()
+    finally:
+        agent_log.entry_changes = entry_changes
+    # Table rows are compared for the touched states only
+    assert any(rows is not None and len(rows) < len(session.base['states']) for rows in compared)
+
+    # The log holds what the work file has
+    work = agent_file.load_arrays(session.work_path)
+    replayed = AgentLog(agent_log.log_path(path)).replay(agent_file.load_arrays(path))
+    for k in work:
+        np.testing.assert_array_equal(replayed[k], work[k])
+    session.close()
+    np.testing.assert_array_equal(agent_file.load_arrays(path)['Q'], work['Q'])
+
+
+def test_readers_compact_pending_training(tmp_path):
+    import book
+    path = str(tmp_path / 'agent.npz')
+    agent_file.save_arrays(path, {'Q': np.zeros((3, 2))})
+    session = TrainingSession(path)
+    q = agent_file.load_arrays(session.work_path)['Q']
+    q[0, 0] = 4
+    train(session, q)
+    # Killed without closing
+    before = book.fingerprint(path)
+    assert not os.path.exists(agent_log.log_path(path))
+    assert agent_file.load_arrays(path)['Q'][0, 0] == 4
+    np.testing.assert_array_equal(before, book.fingerprint(path))
+
+
+def test_restore_uses_its_own_temp_file(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    agent_file.save_arrays(path, {'Q': np.zeros(2)})
+    agent_file.save_arrays(checkpoint, {'Q': np.ones(2)})
+    # Left by an earlier version, or another restore
+    os.mkdir(f'{path}.tmp')
+    agent_log.restore_checkpoint(checkpoint, path)
+    assert agent_file.load_arrays(path)['Q'][0] == 1
+    assert sorted(os.listdir(tmp_path)) == ['agent.npz', 'agent.npz.tmp', 'checkpoint.npz']
+
+
+def test_every_waiter_waits_for_a_closing_session(tmp_path):
+    import threading
+    from concurrent.futures import Future
+    path = str(tmp_path / 'agent.npz')
+    closing = Future()
+    agent_log._closing[path] = closing
+    waited = []
+    threads = [threading.Thread(target=lambda: (agent_log.wait_closing(path), waited.append(closing.done())))
+               for _ in range(2)]
+    for t in threads:
+        t.start()
+    closing.set_result(None)
+    for t in threads:
+        t.join()
+    assert waited == [True, True]
+    assert path not in agent_log._closing
@@ -0,0 +1,47 @@
+import book
+import coup_stub
+import headless
+import numpy as np
+import random
+from board import new_game
+from policy import BatchPolicy, valid_mask
+
+
+def agent(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    headless.play_games(20, path, True, 0.5, 0.5, 0.5, seed=0, metrics=False)
+    return path
+
+
+def greedy(policy):
+    def choose(env):
+        mask = valid_mask([env.get_valid_actions()], policy.num_actions)
+        return policy.greedy(np.array([env.get_obs()]), mask)[0]
+    return choose
+
+
+def test_agent_book_plays_the_agents_own_moves(tmp_path):
+    path = agent(tmp_path)
+    policy = BatchPolicy.load(path)
+    envs = [coup_stub.StubEnv(random.Random(i), p) for i, p in enumerate((0, 1))]
+    built = book.build(envs, greedy(policy), plies=4, games=50, seed=0)
+    built.save(book.book_path(path), path)
+
+    game, _ = new_game(1, path, False)
+    assert hasattr(game.agent.step, '__wrapped__')
+    env = coup_stub.StubEnv(random.Random(5), 1)
+    for _ in range(50):
+        env.reset()
+        if built.get(env) is not None:
+            assert built.get(env) == greedy(policy)(env)
+
+
+def test_tree_search_book_is_not_used_for_an_agent(tmp_path):
+    path = agent(tmp_path)
+    envs = [coup_stub.StubEnv(random.Random(0), 1)]
+    # Saved without its source, as for the tree search opponent
+    book.build(envs, lambda env: env.get_valid_actions()[-1], plies=2, games=5).save(book.book_path(path))
+    assert book.OpeningBook.load(book.book_path(path), path) is None
+
+    game, _ = new_game(1, path, False)
+    assert not hasattr(game.agent.step, '__wrapped__')
@@ -0,0 +1,54 @@
+import coup_stub
+import random
+import sys
+import types
+from components import Decoder
+
+
+class CountingEnv(coup_stub.StubEnv):
+    # Counts calls to the text API
+    text_calls = 0
+
+    def get_obs(self, text=False):
+        CountingEnv.text_calls += text
+        return super().get_obs(text)
+
+    def get_valid_actions(self, text=False):
+        CountingEnv.text_calls += text
+        return super().get_valid_actions(text)
+
+
+def test_tables_come_from_the_game_lists():
+    decoder = Decoder()
+    env = CountingEnv(random.Random(0))
+    decoder.check(env)
+    assert decoder.learning is False
+
+    calls = CountingEnv.text_calls
+    for _ in range(20):
+        obs = env.get_obs()
+        decoder.learn_obs(env, obs)
+        valid = decoder.valid_actions(env)
+        text = env.get_obs(text=True)
+        assert [decoder.cards[c] for c in obs[0:8]] == [None if n == 'none' else n for n in text[0:8]]
+        assert [decoder.actions[a] for a in valid] == env.get_valid_actions(text=True)
+        env.step(random.Random(len(text)).choice(valid))
+        if env.game.game_over:
+            env.reset()
+    # Only the test's own text calls
+    assert CountingEnv.text_calls == calls + 40
+
+
+def test_falls_back_to_learning_when_lists_dont_match(monkeypatch):
+    # Lists in another order than the env's ids
+    monkeypatch.setitem(sys.modules, 'coup_rl', types.SimpleNamespace(cards=coup_stub.cards[::-1],
+                                                                    actions=coup_stub.actions))
+    decoder = Decoder()
+    env = coup_stub.StubEnv(random.Random(0))
+    decoder.check(env)
+    assert decoder.learning is True
+
+    obs = env.get_obs()
+    decoder.learn_obs(env, obs)
+    assert [decoder.cards[c] for c in obs[0:4]] == [n if n != 'none' else None
+                                                    for n in env.get_obs(text=True)[0:4]]
@@ -0,0 +1,34 @@
+import agent_log
+import headless
+import numpy as np
+import os
+from metrics import MetricsReader, metrics_path
+
+
+def test_training_is_logged_every_flush_every_games(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.npz')
+    records = []
+    record_game = agent_log.TrainingSession.record_game
+    def spy(session, games=1):
+        records.append(games)
+        return record_game(session, games)
+    monkeypatch.setattr(agent_log.TrainingSession, 'record_game', spy)
+
+    headless.play_games(10, path, True, 0.5, 0.5, 0.5, seed=0, metrics=False, flush_every=4)
+    # The last 2 games are logged at the end
+    assert records == [4, 4, 2]
+    assert os.path.exists(path)
+    assert not os.path.exists(agent_log.log_path(path))
+
+
+def test_human_v_agent_records_steps_and_updates(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    headless.play_games(10, path, True, 0.5, 0.5, 0.2, seed=0)
+    reader = MetricsReader(metrics_path(path))
+    games, steps, updates = (reader.read(t) for t in ('games', 'steps', 'updates'))
+    assert len(games['won']) == 10
+    assert len(steps['action']) >= 10 and set(steps['games'].tolist()) == set(range(10))
+    # The first game creates the agent, every later one moves some Q-values
+    assert len(updates['td_abs']) == 9
+    assert (updates['td_abs'] > 0).all() and (updates['epsilon'] == np.float32(0.2)).all()
+    assert updates['games'].tolist() == list(range(2, 11))
@@ -0,0 +1,41 @@
+import agent_file
+import os
+import parallel
+import pytest
+from metrics import MetricsReader, metrics_path
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_parallel_training_merges_new_states(tmp_path, compressed):
+    path = str(tmp_path / 'agent.npz')
+    parallel.run(1, path, True, 0.5, 0.5, 0.5, seed=0, workers=1)
+    if not compressed:
+        agent_file.convert(path)
+    rows = len(agent_file.load_arrays(path)['states'])
+
+    parallel.run(40, path, True, seed=1, workers=2, sync_every=10)
+    arrays = agent_file.load_arrays(path)
+    assert len(arrays['states']) > rows
+    assert len(arrays['Q']) == len(arrays['states'])
+    # Every state has one row
+    assert len({tuple(s) for s in arrays['states'].tolist()}) == len(arrays['states'])
+
+
+def test_parallel_play_leaves_agent_alone(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    parallel.run(1, path, True, 0.5, 0.5, 0.5, seed=0, workers=1)
+    mtime = os.stat(path).st_mtime_ns
+    parallel.run(10, path, False, seed=1, workers=2, sync_every=5)
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_parallel_training_records_metrics(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    parallel.run(1, path, True, 0.5, 0.5, 0.5, seed=0, workers=1)
+    parallel.run(40, path, True, seed=1, workers=2, sync_every=10)
+    reader = MetricsReader(metrics_path(path))
+    assert len(reader.read('games')['won']) == 40
+    assert len(reader.read('steps')['action']) >= 40
+    updates = reader.read('updates')
+    assert updates['games'].tolist() == [20, 40]
+    assert (updates['td_abs'] > 0).all()
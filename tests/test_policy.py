@@ -0,0 +1,85 @@
+import agent_file
+import coup_stub
+import headless
+import numpy as np
+import pytest
+import random
+from policy import BatchPolicy, encode
+
+
+def test_batch_policy_round_trip(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    policy = BatchPolicy(coup_stub.ActionSpace.n, 0.1, 0.9, 0.2, seed=0)
+    env = coup_stub.StubEnv(random.Random(0))
+    obs = np.array([env.get_obs()])
+    policy.q[policy.rows(obs), 3] = 1.5
+    policy.save(path)
+
+    loaded = BatchPolicy.load(path)
+    assert (loaded.learning_rate, loaded.discount_factor, loaded.epsilon) == (0.1, 0.9, 0.2)
+    assert loaded.q[loaded.rows(obs), 3] == 1.5
+    assert (loaded.arrays()['states'] == obs).all()
+
+
+def test_encode_keeps_every_coin():
+    obs = np.zeros((2, 20), dtype=np.int64)
+    obs[:, 16] = [10, 12]
+    keys = encode(obs)
+    assert keys[0] != keys[1]
+
+
+def test_human_v_agent_plays_batch_trained_agent(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    envs = [coup_stub.StubEnv(random.Random(i)) for i in range(4)]
+    headless.play_batch(50, path, True, 0.5, 0.5, 0.5, seed=0, envs=envs, metrics=False)
+    assert set(agent_file.check_agent(path)) >= {'Q', 'states', 'lr', 'df', 'eps'}
+
+    game = coup_stub.Human_v_Agent(0, path, True, None, None, None, seed=0)
+    rows = len(game.agent.rows)
+    assert rows == len(BatchPolicy.load(path).index) > 0
+    headless.play_game(game, headless.ScriptedOpponent())
+
+    # And back, with the rows Human_v_Agent added
+    policy = BatchPolicy.load(path)
+    assert len(policy.index) == len(game.agent.rows) >= rows
+    headless.play_batch(10, path, True, seed=1, envs=envs, metrics=False)
+    assert len(BatchPolicy.load(path).index) >= len(game.agent.rows)
+
+
+def test_rejects_other_formats(tmp_path):
+    legacy = str(tmp_path / 'legacy.npz')
+    np.savez(legacy, q=np.zeros((1, 3)), keys=np.zeros(1, dtype=np.uint64), params=np.array([0.5, 0.5, 0.5]))
+    other = str(tmp_path / 'other.npz')
+    np.savez(other, weights=np.zeros(3))
+
+    for path in (legacy, other):
+        with pytest.raises(ValueError):
+            BatchPolicy.load(path)
+        with pytest.raises(ValueError):
+            BatchPolicy(3).save(path)
+        with pytest.raises(ValueError):
+            headless.play_batch(1, path, True, envs=[coup_stub.StubEnv(random.Random(0))], metrics=False)
+    with np.load(legacy) as f:
+        assert 'keys' in f.files
+
+
+def test_encode_rejects_other_widths():
+    with pytest.raises(ValueError):
+        encode(np.zeros((1, 21), dtype=np.int64))
+    with pytest.raises(ValueError):
+        encode(np.zeros((1, 19), dtype=np.int64))
+
+
+def test_saved_tables_are_narrowed(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    states = np.zeros((2, 20), dtype=np.int64)
+    states[1, 16] = 5
+    np.savez(path, Q=np.ones((2, 3)), states=states, lr=0.5, df=0.5, eps=0.5)
+    BatchPolicy.load(path).save(path)
+    info = agent_file.check_agent(path)
+    assert info['Q'].dtype == np.float32 and info['states'].dtype == np.uint8
+
+    np.savez(path, Q=np.ones((2, 3)), states=states, lr=0.5, df=0.5, eps=0.5)
+    agent_file.convert(path)
+    arrays = agent_file.load_arrays(path)
+    assert arrays['Q'].dtype == np.float32 and (arrays['states'] == states).all()
@@ -0,0 +1,43 @@
+import agent_file
+import headless
+import numpy as np
+import os
+from agent_log import TrainingSession
+from policy import PolicyGame
+from prefetch import AgentCache
+
+
+def new_agent(path):
+    headless.play_games(5, path, True, 0.5, 0.5, 0.5, seed=0, metrics=False)
+    agent_file.convert(path)
+
+
+def test_training_prefetch_only_reads_the_header(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    new_agent(path)
+    form = (0, path, True, None, None, None)
+    cache = AgentCache()
+    cache.prefetch(form)
+    assert set(cache._future.result()) >= {'Q', 'states'}
+
+    game, training = cache.take(form)
+    assert isinstance(training, TrainingSession)
+    assert os.path.exists(training.work_path)
+    training.close()
+
+
+def test_play_prefetch_maps_the_table(tmp_path):
+    path = str(tmp_path / 'agent.npz')
+    new_agent(path)
+    form = (1, path, False, None, None, None)
+    cache = AgentCache()
+    cache.prefetch(form)
+    game, training = cache.take(form)
+    assert training is None
+    assert isinstance(game, PolicyGame)
+    # Q-values are paged in from the file as states are met
+    assert isinstance(game.agent.policy.q, np.memmap)
+
+    game.agent.step()
+    headless.play_game(game, headless.ScriptedOpponent())
+    assert game.env.game.game_over
@@ -0,0 +1,58 @@
+import replay
+from replay import GameRecord, ReplayFile
+import os
+import random
+
+
+def states(steps, seed=0):
+    # Text observations plus whose_action and game_over, as state_of records them
+    rng = random.Random(seed)
+    cards = ['Duke', 'Captain', 'Assassin', 'Contessa', 'Ambassador']
+    state = (['Duke', 'Captain', 'none', 'none', 'Assassin', 'Contessa', 'none', 'none']
+             + [0, 0, 1, 1, 0, 0, 1, 1] + [2, 2, 'none', 'none', 0, 0])
+    out = []
+    for n in range(steps):
+        state = list(state)
+        state[rng.randrange(8)] = rng.choice(cards)
+        state[16 + n % 2] = rng.randrange(13)
+        # A name outside the fixed vocabulary, stored with the game
+        state[18 + n % 2] = rng.choice(['tax', 'income', 'block_steal_captain'])
+        state[20] = n % 2
+        state[21] = int(n == steps - 1)
+        out.append(state)
+    return out
+
+
+def test_replays_round_trip(tmp_path):
+    path = str(tmp_path / 'replays.coup')
+    games = [states(n, seed=n) for n in (1, replay.snapshot_every, 3 * replay.snapshot_every + 5)]
+    replays = ReplayFile(path)
+    for n, game in enumerate(games):
+        record = GameRecord()
+        record.states = game
+        replays.append(record, user_won=n % 2 == 0)
+
+    replays = ReplayFile(path)
+    assert len(replays) == len(games)
+    for n, game in enumerate(games):
+        rec = replays.game(n)
+        assert rec.user_won == (n % 2 == 0)
+        assert [rec.state(i) for i in range(rec.num_steps)] == game
+
+
+def test_torn_replay_is_dropped_and_reindexed(tmp_path):
+    path = str(tmp_path / 'replays.coup')
+    replays = ReplayFile(path)
+    for n in range(3):
+        record = GameRecord()
+        record.states = states(10, seed=n)
+        replays.append(record, user_won=True)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    os.remove(replays.index_path)
+
+    replays = ReplayFile(path)
+    assert len(replays) == 2
+    assert replays.game(1).state(9) == states(10, seed=1)[9]
+    # The rebuilt index is used next time
+    assert ReplayFile(path).offsets == replays.offsets
@@ -0,0 +1,149 @@
+import agent_file
+import asyncio
+import contextlib
+import coup_stub
+import headless
+import numpy as np
+import os
+import pytest
+import random
+import threading
+import time
+from client import RemoteGame
+from policy import BatchPolicy, Overlay
+from server import GameServer
+
+
+@contextlib.contextmanager
+def serving(server):
+    # Runs server on 127.0.0.1 in a thread, yields its address for RemoteGame
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve('127.0.0.1', 0))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while server.address is None and thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        host, port = server.address
+        yield f'{host}:{port}'
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join(10)
+
+
+def play(address, games, seed, p_first_turn=0):
+    rng = random.Random(seed)
+    game = RemoteGame(address, p_first_turn)
+    try:
+        for n in range(games):
+            if n:
+                game.env.reset()
+            while not game.env.game.game_over:
+                if game.env.game.whose_action == 0:
+                    game.step(rng.choice(game.env.get_valid_actions()))
+                else:
+                    game.agent.step()
+    finally:
+        game.close()
+
+
+def play_clients(address, clients, games):
+    errors = []
+    def run(i):
+        try:
+            play(address, games, seed=i, p_first_turn=i % 2)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(60)
+    assert not errors
+
+
+def agent(tmp_path):
+    # An agent file as Human_v_Agent trains it
+    path = str(tmp_path / 'agent.npz')
+    headless.play_games(5, path, True, 0.5, 0.5, 0.5, seed=0, metrics=False)
+    return path
+
+
+def test_server_trains_and_saves_an_agent_file(tmp_path):
+    path = agent(tmp_path)
+    rows = len(agent_file.load_arrays(path)['states'])
+    server = GameServer(BatchPolicy.load(path), batch_wait=0.001, is_training=True, filepath=path, save_every=4)
+    with serving(server) as address:
+        play_clients(address, clients=4, games=3)
+        assert server.finished_games == 12
+        # Saved every 4 games while serving
+        server._saving.result()
+        assert len(agent_file.check_agent(path)['states'].shape) == 2
+    assert server.batches > 0 and server.agent_steps >= server.batches
+
+    # The final save is in the format Human_v_Agent loads
+    assert len(agent_file.load_arrays(path)['states']) > rows
+    game = coup_stub.Human_v_Agent(0, path, False, None, None, None, seed=0)
+    assert len(game.agent.rows) == len(BatchPolicy.load(path).index)
+
+
+def test_server_without_training_leaves_the_agent(tmp_path):
+    path = agent(tmp_path)
+    mtime = os.stat(path).st_mtime_ns
+    server = GameServer(BatchPolicy.load(path), batch_wait=0.001, filepath=path, save_every=1)
+    with serving(server) as address:
+        play_clients(address, clients=3, games=2)
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_every_clients_updates_reach_the_saved_file(tmp_path, monkeypatch):
+    path = agent(tmp_path)
+    policy = BatchPolicy.load(path)
+    start = np.array(policy.q[:len(policy.index)])
+    merged = []
+    merge = Overlay.merge
+    def spy(overlay):
+        merged.append({row: delta.copy() for row, delta in overlay.deltas.items()})
+        return merge(overlay)
+    monkeypatch.setattr(Overlay, 'merge', spy)
+
+    server = GameServer(policy, batch_wait=0.001, is_training=True, filepath=path, save_every=1000)
+    with serving(server) as address:
+        play_clients(address, clients=2, games=1)
+    assert len(merged) == 2 and all(merged)
+
+    saved = agent_file.load_arrays(path)
+    expected = np.zeros(saved['Q'].shape)
+    expected[:len(start)] = start
+    for deltas in merged:
+        for row, delta in deltas.items():
+            expected[row] += delta
+    np.testing.assert_allclose(saved['Q'], expected, rtol=1e-6, atol=1e-6)
+    # Human_v_Agent sees both games' training
+    game = coup_stub.Human_v_Agent(0, path, False, None, None, None, seed=0)
+    np.testing.assert_allclose(game.agent.q, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_overlays_on_the_same_rows_both_count(tmp_path):
+    path = agent(tmp_path)
+    policy = BatchPolicy.load(path)
+    before = np.array(policy.q[:2])
+    first, second = Overlay(policy), Overlay(policy)
+    first.add(np.array([0, 1]), np.array([2, 3]), np.array([0.5, 1.0]))
+    second.add(np.array([0]), np.array([2]), np.array([0.25]))
+    first.merge()
+    second.merge()
+    policy.save(path)
+
+    game = coup_stub.Human_v_Agent(0, path, False, None, None, None, seed=0)
+    assert game.agent.q[0, 2] == pytest.approx(before[0, 2] + 0.75)
+    assert game.agent.q[1, 3] == pytest.approx(before[1, 3] + 1.0)
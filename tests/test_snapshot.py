@@ -0,0 +1,45 @@
+from snapshot import Snapshot
+
+
+class Game:
+    def __init__(self):
+        self.turn = 0
+        self.hands = [['Duke'], ['Captain']]
+
+
+class Env:
+    def __init__(self):
+        self.game = Game()
+
+    def step(self, action):
+        self.game.turn += 1
+        self.game.hands[0].append(action)
+
+
+def test_restore_puts_the_env_back_in_place():
+    env = Env()
+    game = env.game
+    snap = Snapshot(env)
+    env.step('Tax')
+    # A wrapper set on the instance, like the board's replay recording
+    calls = []
+    step = env.step
+    env.step = lambda action: calls.append(action) or step(action)
+
+    snap.restore(env)
+    assert env.game.turn == 0 and env.game.hands == [['Duke'], ['Captain']]
+    assert env.game is not game
+    env.step('Coup')
+    assert calls == ['Coup']
+
+
+def test_branches_are_independent():
+    env = Env()
+    env.step('Tax')
+    snap = Snapshot(env)
+    a, b = snap.branch(), snap.branch()
+    a.step('Coup')
+    assert a.game.hands[0] == ['Duke', 'Tax', 'Coup']
+    assert b.game.hands[0] == ['Duke', 'Tax']
+    assert env.game.turn == 1
+    assert type(a) is Env and len(snap) > 0
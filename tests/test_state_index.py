@@ -0,0 +1,36 @@
+from policy import StateIndex, encode
+import numpy as np
+
+
+def test_lookup_adds_rows_in_order():
+    index = StateIndex()
+    keys = np.array([7, 3, 7, 9], dtype=np.uint64)
+    rows = index.lookup(keys)
+    assert len(index) == 3
+    assert rows[0] == rows[2]
+    np.testing.assert_array_equal(index.keys[rows], keys)
+    np.testing.assert_array_equal(index.find(np.array([9, 4], dtype=np.uint64)), [rows[3], -1])
+
+
+def test_index_grows_past_its_slots():
+    keys = np.arange(5000, dtype=np.uint64) * np.uint64(2654435761)
+    index = StateIndex()
+    rows = index.lookup(keys)
+    np.testing.assert_array_equal(rows, np.arange(5000))
+    np.testing.assert_array_equal(index.find(keys), np.arange(5000))
+
+
+def test_index_round_trips_through_its_arrays():
+    keys = np.arange(100, dtype=np.uint64) * np.uint64(31)
+    index = StateIndex(keys)
+    shared = StateIndex.from_arrays({k: v.copy() for k, v in index.arrays().items()})
+    np.testing.assert_array_equal(shared.find(keys), np.arange(100))
+    assert shared.find(np.array([1], dtype=np.uint64))[0] == -1
+
+
+def test_encode_keeps_states_apart():
+    obs = np.zeros((3, 20), dtype=np.int64)
+    obs[1, 0] = 1
+    obs[2, 19] = 1
+    keys = encode(obs)
+    assert len(set(keys.tolist())) == 3
@@ -0,0 +1,61 @@
+import coup_stub
+import headless
+import numpy as np
+import os
+import random
+import tournament
+from policy import mirror
+
+
+def test_list_agents_reads_human_v_agent_files(tmp_path):
+    headless.play_games(3, str(tmp_path / 'trained.npz'), True, 0.5, 0.5, 0.5, seed=0, metrics=False)
+    np.savez(str(tmp_path / 'legacy.npz'), q=np.zeros((1, 3)), keys=np.zeros(1, dtype=np.uint64),
+             params=np.array([0.5, 0.5, 0.5]))
+    np.savez(str(tmp_path / 'other.npz'), weights=np.zeros(3))
+    assert tournament.list_agents(str(tmp_path)) == [str(tmp_path / 'trained.npz')]
+
+
+def test_fit_orders_known_strengths():
+    theta = np.array([1.0, 0.0, -1.0])
+    p = 1 / (1 + np.exp(theta[None, :] - theta[:, None]))
+    games = np.full((3, 3), 400.0)
+    np.fill_diagonal(games, 0)
+    fitted, cov = tournament.fit(p * games, games)
+    assert list(np.argsort(-fitted)) == [0, 1, 2]
+    np.testing.assert_allclose(fitted, theta, atol=0.1)
+    np.testing.assert_allclose(cov, cov.T)
+    assert (np.linalg.eigvalsh(cov) > -1e-12).all()
+
+
+def agent_states(games=2000, seed=0):
+    # States the agent's seat meets in random games, as the agent sees them from either seat
+    env = coup_stub.StubEnv(random.Random(seed))
+    rng = random.Random(seed)
+    states = set()
+    for _ in range(games):
+        env.reset()
+        while not env.game.game_over:
+            obs = np.array([env.get_obs()])
+            states.add(tuple((obs if env.game.whose_action == 1 else mirror(obs))[0]))
+            env.step(rng.choice(env.get_valid_actions()))
+    return np.array(sorted(states))
+
+
+def test_stronger_agent_outranks_weaker(tmp_path):
+    states = agent_states()
+    # Taxes and coups as soon as it can, where the weaker agent takes income
+    strong = np.zeros((len(states), coup_stub.ActionSpace.n))
+    strong[:, coup_stub.actions.index('tax')] = 1
+    strong[:, coup_stub.actions.index('coup')] = 2
+    for name, q in [('strong', strong), ('weak', np.zeros_like(strong))]:
+        np.savez(str(tmp_path / f'{name}.npz'), Q=q, states=states, lr=0.5, df=0.5, eps=0.0)
+
+    paths = tournament.list_agents(str(tmp_path))
+    scores, played = tournament.run(paths, games=40, workers=1)
+    theta, cov = tournament.fit(scores, played)
+    s, w = paths.index(str(tmp_path / 'strong.npz')), paths.index(str(tmp_path / 'weak.npz'))
+    # Ahead by more than two standard errors of the difference
+    assert theta[s] - theta[w] > 2 * np.sqrt(cov[s, s] + cov[w, w] - 2 * cov[s, w])
+    rows = tournament.leaderboard(paths, scores, played)
+    assert os.path.basename(rows[0][1]) == 'strong.npz'
+    assert rows[0][3] > rows[1][4]
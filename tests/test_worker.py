@@ -0,0 +1,22 @@
+import coup_stub
+import threading
+from worker import StepTask
+
+
+def test_step_waits_for_after():
+    game = coup_stub.Human_v_Agent(1, 'unused.npz', False, 0.5, 0.5, 0.5, seed=0)
+    order = []
+    recorded = threading.Event()
+    def after():
+        recorded.wait()
+        order.append('recorded')
+    task = StepTask(0, game, after=after)
+    game.agent.step = lambda: order.append('step')
+
+    thread = threading.Thread(target=task.run)
+    thread.start()
+    assert not task.done.wait(0.05)
+    recorded.set()
+    assert task.done.wait(5)
+    thread.join()
+    assert order == ['recorded', 'step']
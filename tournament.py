@@ -0,0 +1,277 @@
+'''
+Round-robin tournament between saved agents, rated on the Elo scale.
+
+Every pair of agents plays a match of games, alternating seats and first
+turns, across a pool of processes. An agent in the human's seat sees the
+game mirrored, as if it were in the agent's seat it was trained in.
+
+Each agent's Q-table and state index are exported once as uncompressed
+.npy files, which workers memory-map read-only, so the tables are shared
+through the page cache however many processes play them. Pairs are handed
+out in small chunks, so workers that finish early take more.
+
+Ratings are the maximum likelihood fit of a Bradley-Terry model to all
+results at once, so they don't depend on the order matches finished in.
+Draws count as half a win for each side.
+
+    $ python app/tournament.py agents/ --games 20 --out leaderboard.csv
+'''
+
+import agent_file
+from policy import BatchPolicy, StateIndex, encode, mirror, valid_mask
+import numpy as np
+import argparse
+import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+
+logger = logging.getLogger('app')
+
+# Elo points per unit of Bradley-Terry strength
+elo_scale = 400 / math.log(10)
+
+# Each pool process's envs and the agents it has mapped
+_envs = {}
+_agents = {}
+_shared_dir = None
+
+
+def list_agents(dirpath):
+    '''
+    Agent files in dirpath, trained by Human_v_Agent or with --batch in
+    main.py. Other .npz files are skipped.
+    '''
+    paths = []
+    for name in sorted(os.listdir(dirpath)):
+        path = os.path.join(dirpath, name)
+        if not name.endswith('.npz') or not os.path.isfile(path):
+            continue
+        try:
+            agent_file.check_agent(path)
+        except ValueError as e:
+            logger.warning(f'Skipping {path}: {e}')
+            continue
+        paths.append(path)
+    return paths
+
+
+def _export(task):
+    path, dirpath = task
+    policy = BatchPolicy.load(path)
+    arrays = policy.index.arrays()
+    arrays['q'] = policy.q[:len(policy.index)]
+    agent_file.export_npy(arrays, dirpath)
+
+
+class Contestant:
+    # Greedy, read-only player of an agent's table
+    def __init__(self, dirpath):
+        arrays = agent_file.open_npy(dirpath)
+        self.q = arrays['q']
+        self.index = StateIndex.from_arrays(arrays)
+
+    def act(self, obs, mask):
+        rows = self.index.find(encode(obs))
+        # States the agent never met have all-zero Q-values, as when it's training
+        q = np.where((rows >= 0)[:, None], self.q[np.maximum(rows, 0)], 0.0)
+        return np.where(mask, q, -np.inf).argmax(axis=1)
+
+
+def _agent(i):
+    if i not in _agents:
+        _agents[i] = Contestant(os.path.join(_shared_dir, str(i)))
+    return _agents[i]
+
+
+def _get_envs(p_first_turn, n):
+    from headless import new_envs
+    envs = _envs.setdefault(p_first_turn, [])
+    if len(envs) < n:
+        envs.extend(new_envs(n - len(envs), p_first_turn))
+    return envs[:n]
+
+
+def play_match(a, b, games, max_turns=500):
+    '''
+    Play games between two Contestants at once, each taking both seats and
+    moving first equally often. A game still going after max_turns is a draw.
+    Returns a's score, its wins plus half of the draws
+    '''
+    envs = []
+    # (human's seat, agent's seat) of each env
+    seats = []
+    for p_first_turn in (0, 1):
+        n = games // 2 + (p_first_turn < games % 2)
+        envs += _get_envs(p_first_turn, n)
+        seats += [(b, a) if i % 2 else (a, b) for i in range(n)]
+    for env in envs:
+        env.reset()
+
+    turns = [0] * len(envs)
+    live = list(range(len(envs)))
+    score = 0.0
+    while live:
+        for seat in (0, 1):
+            for player in (a, b):
+                move = [i for i in live if envs[i].game.whose_action == seat and seats[i][seat] is player]
+                if not move:
+                    continue
+                obs = np.array([envs[i].get_obs() for i in move])
+                mask = valid_mask([envs[i].get_valid_actions() for i in move], player.q.shape[1])
+                actions = player.act(mirror(obs) if seat == 0 else obs, mask)
+                for i, action in zip(move, actions.tolist()):
+                    envs[i].step(action)
+                    turns[i] += 1
+
+        still = []
+        for i in live:
+            env = envs[i]
+            if env.game.game_over:
+                # Agent's seat won if all of the human seat's cards are eliminated
+                winner = 1 if 0 not in env.get_obs(text=True)[8:12] else 0
+                score += seats[i][winner] is a
+            elif turns[i] >= max_turns:
+                score += 0.5
+            else:
+                still.append(i)
+        live = still
+    return score
+
+
+def _play(task):
+    i, j, games, max_turns = task
+    return i, j, play_match(_agent(i), _agent(j), games, max_turns)
+
+
+def _init(shared_dir):
+    global _shared_dir
+    _shared_dir = shared_dir
+
+
+def fit(scores, games, prior=1.0, iterations=1000, tol=1e-9):
+    '''
+    Bradley-Terry strengths by minorization-maximization.
+    scores: Array (agents, agents), score of the row agent against the column agent
+    games:  Array (agents, agents), games played between them
+    prior:  Virtual wins and losses of each agent against an average opponent,
+            keeping the fit finite for agents that won or lost every game
+    Returns (strengths, covariance), both relative to the mean strength
+    '''
+    n = len(scores)
+    wins = scores.sum(axis=1) + prior
+    gamma = np.ones(n)
+    for _ in range(iterations):
+        denom = (games / (gamma[:, None] + gamma[None, :])).sum(axis=1) + 2 * prior / (gamma + 1)
+        new = wins / denom
+        done = np.abs(new - gamma).max() < tol
+        gamma = new
+        if done:
+            break
+
+    # Fisher information, the prior's virtual opponent pinning down the scale
+    theta = np.log(gamma)
+    p = 1 / (1 + np.exp(theta[None, :] - theta[:, None]))
+    info = -games * p * p.T
+    p0 = 1 / (1 + np.exp(-theta))
+    np.fill_diagonal(info, 0)
+    info[np.diag_indices(n)] = -info.sum(axis=1) + 2 * prior * p0 * (1 - p0)
+    # Relative to the mean, the virtual opponent's strength drops out
+    centre = np.eye(n) - 1 / n
+    return centre @ theta, centre @ np.linalg.inv(info) @ centre.T
+
+
+def leaderboard(paths, scores, games, z=1.96):
+    '''
+    Returns rows of (rank, agent, elo, low, high, games, score) by descending
+    Elo, with low and high the bounds of its z standard error interval
+    '''
+    theta, cov = fit(scores, games)
+    elo = 1500 + elo_scale * theta
+    err = z * elo_scale * np.sqrt(np.maximum(np.diag(cov), 0))
+    order = np.argsort(-elo)
+    elo, err = elo.tolist(), err.tolist()
+    return [(rank, paths[i], round(elo[i], 1), round(elo[i] - err[i], 1), round(elo[i] + err[i], 1),
+             int(games[i].sum()), float(scores[i].sum()))
+            for rank, i in enumerate(order.tolist(), 1)]
+
+
+def run(paths, games=20, workers=None, max_turns=500):
+    '''
+    Play every pair of agents.
+    paths:     Agent files, see list_agents
+    games:     Games per pair
+    workers:   Processes to play in. Defaults to the CPU count. With 1,
+               matches are played in the calling process.
+    max_turns: Turns after which a game is a draw
+    Returns (scores, games), arrays (agents, agents) as fit takes
+    '''
+    n = len(paths)
+    workers = workers or os.cpu_count()
+    scores = np.zeros((n, n))
+    played = np.zeros((n, n))
+    pairs = [(i, j, games, max_turns) for i, j in itertools.combinations(range(n), 2)]
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exports = [(path, os.path.join(tmp, str(i))) for i, path in enumerate(paths)]
+        if workers == 1:
+            pool = None
+            _init(tmp)
+            for task in exports:
+                _export(task)
+            results = map(_play, pairs)
+        else:
+            pool = multiprocessing.Pool(workers, _init, (tmp,))
+            pool.map(_export, exports, chunksize=1)
+            # Several chunks per worker, so none sits idle at the end
+            chunksize = max(1, len(pairs) // (workers * 16))
+            results = pool.imap_unordered(_play, pairs, chunksize)
+
+        try:
+            for done, (i, j, score) in enumerate(results, 1):
+                scores[i, j] += score
+                scores[j, i] += games - score
+                played[i, j] += games
+                played[j, i] += games
+                if done % max(1, len(pairs) // 10) == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f'{done}/{len(pairs)} matches, {done * games / elapsed:.1f} games/s')
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _agents.clear()
+    return scores, played
+
+
+def write_leaderboard(path, rows):
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['rank', 'agent', 'elo', 'low', 'high', 'games', 'score'])
+        out.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rate saved agents against each other')
+    parser.add_argument('agents', help='Directory of agent files')
+    parser.add_argument('--games', type=int, default=20, help='Games per pair of agents')
+    parser.add_argument('--workers', type=int, default=0, help='Processes to play in, 0 for one per CPU')
+    parser.add_argument('--max-turns', type=int, default=500, help='Turns after which a game is a draw')
+    parser.add_argument('--out', default='leaderboard.csv', metavar='FILE', help='Leaderboard .csv file')
+    parser.add_argument('--top', type=int, default=20, help='Leaderboard rows to print')
+    args = parser.parse_args()
+
+    paths = list_agents(args.agents)
+    if len(paths) < 2:
+        parser.error(f'Found {len(paths)} agents in {args.agents}, need at least 2')
+    scores, played = run(paths, args.games, args.workers or None, args.max_turns)
+    rows = leaderboard(paths, scores, played)
+    write_leaderboard(args.out, rows)
+    print(f'{"rank":>4}  {"elo":>7}  {"95% interval":>15}  agent')
+    for rank, path, elo, low, high, _, _ in rows[:args.top]:
+        print(f'{rank:>4}  {elo:>7.1f}  {low:>7.1f}-{high:<7.1f}  {os.path.basename(path)}')
+    print(f'Wrote {len(rows)} agents to {args.out}')
@@ -0,0 +1,104 @@
+from board import *
+
+
+class ReplayState:
+    def __init__(self):
+        self.whose_action = 0
+        self.game_over = False
+
+
+class ReplayEnv:
+    # Stands in for the gym env, showing one recorded step
+    def __init__(self):
+        self.game = ReplayState()
+        self.obs = None
+
+    def show(self, state):
+        self.obs = state[:-2]
+        self.game.whose_action, self.game.game_over = state[-2], bool(state[-1])
+
+    def get_obs(self, text=True):
+        return self.obs
+
+    def get_valid_actions(self, text=True):
+        # Nothing can be played in a replay
+        return []
+
+
+class ReplayGame:
+    # Same interface as Human_v_Agent, for Board
+    def __init__(self, state):
+        self.env = ReplayEnv()
+        self.env.show(state)
+        self.agent = self
+
+    def step(self, action=None):
+        raise RuntimeError('Replays can\'t be played')
+
+
+class ReplayViewer(QWidget):
+    def __init__(self, replays):
+        '''
+        replays: replay.ReplayFile to browse
+        Steps are shown with the game's Board, from the human player's side.
+        '''
+        super().__init__()
+        self.replays = replays
+        self.replay = None
+        self.layout = QVBoxLayout()
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel('Game'))
+        self.game_box = QSpinBox()
+        self.game_box.setRange(1, max(1, len(replays)))
+        self.game_box.valueChanged.connect(self.load_game)
+        controls.addWidget(self.game_box)
+        controls.addWidget(QLabel(f'of {len(replays)}'))
+
+        self.prev_btn = QPushButton('<', self)
+        self.prev_btn.setFixedWidth(30)
+        self.prev_btn.clicked.connect(lambda: self.step_slider.setValue(self.step_slider.value() - 1))
+        controls.addWidget(self.prev_btn)
+        self.step_slider = QSlider(Qt.Orientation.Horizontal)
+        self.step_slider.valueChanged.connect(self.show_step)
+        controls.addWidget(self.step_slider)
+        self.next_btn = QPushButton('>', self)
+        self.next_btn.setFixedWidth(30)
+        self.next_btn.clicked.connect(lambda: self.step_slider.setValue(self.step_slider.value() + 1))
+        controls.addWidget(self.next_btn)
+        self.step_lbl = QLabel('', self)
+        controls.addWidget(self.step_lbl)
+        self.layout.addLayout(controls)
+
+        self.board = Board()
+        self.board.can_rematch = False
+        self.layout.addWidget(self.board)
+        self.setLayout(self.layout)
+
+        if len(replays):
+            self.load_game(1)
+        else:
+            self.step_slider.setEnabled(False)
+            self.step_lbl.setText('No games recorded yet')
+
+    def load_game(self, n):
+        self.replay = self.replays.game(n - 1)
+        self.board.attach_game(ReplayGame(self.replay.state(0)))
+        self.step_slider.blockSignals(True)
+        self.step_slider.setRange(0, self.replay.num_steps - 1)
+        self.step_slider.setValue(0)
+        self.step_slider.blockSignals(False)
+        self.show_step(0)
+
+    def show_step(self, step):
+        state = self.replay.state(step)
+        result = ''
+        if state[-1]:
+            result = ', won' if self.replay.user_won else ', lost'
+        self.step_lbl.setText(f'Step {step} of {self.replay.num_steps - 1}{result}')
+
+        self.board.env.show(state)
+        if not state[-1]:
+            self.board.show_actions()
+        # Steps can be far apart, so the last moves shown may be stale
+        self.board.redraw()
@@ -0,0 +1,109 @@
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from profiling import profiled
+import logging
+import threading
+
+logger = logging.getLogger('app')
+
+
+class StepSignals(QObject):
+    # step_id, numeric observation after the step
+    finished = pyqtSignal(int, object)
+    # step_id, error message
+    failed = pyqtSignal(int, str)
+
+
+class StepTask(QRunnable):
+    def __init__(self, step_id, game, action=None, after=None):
+        '''
+        step_id: Id used by StepRunner to drop results of cancelled steps
+        game:    Human_v_Agent instance
+        action:  Action name for the human player.
+                 If None, only the agent takes a step.
+        after:   Function to wait on before stepping, on the worker thread
+        '''
+        super().__init__()
+        self.step_id = step_id
+        self.game = game
+        self.action = action
+        self.after = after
+        self.signals = StepSignals()
+        # Set once the step has run, even if cancelled, for waiting off the GUI thread
+        self.done = threading.Event()
+
+    @profiled('step')
+    def run(self):
+        try:
+            if self.after is not None:
+                self.after()
+            if self.action is None:
+                self.game.agent.step()
+            else:
+                self.game.step(self.action)
+            obs = self.game.env.get_obs()
+        except Exception as e:
+            logger.exception('Game step failed')
+            self.signals.failed.emit(self.step_id, str(e))
+        else:
+            self.signals.finished.emit(self.step_id, obs)
+        finally:
+            self.done.set()
+
+
+class StepRunner(QObject):
+    '''
+    Runs Human_v_Agent steps off the GUI thread, one at a time.
+    Results come back on the GUI thread through the finished signal.
+    '''
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Use the global pool so deleting the board never waits on a slow agent
+        self.pool = QThreadPool.globalInstance()
+        self._step_id = 0
+        self._tasks = {}
+
+    @property
+    def busy(self):
+        return self._step_id in self._tasks
+
+    def submit(self, game, action=None, after=None):
+        # after is as for StepTask
+        if self.busy:
+            raise RuntimeError('A game step is already in progress')
+
+        task = StepTask(self._step_id, game, action, after)
+        task.signals.finished.connect(self._on_finished)
+        task.signals.failed.connect(self._on_failed)
+        # Keep a reference until the task reports back
+        self._tasks[self._step_id] = task
+        self.pool.start(task)
+
+    def waiter(self):
+        '''
+        Returns a function that blocks until the steps submitted so far have run,
+        including cancelled ones. It can be called from any thread.
+        '''
+        events = [task.done for task in self._tasks.values()]
+        def wait():
+            for event in events:
+                event.wait()
+        return wait
+
+    def cancel(self):
+        # A running step can't be interrupted, but its result is discarded
+        if self.busy:
+            logger.info('Cancelling game step in progress')
+        self._step_id += 1
+
+    def _on_finished(self, step_id, obs):
+        self._tasks.pop(step_id, None)
+        if step_id == self._step_id:
+            self.finished.emit(obs)
+
+    def _on_failed(self, step_id, msg):
+        self._tasks.pop(step_id, None)
+        if step_id == self._step_id:
+            self.failed.emit(msg)